@@ -0,0 +1,92 @@
+"""Benchmark a backward paginated backfill collected with `CandleBuffer` against the previous list/DataFrame prepends
+
+Usage:
+    python -m benchmarks.candle_buffer_benchmark --candles 500000 --page-size 1500 100
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils.candle_buffer_util import CandleBuffer
+
+FIELDS = ["open", "high", "low", "close", "volume"]
+HOUR_MS = 3600 * 1000
+
+
+def make_pages(n_candles: int, page_size: int, seed: int = 0):
+    """ccxt-like pages of ohlcv rows, newest page first like a backward pagination"""
+    rng = np.random.default_rng(seed)
+    timestamps = np.arange(n_candles, dtype=np.int64) * HOUR_MS
+    values = rng.random((n_candles, len(FIELDS)))
+    rows = [[int(ts), *row] for ts, row in zip(timestamps, values.tolist())]
+    pages = [rows[i : i + page_size] for i in range(0, n_candles, page_size)]
+    return pages[::-1]
+
+
+def legacy_list(pages):
+    """`all_ohlcv = ohlcv + all_ohlcv` then one DataFrame"""
+    all_ohlcv = []
+    for ohlcv in pages:
+        all_ohlcv = ohlcv + all_ohlcv
+    df = pd.DataFrame(all_ohlcv, columns=["timestamp"] + FIELDS)
+    df["timestamp"] = pd.to_datetime(df["timestamp"], unit="ms")
+    return df
+
+
+def legacy_concat(pages):
+    """`master = pd.concat([page_df, master])` on every page"""
+    master = pd.DataFrame()
+    for ohlcv in pages:
+        page_df = pd.DataFrame(ohlcv, columns=["timestamp"] + FIELDS)
+        master = pd.concat([page_df, master])
+    master["timestamp"] = pd.to_datetime(master["timestamp"], unit="ms")
+    return master.reset_index(drop=True)
+
+
+def candle_buffer(pages):
+    buffer = CandleBuffer(FIELDS)
+    for ohlcv in pages:
+        buffer.prepend_rows(ohlcv)
+    return buffer.to_frame()
+
+
+def timeit(function, pages, repeat: int = 3) -> float:
+    best = np.inf
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(pages)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--candles", type=int, nargs="+", default=[50_000, 500_000])
+    parser.add_argument("--page-size", type=int, nargs="+", default=[1500, 100])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'candles':>10} {'page':>6} {'list+list':>10} {'pd.concat':>10} {'buffer':>10}")
+
+    for n_candles in args.candles:
+        for page_size in args.page_size:
+            pages = make_pages(n_candles, page_size)
+
+            expected = legacy_list(pages)
+            result = candle_buffer(pages)
+            pd.testing.assert_frame_equal(expected, result, check_dtype=False)
+
+            timings = [
+                timeit(function, pages, args.repeat)
+                for function in [legacy_list, legacy_concat, candle_buffer]
+            ]
+            print(
+                f"{n_candles:>10,} {page_size:>6} "
+                + " ".join(f"{timing:>9.3f}s" for timing in timings)
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Memory per million rows of an OHLCV frame as the drivers used to build it, in compact mode and with float32 prices
+
+Usage:
+    python -m benchmarks.compact_frames_benchmark --rows 1000000 --tickers 300
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+from google.cloud import bigquery
+
+from utils.compact_util import (
+    PRICE_COLUMNS,
+    bytes_per_million_rows,
+    compact_dtypes,
+    concat_compact,
+    constant_category,
+    to_compact,
+)
+
+FIELDS = ["open", "high", "low", "close", "volume"]
+HOUR = np.timedelta64(1, "h")
+
+SCHEMA = [
+    bigquery.SchemaField(name="startTime", field_type="DATETIME", mode="REQUIRED"),
+    bigquery.SchemaField(name="ticker", field_type="STRING", mode="REQUIRED"),
+    *(bigquery.SchemaField(name=field, field_type="FLOAT", mode="REQUIRED") for field in FIELDS),
+]
+
+
+def make_markets(n_rows: int, n_tickers: int, seed: int = 0):
+    """one frame per market like `ohlcv_to_dataframe` returns, with `ticker` as repeated strings"""
+    rng = np.random.default_rng(seed)
+    rows_per_ticker = n_rows // n_tickers
+    times = np.datetime64("2021-01-01T00:00:00", "ns") + np.arange(rows_per_ticker) * HOUR
+
+    frames = []
+    for i in range(n_tickers):
+        df = pd.DataFrame({"startTime": times})
+        for field in FIELDS:
+            df[field] = rng.random(rows_per_ticker) * 1000
+        df["ticker"] = f"TICKER{i}-USDT-SWAP"
+        frames.append(df)
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--tickers", type=int, default=300)
+    args = parser.parse_args()
+
+    markets = make_markets(args.rows, args.tickers)
+
+    legacy = pd.concat(markets, ignore_index=True)
+
+    categorical = []
+    for df in markets:
+        df = df.copy()
+        df["ticker"] = constant_category(df["ticker"].iloc[0], len(df))
+        categorical.append(df)
+
+    compact = concat_compact([to_compact(df, compact_dtypes(SCHEMA)) for df in categorical])
+    float32 = to_compact(compact, compact_dtypes(SCHEMA, PRICE_COLUMNS))
+
+    print(f"{len(legacy):,} rows, {args.tickers} tickers")
+    print(f"{'frame':>30} {'MB per 1M rows':>15}")
+    for name, df in [
+        ("datetime64 + str tickers", legacy),
+        ("datetime64 + categorical", concat_compact(categorical)),
+        ("compact (int64 ms)", compact),
+        ("compact + float32 prices", float32),
+    ]:
+        print(f"{name:>30} {bytes_per_million_rows(df) / 1e6:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""Run the drivers offline against recorded HTTP responses and an in-memory BigQuery
+
+Cassettes are recorded once, with network access:
+    python -m benchmarks.replay_drivers --record binance_funding dydx_funding
+
+or from a synthetic exchange, see `SYNTHETIC`, e.g. the committed `dydx_funding` cassette replayed in CI:
+    TZ=UTC python -m benchmarks.replay_drivers --record --synthetic dydx_funding
+
+and replayed by `benchmarks/test_drivers_benchmark.py`, or from the command line:
+    python -m benchmarks.replay_drivers binance_funding
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Iterable
+from unittest import mock
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from drivers import CCXTDriverFunding, CCXTDriverOHLCV, DYDXFunding, DYDXFutures
+from drivers.dydx_drivers.async_client import MAX_SAMPLES, AsyncDydxClient, parse_iso, to_iso
+from drivers.okx_drivers.webscraper import downloader
+from drivers.okx_drivers.webscraper.downloader import OKXWebscaper
+from tests.fake_bigquery import FakeBigQueryClient
+from tests.replay import FIXTURES_DIR, replay
+from utils.bigquery_util import set_bigquery_client
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ID = "replay-project"
+
+
+def binance_ohlcv_1h_future():
+    driver = CCXTDriverOHLCV(
+        ccxt_exchange_id="binance",
+        timeframe="1h",
+        instrument_type="future",
+        coinapi_exchange_id="BINANCEFTS",
+        coinapi_symbol_type="PERPETUAL",
+    )
+    return driver, lambda: driver.fetch_data(upload=True, upload_one_at_a_time=True)
+
+
+def binance_funding():
+    driver = CCXTDriverFunding(
+        ccxt_exchange_id="binance",
+        coinapi_exchange_id="BINANCEFTS",
+        coinapi_symbol_type="PERPETUAL",
+    )
+    return driver, lambda: driver.fetch_data(upload=True, upload_one_at_a_time=True)
+
+
+def okx_ohlcv_1h_future():
+    driver = CCXTDriverOHLCV(
+        ccxt_exchange_id="okx",
+        timeframe="1h",
+        instrument_type="future",
+        coinapi_exchange_id="OKEX",
+        coinapi_symbol_type="PERPETUAL",
+        upload_data=True,
+    )
+    return driver, lambda: driver.fetch_data()
+
+
+def dydx_funding():
+    driver = DYDXFunding()
+    return driver, lambda: driver.fetch_data(upload=True, upload_one_at_a_time=True)
+
+
+def dydx_ohlcv_1h():
+    driver = DYDXFutures(timeframe="1HOUR")
+    return driver, lambda: driver.fetch_data(upload=True, upload_one_at_a_time=True)
+
+
+def okx_downloader():
+    """the archives of the last two days only, the whole history is hundreds of GB"""
+    folder = Path(tempfile.mkdtemp(prefix="okx_replay_"))
+    # the downloader's `date` is frozen during a replay
+    today = downloader.date.today()
+    webscraper = OKXWebscaper(
+        data_type="aggtrades",
+        period="daily",
+        resume_path=folder,
+        start_date=today - timedelta(days=2),
+    )
+    return None, webscraper.okx_download
+
+
+# name -> factory returning (driver or None, fetch function), called within the replay
+DRIVERS = {
+    "binance_ohlcv_1h_future": binance_ohlcv_1h_future,
+    "binance_funding": binance_funding,
+    "okx_ohlcv_1h_future": okx_ohlcv_1h_future,
+    "dydx_funding": dydx_funding,
+    "dydx_ohlcv_1h": dydx_ohlcv_1h,
+    "okx_downloader": okx_downloader,
+}
+
+
+@contextmanager
+def synthetic_dydx(markets: Iterable[str] = ("BTC-USD", "ETH-USD"), history: timedelta = timedelta(days=10)):
+    """a dYdX listing `markets`, each with hourly funding payments over the last `history`, instead of the network
+
+    Only answers `/v3/markets` and `/v3/historical-funding`, anything else raises.
+    """
+    markets = list(markets)
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    listed = (now - history).replace(minute=0, second=0, microsecond=0)
+
+    def send(adapter, request, *args, **kwargs):
+        if urlsplit(request.url).path != "/v3/markets":
+            raise NotImplementedError(f"synthetic dYdX can't answer {request.url}")
+
+        response = requests.Response()
+        response.status_code = 200
+        response.headers["Content-Type"] = "application/json"
+        response._content = json.dumps(
+            {"markets": {market: {"market": market, "status": "ONLINE"} for market in markets}}
+        ).encode()
+        response.url = request.url
+        response.request = request
+        return response
+
+    async def get_once(client, path: str, params: dict) -> dict:
+        if not path.startswith("/v3/historical-funding/"):
+            raise NotImplementedError(f"synthetic dYdX can't answer {path}")
+
+        market = path.rsplit("/", 1)[-1]
+        t = parse_iso(params["effectiveBeforeOrAt"]).replace(minute=0, second=0, microsecond=0)
+        rows = []
+        # newest first, like the API
+        while t >= listed and len(rows) < MAX_SAMPLES:
+            hours = (t - listed) // timedelta(hours=1)
+            rows.append(
+                {"market": market, "rate": f"{hours % 7 - 3}e-6", "price": str(1000 + hours), "effectiveAt": to_iso(t)}
+            )
+            t -= timedelta(hours=1)
+        return {"historicalFunding": rows}
+
+    with mock.patch.object(HTTPAdapter, "send", send), mock.patch.object(AsyncDydxClient, "_get_once", get_once):
+        yield
+
+
+# name -> context manager serving the driver's requests, to record a cassette without network access
+SYNTHETIC = {
+    "dydx_funding": synthetic_dydx,
+}
+
+
+def cassette_path(name: str) -> Path:
+    return FIXTURES_DIR / f"{name}.json.gz"
+
+
+@contextmanager
+def offline(name: str, mode: str = "replay"):
+    """the environment of an offline run: a fresh fake BigQuery, no watermark store, candle cache, CoinAPI or symbol
+    index snapshot
+
+    :return: the fake BigQuery client
+    """
+    client = FakeBigQueryClient(PROJECT_ID)
+    set_bigquery_client(PROJECT_ID, client)
+
+    with tempfile.TemporaryDirectory(prefix="replay_") as folder:
+        env = {
+            "project_id": PROJECT_ID,
+            "WATERMARK_DB_PATH": "",
+            "CANDLE_CACHE_DIR": "",
+            "COINAPI_CACHE_DIR": folder,
+            "SYMBOL_INDEX_DIR": "",
+            "BIGQUERY_SINK": "load",
+            "JOB_METRICS_LOG": "",
+        }
+        with mock.patch.dict(os.environ, env), replay(cassette_path(name), mode):
+            yield client
+
+
+def run(name: str, mode: str = "replay") -> FakeBigQueryClient:
+    """run a driver end to end, returns the fake BigQuery client with everything it uploaded"""
+    with offline(name, mode) as client:
+        _, fetch = DRIVERS[name]()
+        fetch()
+    return client
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("drivers", nargs="+", choices=sorted(DRIVERS))
+    parser.add_argument("--record", action="store_true", help="record new cassettes, needs network access")
+    parser.add_argument("--synthetic", action="store_true", help="record from the `SYNTHETIC` exchanges instead")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    for name in args.drivers:
+        started = time.perf_counter()
+        if args.record and args.synthetic:
+            with SYNTHETIC[name]():
+                client = run(name, mode="record")
+        else:
+            client = run(name, mode="record" if args.record else "replay")
+        rows = {table_id: len(client.table_data(table_id)) for table_id in client.tables}
+        print(f"{name}: {time.perf_counter() - started:.2f}s, uploaded {rows}")
+
+
+if __name__ == "__main__":
+    main()
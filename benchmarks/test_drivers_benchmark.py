@@ -0,0 +1,92 @@
+"""pytest-benchmark suite of the drivers replayed offline, see `benchmarks/replay_drivers.py`
+
+Usage:
+    pytest benchmarks/test_drivers_benchmark.py --benchmark-only --benchmark-group-by=func
+
+Drivers without a recorded cassette are skipped, the synthetic `dydx_funding` one is committed so CI replays at least
+one driver end to end.
+"""
+from unittest import mock
+
+import pytest
+from google.cloud import bigquery
+
+from benchmarks.replay_drivers import DRIVERS, cassette_path, offline, run
+from drivers.base import DataDriver
+from tests.fake_bigquery import FakeBigQueryClient
+from utils.sink_util import LoadJobSink
+
+pytest.importorskip("pytest_benchmark")
+
+RECORDED = [name for name in DRIVERS if cassette_path(name).exists()]
+
+if len(RECORDED) == 0:
+    pytest.skip(
+        "no recorded cassette, see benchmarks/replay_drivers.py", allow_module_level=True
+    )
+
+
+def fetch_only(name: str):
+    """replay `name` with uploads captured instead of validated and loaded
+
+    :return: the driver and the (DataFrame, unique_col) it tried to upload
+    """
+    uploads = []
+
+    def capture(driver, df, unique_col):
+        uploads.append((df, unique_col))
+
+    with offline(name), mock.patch.object(DataDriver, "load_from_dataframe", capture):
+        driver, fetch = DRIVERS[name]()
+        fetch()
+
+    return driver, uploads
+
+
+@pytest.fixture(scope="module", params=RECORDED)
+def fetched(request):
+    driver, uploads = fetch_only(request.param)
+    if driver is None:
+        pytest.skip(f"{request.param} doesn't upload anything")
+    return request.param, driver, uploads
+
+
+@pytest.mark.parametrize("name", RECORDED)
+def test_fetch_data(benchmark, name):
+    client = benchmark.pedantic(run, args=(name,), rounds=3, iterations=1)
+
+    benchmark.extra_info["queries"] = len(client.queries)
+
+
+@pytest.mark.parametrize("name", RECORDED)
+def test_fetch_stage(benchmark, name):
+    benchmark.pedantic(fetch_only, args=(name,), rounds=3, iterations=1)
+
+
+def test_validate_stage(benchmark, fetched):
+    name, driver, uploads = fetched
+
+    def validate():
+        return [driver.validate_df(df, unique_col=unique_col) for df, unique_col in uploads]
+
+    frames = benchmark(validate)
+
+    benchmark.extra_info["rows"] = sum(len(df) for df in frames)
+
+
+def test_upload_stage(benchmark, fetched):
+    name, driver, uploads = fetched
+    frames = [driver.validate_df(df, unique_col=unique_col) for df, unique_col in uploads]
+
+    def upload():
+        client = FakeBigQueryClient()
+        client.create_table(bigquery.Table(driver.TABLE_ID, schema=driver.schema))
+        sink = LoadJobSink(client)
+        for df in frames:
+            sink.write(driver.TABLE_ID, df)
+        sink.commit()
+        return sink
+
+    sink = benchmark(upload)
+
+    benchmark.extra_info.update(sink.metrics.as_dict())
@@ -0,0 +1,124 @@
+"""Benchmark the vectorized `validate_timeseries` against the previous per-ticker loop of `DataDriver.validate_df`
+
+Usage:
+    python -m benchmarks.validate_df_benchmark --rows 10000 1000000 10000000 --legacy-max-rows 1000000
+"""
+import argparse
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils.validation_util import validate_timeseries
+
+logging.disable(logging.WARNING)
+
+
+def make_ohlcv(n_rows: int, n_tickers: int, timeframe: str = "1min", seed: int = 0):
+    """Synthetic OHLCV with ~0.1% duplicated rows, ~0.1% gaps and one ticker with misaligned seconds"""
+    rng = np.random.default_rng(seed)
+    rows_per_ticker = max(n_rows // n_tickers, 1)
+    step = pd.Timedelta(timeframe)
+
+    start = pd.Timestamp("2021-10-01")
+    ts = start + step * np.tile(np.arange(rows_per_ticker), n_tickers)
+    tickers = np.repeat([f"T{i}-USDT-SWAP" for i in range(n_tickers)], rows_per_ticker)
+
+    df = pd.DataFrame(
+        {
+            "startTime": ts,
+            "ticker": tickers,
+            "close": rng.random(len(ts)),
+            "volume": rng.random(len(ts)),
+        }
+    )
+
+    drop = rng.random(len(df)) < 0.001
+    drop[::rows_per_ticker] = False  # keep the first sample of each ticker
+    df = df[~drop]
+    df = pd.concat([df, df.sample(frac=0.001, random_state=seed)])
+    df.loc[df["ticker"] == "T0-USDT-SWAP", "startTime"] += pd.Timedelta(seconds=1)
+
+    return df.sample(frac=1.0, random_state=seed).reset_index(drop=True)
+
+
+def legacy_validate(df: pd.DataFrame, timeframe: str):
+    """The per-ticker loop `DataDriver.validate_df` used before the vectorized engine"""
+    clean_df = pd.DataFrame()
+    stats = pd.DataFrame(columns=["duplicated", "missing"])
+
+    for ticker in df["ticker"].unique():
+        ticker_df = df[df["ticker"] == ticker]
+        ticker_df = ticker_df.set_index("startTime")
+        ticker_df = ticker_df.sort_index()
+        index_time = pd.Series(ticker_df.index)
+
+        if not index_time.apply(lambda x: x.second == 0).all():
+            ticker_df.index = ticker_df.index.floor("min")
+
+        duplicated = ticker_df.index.duplicated()
+        if duplicated.any():
+            ticker_df = ticker_df[~duplicated]
+
+        t_start = ticker_df.index[0]
+        t_end = ticker_df.index[-1]
+        all = pd.Series(data=pd.date_range(start=t_start, end=t_end, freq=timeframe))
+        mask = all.isin(ticker_df.index)
+        missing_timestamp = all[~mask]
+
+        if len(missing_timestamp) != 0:
+            ticker_df = ticker_df.resample(timeframe).asfreq()
+            ticker_df["ticker"] = ticker_df["ticker"].ffill()
+
+        stats.loc[ticker, "missing"] = len(missing_timestamp)
+        stats.loc[ticker, "duplicated"] = duplicated.sum()
+
+        clean_df = pd.concat([clean_df, ticker_df])
+
+    return clean_df.sort_index(), stats
+
+
+def timeit(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 1_000_000, 10_000_000])
+    parser.add_argument("--tickers", type=int, default=300)
+    parser.add_argument("--timeframe", default="1min")
+    parser.add_argument(
+        "--legacy-max-rows",
+        type=int,
+        default=1_000_000,
+        help="skip the legacy loop above this size, it is quadratic in the number of tickers",
+    )
+    args = parser.parse_args()
+
+    print(f"{'rows':>12} {'tickers':>8} {'legacy (s)':>12} {'vectorized (s)':>15} {'speedup':>8}")
+
+    for n_rows in args.rows:
+        df = make_ohlcv(n_rows, args.tickers, args.timeframe)
+
+        vectorized = timeit(
+            validate_timeseries,
+            df,
+            timestamp_col="startTime",
+            market_col="ticker",
+            timeframe=args.timeframe,
+        )
+
+        if n_rows <= args.legacy_max_rows:
+            legacy = timeit(legacy_validate, df, args.timeframe)
+            print(
+                f"{n_rows:>12,} {args.tickers:>8} {legacy:>12.3f} {vectorized:>15.3f} {legacy / vectorized:>7.1f}x"
+            )
+        else:
+            print(f"{n_rows:>12,} {args.tickers:>8} {'skipped':>12} {vectorized:>15.3f} {'-':>8}")
+
+
+if __name__ == "__main__":
+    main()
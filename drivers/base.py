@@ -1,13 +1,40 @@
 from abc import ABC, abstractmethod
-from datetime import datetime
+from datetime import datetime, timedelta
 from google.cloud import bigquery
-from google.oauth2 import service_account
 from dotenv import load_dotenv
 import os
+import threading
 from google.cloud.exceptions import NotFound, Conflict
 import logging
 import pandas as pd
 from utils.coinAPI_util import CoinAPI
+from utils.validation_util import validate_timeseries, unexpected_time_mask
+from utils.sink_util import (
+    BaseSink,
+    LoadJobSink,
+    MergeSink,
+    StreamingSink,
+    StorageWriteApiWriter,
+)
+from utils.cache_util import CandleCache
+from utils.watermark_util import WatermarkStore, summarise
+from utils.gap_util import FetchRange, gap_query, plan_fetches
+from utils.partition_util import partition_table, watermark_query
+from utils.compact_util import (
+    PRICE_COLUMNS,
+    compact_dtypes,
+    concat_compact,
+    from_compact,
+    to_compact,
+)
+from utils.instrumentation_util import Instrumentation
+from utils.coalesce_util import UploadCoalescer, arrow_nbytes
+from utils.bigquery_util import (
+    ensure_once,
+    get_bigquery_client,
+    get_bigquery_credentials,
+)
+from typing import Callable, Iterable, List
 import numpy as np
 import seaborn as sns
 
@@ -15,13 +42,23 @@ import seaborn as sns
 logger = logging.getLogger(__name__)
 load_dotenv()
 
+# `DataFrame.attrs` flag of a fetch that stopped early (e.g. on an error), only its newest candles are contiguous
+PARTIAL_FETCH = "partial"
+
 """
 For ease of use, let's name the main datetime field as startTime
 """
 
 
 class DataDriver(ABC):
-    def __init__(self, dataset_id: str, table_name: str, timeframe: str):
+    def __init__(
+        self,
+        dataset_id: str,
+        table_name: str,
+        timeframe: str,
+        sink: BaseSink = None,
+        compact: bool = None,
+    ):
         self.PROJECT_ID = os.environ.get("project_id")
 
         self.DATASET_ID = dataset_id
@@ -33,45 +70,105 @@ class DataDriver(ABC):
 
         self.timeframe = timeframe
 
-        # we favor small but frequent uploads
-        self.max_upload_size_mb = 0.2
-
-        info = {
-            "type": os.getenv("type"),
-            "project_id": os.getenv("project_id"),
-            "private_key_id": os.getenv("private_key_id"),
-            "private_key": os.getenv("private_key"),
-            "client_email": os.getenv("client_email"),
-            "client_id": os.getenv("client_id"),
-            "auth_uri": os.getenv("auth_uri"),
-            "token_uri": os.getenv("token_uri"),
-            "auth_provider_x509_cert_url": os.getenv("auth_provider_x509_cert_url"),
-            "client_x509_cert_url": os.getenv("client_x509_cert_url"),
-        }
-
-        bigquery_credentials = service_account.Credentials.from_service_account_info(
-            info
+        # `queue_upload` batches markets into uploads of this much Arrow data, a batch waits at most this long
+        self.upload_batch_bytes = int(float(os.getenv("UPLOAD_BATCH_MB", 8)) * 1e6)
+        self.upload_batch_age_s = float(os.getenv("UPLOAD_BATCH_AGE_S", 60))
+        # fetching pauses while more than this is waiting to be uploaded
+        self.upload_max_inflight_bytes = int(
+            float(os.getenv("UPLOAD_MAX_INFLIGHT_MB", 128)) * 1e6
         )
-
-        self.BQ_client = bigquery.Client(
-            project=self.PROJECT_ID, credentials=bigquery_credentials
+        # unique_col -> coalescer, created on first use
+        self.coalescers = {}
+
+        # where validated data is uploaded, `load` (one load job per upload) or `stream` (Storage Write API)
+        # created on first use, like the BigQuery client
+        self._sink = sink
+        # markets can be fetched concurrently, but sinks aren't thread-safe
+        self.sink_lock = threading.RLock()
+
+        # latest timestamp per ticker, updated after each committed upload (None if disabled)
+        self.watermarks = WatermarkStore.from_env()
+        self.pending_watermarks = []
+
+        # local copy of fetched candles, so reruns don't download the same history again (None if disabled)
+        self.candle_cache = CandleCache.from_env(
+            timestamp_col=self.unified_timestamp_name
         )
 
+        # keep fetched frames with int64 ms timestamps and categorical tickers until they are uploaded
+        if compact is None:
+            compact = os.getenv("COMPACT_FRAMES", "0") == "1"
+        self.compact = compact
+
+        # time spent fetching, parsing, validating and uploading, exported at the end of each run
+        self.instrumentation = Instrumentation(table_id=self.TABLE_ID)
+
         self.CoinApi = CoinAPI()
 
-        self.create_dataset()
-        self.create_table()
+    @property
+    def bigquery_credentials(self):
+        return get_bigquery_credentials()
+
+    @property
+    def BQ_client(self) -> bigquery.Client:
+        """the process-wide client, the dataset and table are created (once per process) on first use"""
+        client = get_bigquery_client(self.PROJECT_ID)
+
+        ensure_once(("dataset", self.PROJECT_ID, self.DATASET_ID), self.create_dataset)
+        ensure_once(("table", self.TABLE_ID), self.create_table)
+
+        return client
+
+    @property
+    def sink(self) -> BaseSink:
+        if self._sink is None:
+            with self.sink_lock:
+                if self._sink is None:
+                    self._sink = self.create_sink()
+        return self._sink
 
     @property
     @abstractmethod
     def schema(self):
         pass
 
+    @property
+    def compact_dtypes(self) -> dict:
+        """the in-memory dtype of each column of `schema` in compact mode"""
+        return compact_dtypes(self.schema)
+
+    def to_compact(self, df: pd.DataFrame, float32: bool = False) -> pd.DataFrame:
+        """int64 ms timestamps and categorical tickers, and float32 prices if `float32` is set"""
+        dtypes = compact_dtypes(self.schema, PRICE_COLUMNS if float32 else ())
+        return to_compact(df, dtypes)
+
+    def read_table(self, since: datetime = None, float32: bool = True) -> pd.DataFrame:
+        """a compact research extract of the table
+
+        :param since: only the rows after this date
+        :param float32: whether to keep prices as float32, roughly halving their memory
+        """
+        where = (
+            f"WHERE {self.unified_timestamp_name} >= DATETIME('{since:%Y-%m-%d %H:%M:%S}')"
+            if since
+            else ""
+        )
+        query = f"SELECT * FROM `{self.TABLE_ID}` {where} ORDER BY {self.unified_timestamp_name}"
+        df = self.BQ_client.query(query).to_dataframe()
+        return self.to_compact(df, float32=float32)
+
     @property
     @abstractmethod
     def possible_resolutions(self):
         pass
 
+    @property
+    def timeframe_step(self) -> timedelta:
+        """the candle size"""
+        return getattr(self, "timeframe_timedelta", None) or pd.Timedelta(
+            self.timeframe
+        ).to_pytimedelta()
+
     @property
     @abstractmethod
     def period_to_pandas(self) -> dict:
@@ -86,9 +183,29 @@ class DataDriver(ABC):
         """
         pass
 
+    def create_sink(self) -> BaseSink:
+        sink_type = os.getenv("BIGQUERY_SINK", "load")
+
+        if sink_type == "load":
+            return LoadJobSink(self.BQ_client)
+        elif sink_type == "stream":
+            writer = StorageWriteApiWriter(
+                self.BQ_client, credentials=self.bigquery_credentials
+            )
+            return StreamingSink(writer)
+        elif sink_type == "merge":
+            return MergeSink(
+                self.BQ_client,
+                key_columns=[self.unified_market_name, self.unified_timestamp_name],
+                max_batch_rows=int(os.getenv("MERGE_BATCH_ROWS", 1_000_000)),
+                max_batch_bytes=int(float(os.getenv("MERGE_BATCH_MB", 64)) * 1e6),
+            )
+        else:
+            raise NotImplementedError(f"BIGQUERY_SINK={sink_type} not implemented")
+
     def check_dataset_exists(self):
         try:
-            self.BQ_client.get_dataset(self.DATASET_ID)  # Make an API request.
+            get_bigquery_client(self.PROJECT_ID).get_dataset(self.DATASET_ID)  # Make an API request.
             print(f"Dataset {self.DATASET_ID} already exists")
             return True
         except NotFound:
@@ -98,12 +215,10 @@ class DataDriver(ABC):
     def create_table(self):
 
         table = bigquery.Table(self.TABLE_ID, schema=self.schema)
-
-        # if hasattr(self.__class__, "time_partitioning"):
-        #     table = self.time_partitioning(table)
+        table = self.time_partitioning(table)
 
         try:
-            table = self.BQ_client.create_table(table)  # Make an API request.
+            table = get_bigquery_client(self.PROJECT_ID).create_table(table)  # Make an API request.
             logger.info(
                 f"Created table {table.project}.{table.dataset_id}.{table.table_id}"
             )
@@ -113,10 +228,19 @@ class DataDriver(ABC):
             logger.fatal(e)
             raise Exception("Something bad & unexpected happened")
 
+    def time_partitioning(self, table: bigquery.Table) -> bigquery.Table:
+        """partition by timestamp (see `utils.partition_util.partitioning_type`) and cluster by ticker"""
+        return partition_table(
+            table,
+            timestamp_col=self.unified_timestamp_name,
+            market_col=self.unified_market_name,
+            step=self.timeframe_step,
+        )
+
     def create_dataset(self):
 
         try:
-            table = self.BQ_client.create_dataset(
+            table = get_bigquery_client(self.PROJECT_ID).create_dataset(
                 self.DATASET_ID
             )  # Make an API request.
             logger.info(f"Created table {table.project}.{table.dataset_id}")
@@ -126,29 +250,109 @@ class DataDriver(ABC):
             logger.fatal(e)
             raise Exception("Something bad & unexpected happened")
 
-    def get_latest_date(self) -> datetime:
+    def get_latest_date(
+        self, reconcile: bool = None, tickers: Iterable[str] = None
+    ) -> pd.DataFrame:
+        """max/min/count of the timestamps per ticker
 
-        query_job = self.BQ_client.query(
-            f"""SELECT
-                max({self.unified_timestamp_name}) as maxStartTime,
-                min({self.unified_timestamp_name}) as minStartTime,
-                count({self.unified_timestamp_name}) as countStartTime,
-                {self.unified_market_name}
-                FROM {self.TABLE_ID}
-                GROUP BY {self.unified_market_name}
-                ORDER BY maxStartTime DESC"""
-        )
+        Answered from the watermark store when it knows the table. Otherwise (or when reconciling) from the table:
+        with `tickers`, only the partitions of the last `WATERMARK_LOOKBACK_DAYS` (35) days are read, and the tickers
+        missing from them are looked up in their clustered blocks. Without, the whole table is scanned. The store is
+        then rebuilt from the result.
 
-        df = query_job.to_dataframe()
+        :param reconcile: force reading the table, defaults to the `WATERMARK_RECONCILE` environment variable
+        :param tickers: the tickers the caller is about to fetch
+        :return: a DataFrame with the maxStartTime, minStartTime, countStartTime and ticker columns, minStartTime and
+            countStartTime only cover the lookback for the tickers found in it
+        """
+        if reconcile is None:
+            reconcile = os.getenv("WATERMARK_RECONCILE") == "True"
+
+        if self.watermarks is not None and not reconcile:
+            df = self.watermarks.get(self.TABLE_ID)
+            if not df.empty:
+                logger.info(f"Using stored watermarks for {self.TABLE_ID}")
+                return df
+
+        if tickers is None:
+            df = self._query_watermarks()
+        else:
+            tickers = list(tickers)
+            lookback = timedelta(days=float(os.getenv("WATERMARK_LOOKBACK_DAYS", 35)))
+            df = self._query_watermarks(since=datetime.utcnow() - lookback)
+
+            missing = sorted(set(tickers) - set(df[self.unified_market_name]))
+            if len(missing) > 0:
+                logger.info(
+                    f"{len(missing)} tickers not updated within {lookback}, looking them up"
+                )
+                df = pd.concat(
+                    [df, self._query_watermarks(tickers=missing)], ignore_index=True
+                )
 
         if df.empty:
             logger.warning(
                 f"Table is either empty or doesn't contain time field named `startTime`."
             )
 
+        if self.watermarks is not None:
+            self.watermarks.replace(self.TABLE_ID, df)
+
         return df
 
-    def validate_df(self, df: pd.DataFrame, unique_col: str, savefig_path: str = None):
+    def _query_watermarks(
+        self, since: datetime = None, tickers: List[str] = None
+    ) -> pd.DataFrame:
+        query_job = self.BQ_client.query(
+            watermark_query(
+                self.TABLE_ID,
+                timestamp_col=self.unified_timestamp_name,
+                market_col=self.unified_market_name,
+                since=since,
+                tickers=tickers,
+            )
+        )
+        return query_job.to_dataframe()
+
+    def get_gaps(self, unique_col: str, since: datetime = None) -> pd.DataFrame:
+        """[start, end) of the holes of every ticker in the table: missing rows and rows where `unique_col` is NULL
+
+        :param unique_col: a column that is only NULL for rows added to fill a gap
+        :param since: only look for gaps after this date, to avoid scanning the whole table
+        :return: a DataFrame with the ticker, start and end columns
+        """
+        query_job = self.BQ_client.query(
+            gap_query(
+                self.TABLE_ID,
+                timestamp_col=self.unified_timestamp_name,
+                market_col=self.unified_market_name,
+                unique_col=unique_col,
+                step=self.timeframe_step,
+                since=since,
+            )
+        )
+
+        return query_job.to_dataframe()
+
+    def get_gap_plan(self, unique_col: str, since: datetime = None) -> List[FetchRange]:
+        """the minimal ranges to fetch to fill the holes found by `get_gaps`"""
+        return plan_fetches(self.get_gaps(unique_col, since=since))
+
+    def validate_df(
+        self,
+        df: pd.DataFrame,
+        unique_col: str,
+        savefig_path: str = None,
+        return_stats: bool = False,
+    ):
+        """Floor, de-duplicate and re-index every ticker on the expected timeframe grid
+
+        :param df: the DataFrame to clean, must contain the unified timestamp and market columns
+        :param unique_col: a column that is only NaN for missing samples, used to plot the data availability
+        :param savefig_path: if set, where to save the data availability plot
+        :param return_stats: whether to also return the per-ticker `duplicated` and `missing` counts
+        :return: the cleaned DataFrame (and the stats if `return_stats` is set)
+        """
 
         if not self.unified_timestamp_name in df.columns:
             raise Exception(
@@ -160,84 +364,34 @@ class DataDriver(ABC):
                 f"{self.unified_market_name} needs to be a column in the DataFrame"
             )
 
-        clean_df = pd.DataFrame()
-        stats = pd.DataFrame(columns=["duplicated", "missing"])
-
-        for ticker in df[self.unified_market_name].unique():
-
-            logger.info(f"Processing: {ticker}")
-
-            ticker_df = df[df[self.unified_market_name] == ticker]
-            ticker_df = ticker_df.set_index("startTime")
-            ticker_df = ticker_df.sort_index()
-            index_time = pd.Series(ticker_df.index)
-
-            # check seconds for all periods
-            if not index_time.apply(lambda x: x.second == 0).all():
-                logger.warning(f"Not all seconds are zero")
-                ticker_df.index = ticker_df.index.floor("min")
-
-            # check seconds for all hourly and above
-            if self.timeframe.upper() in ["1H", "8H"]:
-                if not index_time.apply(lambda x: x.minute == 0).all():
-                    logger.warning(f"Not all minutes are zero")
-                    ticker_df.index = ticker_df.index.floor("h")
-
-            # check for duplicates
-            duplicated = ticker_df.index.duplicated()
-            if duplicated.any():
-                logger.warning(
-                    f"Duplicated {len(duplicated)} samples ({(duplicated.sum() / len(ticker_df) - 1)*100:.2f}%)"
-                )
-                ticker_df = ticker_df[~duplicated]
-
-            # check for gaps in timeseries
-            t_start = ticker_df.index[0]
-            t_end = ticker_df.index[-1]
-
-            all = pd.Series(
-                data=pd.date_range(start=t_start, end=t_end, freq=self.timeframe)
-            )
-            mask = all.isin(ticker_df.index)
-            missing_timestamp = all[~mask]
-
-            if len(missing_timestamp) != 0:
-                logger.warning(
-                    f"Missing {len(missing_timestamp)} samples ({(len(missing_timestamp) / len(ticker_df) - 1)*100:.2f}%)"
-                )
-                ticker_df = ticker_df.resample(self.timeframe).asfreq()
-                ticker_df[self.unified_market_name] = ticker_df[
-                    self.unified_market_name
-                ].ffill()
-
-            stats.loc[ticker, "missing"] = len(missing_timestamp)
-            stats.loc[ticker, "duplicated"] = duplicated.sum()
-
-            clean_df = pd.concat([clean_df, ticker_df])
-
-            logger.info("\n")
-
-        offset_alias = self.period_to_pandas[self.timeframe]
+        clean_df, stats = validate_timeseries(
+            df,
+            timestamp_col=self.unified_timestamp_name,
+            market_col=self.unified_market_name,
+            timeframe=self.timeframe,
+            floor_to_hour=self.timeframe.upper() in ["1H", "8H"],
+        )
 
         # Ensure that all times are as we expect
-        unique_times = np.unique(clean_df.index.time)
-        expected_times = pd.date_range("00:00", "23:59", freq=offset_alias).time
-        unexpected_times = unique_times[~np.isin(unique_times, expected_times)]
+        unexpected = unexpected_time_mask(clean_df.index, self.timeframe)
 
-        if len(unexpected_times) > 0:
+        if unexpected.any():
+            unexpected_times = np.unique(clean_df.index[unexpected].time)
             logger.info(f"Got UNEXPECTED time(s): {unexpected_times}")
-            clean_df = clean_df[~np.isin(clean_df.index.time, unexpected_times)]
+            clean_df = clean_df[~unexpected]
 
-        logger.info(f"Unique times: {unique_times}")
-        logger.info(f"Total missing rows: {(len(clean_df) / len(df) - 1) * 100:.2f}%")
+        if len(df) > 0:
+            logger.info(
+                f"Total missing rows: {(len(clean_df) / len(df) - 1) * 100:.2f}%"
+            )
 
         if savefig_path:
             clean_df["is_valid"] = np.where(clean_df[unique_col].isna(), 0, 1)
             ax = sns.relplot(
                 data=clean_df.reset_index(),
-                x="startTime",
+                x=self.unified_timestamp_name,
                 y="is_valid",
-                row="ticker",
+                row=self.unified_market_name,
                 kind="line",
                 height=0.8,
                 aspect=8,
@@ -252,23 +406,192 @@ class DataDriver(ABC):
                 logger.info(e)
             clean_df.drop(columns=["is_valid"], inplace=True)
 
-        return clean_df.sort_index().reset_index()
+        clean_df = clean_df.reset_index()
+
+        if return_stats:
+            return clean_df, stats
+
+        return clean_df
+
+    def cache_key(self, market: str) -> tuple:
+        instrument_type = getattr(self, "instrument_type", None) or "default"
+        return self.DATASET_ID, instrument_type, self.timeframe, market
+
+    def fetch_with_cache(
+        self,
+        market: str,
+        from_time_dt: datetime,
+        to_time_dt: datetime,
+        fetch_function: Callable,
+    ) -> pd.DataFrame:
+        """Only fetch the parts of [from_time_dt, to_time_dt) that aren't in the candle cache
+
+        The latest candle of each fetch is never cached since it might still be open. A fetch flagged with
+        `PARTIAL_FETCH` is only cached from its earliest candle, the older part is fetched again next time.
+
+        :param market: the ticker/market name
+        :param from_time_dt: the earliest point in time to fetch
+        :param to_time_dt: the latest point in time to fetch
+        :param fetch_function: called as `fetch_function(market, start, end)` and returns a DataFrame
+        :return: the cached and fetched candles as one DataFrame
+        """
+        if self.candle_cache is None:
+            return fetch_function(market, from_time_dt, to_time_dt)
+
+        key = self.cache_key(market)
+        frames = []
+
+        for start, end in self.candle_cache.missing_ranges(
+            key, from_time_dt, to_time_dt
+        ):
+            df = fetch_function(market, start.to_pydatetime(), end.to_pydatetime())
+            frames.append(self._cache_fetched(key, df, start, end))
+
+        return self._merge_with_cache(key, market, frames, from_time_dt, to_time_dt)
+
+    async def fetch_with_cache_async(
+        self,
+        market: str,
+        from_time_dt: datetime,
+        to_time_dt: datetime,
+        fetch_function: Callable,
+    ) -> pd.DataFrame:
+        """same as `fetch_with_cache` for a coroutine `fetch_function`"""
+        if self.candle_cache is None:
+            return await fetch_function(market, from_time_dt, to_time_dt)
+
+        key = self.cache_key(market)
+        frames = []
+
+        for start, end in self.candle_cache.missing_ranges(
+            key, from_time_dt, to_time_dt
+        ):
+            df = await fetch_function(
+                market, start.to_pydatetime(), end.to_pydatetime()
+            )
+            frames.append(self._cache_fetched(key, df, start, end))
+
+        return self._merge_with_cache(key, market, frames, from_time_dt, to_time_dt)
+
+    def _cache_fetched(
+        self, key: tuple, df: pd.DataFrame, start: pd.Timestamp, end: pd.Timestamp
+    ) -> pd.DataFrame:
+        """cache the fetched candles of [start, end) and return the ones that might still be open"""
+        if df is None or df.empty:
+            return pd.DataFrame()
+
+        timestamps = pd.to_datetime(df[self.unified_timestamp_name])
+        if timestamps.dt.tz is not None:
+            timestamps = timestamps.dt.tz_convert(None)
+
+        covered_start = pd.Timestamp(start)
+        if df.attrs.get(PARTIAL_FETCH):
+            # the pages before the earliest candle weren't fetched, they aren't known to be empty
+            covered_start = max(covered_start, timestamps.min())
+
+        covered_end = min(pd.Timestamp(end), timestamps.max())
+        self.candle_cache.write(
+            key,
+            df[(timestamps >= covered_start) & (timestamps < covered_end)],
+            covered_start,
+            covered_end,
+        )
+
+        # the latest candle(s) aren't cached but still returned
+        return df[timestamps >= covered_end]
+
+    def _merge_with_cache(
+        self,
+        key: tuple,
+        market: str,
+        frames: List[pd.DataFrame],
+        from_time_dt: datetime,
+        to_time_dt: datetime,
+    ) -> pd.DataFrame:
+        frames.insert(0, self.candle_cache.read(key, from_time_dt, to_time_dt))
+        frames = [frame for frame in frames if not frame.empty]
+
+        logger.info(f"{market} candle cache: {self.candle_cache.metrics}")
+
+        if len(frames) == 0:
+            return pd.DataFrame()
+
+        df = pd.concat(frames, ignore_index=True)
+        df = df.drop_duplicates(self.unified_timestamp_name, keep="last")
+
+        return df.sort_values(self.unified_timestamp_name).reset_index(drop=True)
 
     def load_from_dataframe(self, df: pd.DataFrame, unique_col: str):
 
-        df = self.validate_df(df, unique_col=unique_col)
+        # validation and BigQuery expect datetimes, compact frames are expanded back
+        with self.instrumentation.span("validate"):
+            df = from_compact(df, [self.unified_timestamp_name])
+            df = self.validate_df(df, unique_col=unique_col)
+
+        with self.sink_lock, self.instrumentation.span("upload"):
+            self.sink.write(self.TABLE_ID, df)
+            self.pending_watermarks.append(
+                summarise(df, self.unified_timestamp_name, self.unified_market_name)
+            )
+
+        self.instrumentation.count("rows_uploaded", len(df))
+        self.instrumentation.count("bytes_uploaded", arrow_nbytes(df))
+
+    def upload_coalescer(self, unique_col: str) -> UploadCoalescer:
+        with self.sink_lock:
+            if unique_col not in self.coalescers:
+                self.coalescers[unique_col] = UploadCoalescer(
+                    flush=lambda frames: self._upload_batch(frames, unique_col),
+                    target_bytes=self.upload_batch_bytes,
+                    max_age_s=self.upload_batch_age_s,
+                    max_inflight_bytes=self.upload_max_inflight_bytes,
+                )
+            return self.coalescers[unique_col]
+
+    def queue_upload(self, df: pd.DataFrame, unique_col: str):
+        """upload `df` within a larger batch, in the background, see `UploadCoalescer`
+
+        Only blocks while too much data is waiting to be uploaded. Batches are flushed by `commit_uploads` at the latest.
+        """
+        self.upload_coalescer(unique_col).add(df)
+
+    def _upload_batch(self, frames: List[pd.DataFrame], unique_col: str):
+        self.instrumentation.count("upload_batches")
+        self.load_from_dataframe(concat_compact(frames), unique_col=unique_col)
+
+    def commit_uploads(self):
+        """Commit everything uploaded during this run, to be called once at the end of `fetch_data`"""
+        # not within the sink lock, the coalescers' threads need it to flush
+        for coalescer in list(self.coalescers.values()):
+            with self.instrumentation.span("drain"):
+                coalescer.close()
 
-        table = self.BQ_client.get_table(self.TABLE_ID)
+        with self.sink_lock, self.instrumentation.span("commit"):
+            self.sink.commit()
+
+            if self.watermarks is not None and len(self.pending_watermarks) > 0:
+                self.watermarks.update(
+                    self.TABLE_ID, pd.concat(self.pending_watermarks)
+                )
+            self.pending_watermarks = []
+        logger.info(f"{self.TABLE_ID} upload metrics: {self.sink.metrics}")
+
+    def report_instrumentation(self) -> str:
+        """log and export the spans and counters of the run, to be called once at the end of `fetch_data`
+
+        :return: a one line summary, returned by the scheduled jobs for the Discord embed
+        """
+        retry_policy = getattr(self, "retry_policy", None)
+        if retry_policy is not None:
+            # every attempt is an HTTP call
+            self.instrumentation.set_count("http_calls", retry_policy.metrics.calls)
+            self.instrumentation.set_count("retries", retry_policy.metrics.retries)
+
+        logger.info(f"{self.TABLE_ID} instrumentation: {self.instrumentation}")
 
         try:
-            resp = self.BQ_client.load_table_from_dataframe(df, table)
-        except Conflict as conf:
-            logger.info(f"{conf}")
-        except Exception as e:
-            raise e
-        else:
-            logger.info(
-                f"Updated table: {table.project}.{table.dataset_id}.{table.table_id}"
-            )
-            if resp.error_result is not None:
-                logger.error(f"Found errors uploading job: {resp.error_result}")
+            self.instrumentation.export()
+        except OSError as e:
+            logger.warning(f"Couldn't export the metrics of {self.TABLE_ID}: {e}")
+
+        return self.instrumentation.summary()
@@ -1,12 +1,20 @@
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from typing import Callable
 import logging
 from drivers.base import DataDriver
 import ccxt
-from ccxt.base.errors import BadSymbol
-from time import sleep
 import pandas as pd
+from utils.rate_limit_util import (
+    EXCHANGE_RATE_LIMITS,
+    USED_WEIGHT_HEADERS,
+    get_rate_limiter,
+    request_weight,
+)
+from utils.retry_util import RetryPolicy
+from utils.compact_util import concat_compact
+from utils.symbol_index_util import SymbolIndex, get_symbol_index
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +29,7 @@ class CCXTBase(DataDriver, ABC):
         instrument_type,
         timeframe,
         upload_data,
+        max_workers: int = None,
     ):
 
         # https://www.coinapi.io/integration
@@ -49,10 +58,18 @@ class CCXTBase(DataDriver, ABC):
             self.ccxt_default_type in self.supported_default_types
         ), f"instrument_type:{instrument_type} must be one of {self.supported_default_types}"
 
+        # number of markets fetched at the same time
+        self.max_workers = (
+            max_workers
+            if max_workers is not None
+            else self.default_max_workers.get(self.exchange_id, 1)
+        )
+
         # https://github.com/ccxt/ccxt/blob/00fb5389da706c0acc3bb0892ffa211ac535bd3b/python/ccxt/binance.py#L857
         self.exchange = getattr(ccxt, self.exchange_id)(
             {
-                "enableRateLimit": True,  # required by the Manual
+                # ccxt's throttling is per thread, when fetching concurrently the shared rate limiter takes over
+                "enableRateLimit": self.max_workers == 1,
                 "options": {
                     "defaultType": self.ccxt_default_type,
                 },
@@ -65,7 +82,25 @@ class CCXTBase(DataDriver, ABC):
 
         self.exchange.load_markets()
 
-        self.max_retries = 3
+        # shared by every driver (and thread) using this exchange
+        self.rate_limiter = get_rate_limiter(
+            exchange_id=self.exchange_id,
+            default_type=self.ccxt_default_type,
+            requests_per_second=1000 / self.exchange.rateLimit,
+        )
+
+        self.max_retries = 5
+
+        # backoff with jitter on errors, and a pause when the exchange reports most of its weight is used
+        weight_limit, weight_window_s = EXCHANGE_RATE_LIMITS.get(
+            (self.exchange_id, self.ccxt_default_type), (None, 60)
+        )
+        self.retry_policy = RetryPolicy(
+            max_attempts=self.max_retries,
+            used_weight_header=USED_WEIGHT_HEADERS.get(self.exchange_id),
+            weight_limit=weight_limit,
+            weight_window_s=weight_window_s,
+        )
 
         table_name = f"{table_name}_{self.instrument_type}_{timeframe}"
         self.timeframe = timeframe
@@ -95,10 +130,17 @@ class CCXTBase(DataDriver, ABC):
 
         self.market_names = self.markets["symbol_id_exchange"]
 
+        self._symbol_index = None
+
     @property
     def supported_default_types(self):
         return ["spot", "margin", "delivery", "future"]
 
+    @property
+    def default_max_workers(self) -> dict:
+        """number of markets fetched concurrently per exchange, the rate limiter keeps us within the weight limits"""
+        return {"binance": 8, "okx": 4}
+
     @property
     @abstractmethod
     def limit(self):
@@ -108,11 +150,49 @@ class CCXTBase(DataDriver, ABC):
     def possible_resolutions(self):
         return self.exchange.timeframes
 
+    @property
+    def symbol_index(self) -> SymbolIndex:
+        """the names of the markets, rebuilt only when the CoinAPI catalog or the exchange's markets change"""
+        if self._symbol_index is None:
+            # we get the asset list from CoinAPI since Binance doesn't provide us with name of assets that are delisted
+            coinapi_assets = self.CoinApi.get_all_assets_for_exchange(
+                coinapi_exchange_id=self.coinapi_exchange_id,
+                coinapi_symbol_type=self.coinapi_symbol_type,
+            )
+            self._symbol_index = get_symbol_index(
+                coinapi_assets=coinapi_assets,
+                markets=self.exchange.markets,
+                exchange_id=self.exchange_id,
+                instrument_type=self.instrument_type,
+            )
+        return self._symbol_index
+
+    def get_symbols(self) -> dict:
+        """the exchange's symbol of each market, keyed by its homogenised name, e.g. BTC-USDT-SWAP"""
+        symbols = self.symbol_index.exchange_ids()
+
+        # useful for DEBUG
+        # symbols = {"ETH_USD_SWAP": "ETH-USD"}
+
+        return symbols
+
+    def ticker_of(self, symbol: str) -> str:
+        """the ticker the rows of an exchange symbol are stored under"""
+        return symbol
+
+    def market_of(self, ticker: str) -> str:
+        """the exchange symbol of a stored ticker, the inverse of `ticker_of`"""
+        return ticker
+
     def get_data_foreach_market(
         self,
         fetch_data_function: Callable,
         upload: bool = False,
         upload_one_at_a_time: bool = False,
+        unique_col: str = None,
+        repair_gaps: bool = False,
+        gap_lookback: timedelta = None,
+        bulk_fetch_function: Callable = None,
     ):
         """This function loops through each market, if it's already in the database then we fetch from that date
         And if it's not we fetch since the beginging of time
@@ -123,55 +203,41 @@ class CCXTBase(DataDriver, ABC):
 
         :param fetch_data_function: the function that the fetches the timeseries in question
         :param upload: whether to upload the data or not (False useful for debugging/development)
-        :param upload_one_at_a_time: whether to upload for each asset or all in one go (bad idea if there's a lot data
+        :param upload_one_at_a_time: whether to upload each asset once fetched (in batches across markets, see
+            `queue_upload`) or all in one go (bad idea if there's a lot data)
+        :param unique_col: column passed to `validate_df` when uploading the returned DataFrames
+        :param repair_gaps: also fetch the holes inside the stored series, see `get_gap_plan`. With the `load` sink the
+            repaired rows are appended next to the NULL ones, which then no longer count as holes
+        :param gap_lookback: only look for holes within this period, the whole table is scanned if None
+        :param bulk_fetch_function: called with the (market, from, to) tasks before they are fetched one by one, it
+            returns a DataFrame of the markets it could fetch at once and the tasks left
+
+        Markets are fetched concurrently by `self.max_workers` threads sharing the exchange's rate limiter. A market
+        that fails doesn't stop the others, what was fetched is still committed and the failed markets raised after.
         """
 
         to_time_since_dt = datetime.now()
 
-        tracked_assets = self.get_latest_date()
-
         # anything older than 14 days we consider as delisted
         delisted_threshold = to_time_since_dt - timedelta(days=14)
 
-        # we get the asset list from CoinAPI since Binance doesn't provide us with name of assets that are delisted
-        coinapi_assets = self.CoinApi.get_all_assets_for_exchange(
-            coinapi_exchange_id=self.coinapi_exchange_id,
-            coinapi_symbol_type=self.coinapi_symbol_type,
-        )
-
-        # since it's hashable, we don't get any duplicates
-        symbols = dict()
-
-        for index, row in coinapi_assets.iterrows():
-
-            symbol = row["symbol_id_exchange"]
-
-            if self.exchange_id == "okx":
-                if self.instrument_type == "future":
-                    symbol = f"{row['asset_id_base_exchange']}-{row['asset_id_quote_exchange']}-SWAP"  # OKX: "BTC-USDT-SWAP"
-                elif self.instrument_type == "index":
-                    symbol = f"{row['asset_id_base_exchange']}-{row['asset_id_quote_exchange']}"  # OKX: "BTC-USDT"
-
-            if self.instrument_type == "future":
-                homogenised_symbol = f"{row['asset_id_base_exchange']}-{row['asset_id_quote_exchange']}-SWAP"  # OKX: "BTC-USDT-SWAP"
-            elif self.instrument_type == "index":
-                homogenised_symbol = f"{row['asset_id_base_exchange']}-{row['asset_id_quote_exchange']}"  # OKX: "BTC-USDT"
-            else:
-                homogenised_symbol = (
-                    f"{row['asset_id_base_exchange']}-{row['asset_id_quote_exchange']}"
-                )
+        symbols = self.get_symbols()
 
-            symbols[homogenised_symbol] = symbol
+        # only the recent partitions are read for the symbols still trading
+        tracked_assets = self.get_latest_date(
+            tickers=[self.ticker_of(symbol) for symbol in symbols.values()]
+        )
+        latest_dates = dict(
+            zip(tracked_assets[self.unified_market_name], tracked_assets["maxStartTime"])
+        )
 
-        # useful for DEBUG
-        # symbols = {"ETH_USD_SWAP": "ETH-USD"}
+        tasks = []
 
         for homogenised_symbol, symbol in symbols.items():
 
-            if symbol in tracked_assets["ticker"].to_list():
-                since_dt = tracked_assets[tracked_assets["ticker"] == symbol][
-                    "maxStartTime"
-                ].iloc[0]
+            since_dt = latest_dates.get(self.ticker_of(symbol))
+
+            if since_dt is not None:
                 logger.info(
                     f"{symbol} found in DB, starting from latest date: {since_dt}"
                 )
@@ -190,35 +256,100 @@ class CCXTBase(DataDriver, ABC):
 
             since_dt_plus_one = since_dt + self.timeframe_timedelta
 
-            is_success = fetch_data_function(
-                market=symbol,
-                from_time_dt=since_dt_plus_one,
-                to_time_dt=to_time_since_dt,
-            )
+            tasks.append((symbol, since_dt_plus_one, to_time_since_dt))
 
-            if is_success is False:
+        upload = upload or self.upload_data
+        master = []
+
+        def handle_result(symbol: str, result):
+            if result is False or (isinstance(result, pd.DataFrame) and result.empty):
                 logger.warning(f"no data found for {symbol}, skipping...")
-            else:
-                logger.info(f"Sucessfully loaded {symbol}.")
+                return
 
-    def _retry_fetch_function(self, callable_function: Callable, *args, **kwargs):
-        num_retries = 0
+            logger.info(f"Sucessfully loaded {symbol}.")
 
-        while True:
-            try:
-                num_retries += 1
-                if callable_function.__name__ == "fetch_ohlcv":
-                    data = callable_function(**kwargs)
+            # some fetch functions upload as they go and only return a boolean
+            if isinstance(result, pd.DataFrame) and upload:
+                if upload_one_at_a_time:
+                    # batched with the other markets and uploaded in the background
+                    self.queue_upload(result, unique_col=unique_col)
+                elif self.compact:
+                    master.append(self.to_compact(result))
                 else:
-                    data = callable_function(params=kwargs)
-
-                return data
-            except BadSymbol as e:
-                raise e
-            except Exception as e:
-                if num_retries >= self.max_retries:
-                    raise Exception(
-                        f"FAILED ({e}): Couldn't call {callable_function} function {num_retries}/{self.max_retries}"
+                    master.append(result)
+
+        # the markets up to date enough to be fetched together, the gaps are always fetched one market at a time
+        if bulk_fetch_function is not None and len(tasks) > 0:
+            bulk_result, tasks = bulk_fetch_function(tasks)
+            handle_result("bulk", bulk_result)
+
+        if repair_gaps:
+            since = to_time_since_dt - gap_lookback if gap_lookback else None
+            # the fetch functions include `to_time_dt`, the end of a gap is the next stored candle
+            for fetch_range in self.get_gap_plan(unique_col, since=since):
+                tasks.append(
+                    (
+                        self.market_of(fetch_range.ticker),
+                        fetch_range.start,
+                        fetch_range.end - self.timeframe_timedelta,
                     )
-                logger.warning(f"FAILED {num_retries}/{self.max_retries}: {e}")
-                sleep(1)
+                )
+
+        failed = []
+
+        # results are handled as soon as each market completes, so uploads overlap with the remaining fetches
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(
+                    fetch_data_function,
+                    market=symbol,
+                    from_time_dt=since_dt,
+                    to_time_dt=to_time_dt,
+                ): symbol
+                for symbol, since_dt, to_time_dt in tasks
+            }
+
+            for future in as_completed(futures):
+                symbol = futures[future]
+
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f"Couldn't fetch {symbol}: {e}")
+                    failed.append(symbol)
+                    continue
+
+                handle_result(symbol, result)
+
+        if len(master) > 0:
+            self.load_from_dataframe(concat_compact(master), unique_col=unique_col)
+
+        self.commit_uploads()
+
+        logger.info(f"{self.TABLE_ID} retry metrics: {self.retry_policy.metrics}")
+
+        self.report_instrumentation()
+
+        if len(failed) > 0:
+            raise RuntimeError(
+                f"Couldn't fetch {len(failed)}/{len(tasks)} markets of {self.TABLE_ID}: {', '.join(sorted(failed))}"
+            )
+
+    def _retry_fetch_function(self, callable_function: Callable, *args, **kwargs):
+        """call a ccxt function within the rate limit, retrying according to `self.retry_policy`"""
+
+        def fetch():
+            self.rate_limiter.acquire(
+                request_weight(
+                    self.exchange_id, self.ccxt_default_type, kwargs.get("limit")
+                )
+            )
+            if callable_function.__name__ == "fetch_ohlcv":
+                return callable_function(**kwargs)
+            else:
+                return callable_function(params=kwargs)
+
+        with self.instrumentation.span("fetch_page"):
+            return self.retry_policy.call(
+                fetch, headers=lambda: self.exchange.last_response_headers
+            )
@@ -1,15 +1,62 @@
 from datetime import datetime, timedelta
 import logging
+import os
+from typing import Callable, List, Tuple
+import numpy as np
 import pandas as pd
 from drivers.ccxt_driver.ccxt_base import CCXTBase
+from utils.candle_buffer_util import CandleBuffer
+from utils.compact_util import constant_category
 from google.cloud import bigquery
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def page_funding_forward(
+    fetch_page: Callable[[int], List[dict]], since_ms: int, limit: int
+) -> Tuple[List[dict], int]:
+    """fetch the funding rates of every market from `since_ms` oldest first, with an all-markets endpoint
+
+    Markets settle at the same time, so a page may end in the middle of a settlement: the next page starts at the
+    last timestamp rather than after it and the rates fetched twice are dropped.
+
+    :param fetch_page: called with the start in ms, returns ccxt funding rate structures, oldest first
+    :param since_ms: the earliest settlement to fetch
+    :param limit: the most rates the exchange returns per request
+    :return: the rates and the number of requests
+    """
+    rates = {}
+    requests = 0
+
+    while True:
+        page = fetch_page(since_ms)
+        requests += 1
+
+        for rate in page:
+            rates[(rate.get("symbol"), rate.get("timestamp"))] = rate
+
+        if len(page) < limit:
+            break
+
+        last_ms = max(rate.get("timestamp") for rate in page)
+        if last_ms <= since_ms:
+            logger.warning(f"more than {limit} rates settled at {last_ms}, the rest are skipped")
+            break
+        since_ms = last_ms
+
+    return list(rates.values()), requests
+
+
 class CCXTDriverFunding(CCXTBase):
-    def __init__(self, ccxt_exchange_id, coinapi_exchange_id, coinapi_symbol_type):
+    def __init__(
+        self,
+        ccxt_exchange_id,
+        coinapi_exchange_id,
+        coinapi_symbol_type,
+        upload_data: bool = False,
+        max_workers: int = None,
+    ):
 
         table_name = "funding"
         default_type = "future"
@@ -22,7 +69,8 @@ class CCXTDriverFunding(CCXTBase):
             coinapi_symbol_type=coinapi_symbol_type,
             timeframe=timeframe,
             instrument_type=default_type,
-            full_history=True,
+            upload_data=upload_data,
+            max_workers=max_workers,
         )
 
     def get_all_funding(
@@ -35,7 +83,9 @@ class CCXTDriverFunding(CCXTBase):
         earliest_datetime = datetime.now() if to_time_dt is None else to_time_dt
         fetch_since = earliest_datetime - timedelta_window
 
-        all_funding = []
+        # older pages are prepended in place, without copying what was already fetched
+        buffer = CandleBuffer(["fundingRate"])
+        symbol = market
 
         while True:
 
@@ -79,7 +129,13 @@ class CCXTDriverFunding(CCXTBase):
             earliest_datetime = datetime.utcfromtimestamp(earliest_timestamp / 1000)
             latest_datetime = datetime.utcfromtimestamp(latest_timestamp / 1000)
 
-            all_funding = funding + all_funding
+            symbol = funding[0].get("symbol", symbol)
+            buffer.prepend(
+                timestamps=[rate.get("timestamp") for rate in funding],
+                fundingRate=np.array(
+                    [rate.get("fundingRate") for rate in funding], dtype=np.float64
+                ),
+            )
 
             if earliest_datetime > (fetch_since + self.timeframe_timedelta):
                 logger.info(f"earliest_datetime > fetch_since, quitting")
@@ -93,7 +149,7 @@ class CCXTDriverFunding(CCXTBase):
                 fetch_since = earliest_datetime
 
             logger.info(
-                f"{market} {earliest_datetime} -> {latest_datetime} {len(funding)}/{len(all_funding)}"
+                f"{market} {earliest_datetime} -> {latest_datetime} {len(funding)}/{len(buffer)}"
             )
             # if we have reached the checkpoint
             if len(funding) < self.limit:
@@ -108,36 +164,122 @@ class CCXTDriverFunding(CCXTBase):
                 )
                 break
 
-        if len(all_funding) == 0:
+        if len(buffer) == 0:
             return pd.DataFrame()
 
-        df = pd.DataFrame(all_funding, columns=["timestamp", "symbol", "fundingRate"])
-        df["timestamp"] = pd.to_datetime(df["timestamp"], unit="ms")
-        df["timestamp"] = df["timestamp"].dt.floor("S")
-        df.rename(
-            columns={
-                "timestamp": self.unified_timestamp_name,
-                "symbol": self.unified_market_name,
-            },
-            inplace=True,
-        )
+        with self.instrumentation.span("parse"):
+            df = buffer.to_frame(timestamp_col=self.unified_timestamp_name)
+            df[self.unified_timestamp_name] = df[self.unified_timestamp_name].dt.floor("s")
+            df.insert(1, self.unified_market_name, constant_category(symbol, len(df)))
+
+            if from_time_dt is not None:
+                df = df[df[self.unified_timestamp_name] >= from_time_dt]
 
-        if from_time_dt is not None:
-            df = df[df[self.unified_timestamp_name] >= from_time_dt]
+            # remove duplicated
+            df = df[~df.duplicated(["startTime"])]
 
-        # remove duplicated
-        df = df[~df.duplicated(["startTime"])]
+        self.instrumentation.count("rows_fetched", len(df))
 
         return df.reset_index(drop=True)
 
-    def fetch_data(self, upload: bool = False, upload_one_at_a_time: bool = False):
+    def ticker_of(self, symbol: str) -> str:
+        """rates are stored under ccxt's unified symbol (e.g. BTC/USDT:USDT), as parsed from the responses"""
+        return self.symbol_index.ccxt_symbol(symbol)
+
+    def market_of(self, ticker: str) -> str:
+        """the exchange id of a stored ccxt symbol, tickers the index doesn't know are returned as is"""
+        return self.symbol_index.exchange_id_of_ccxt_symbol(ticker) or ticker
+
+    def get_bulk_funding(self, tasks: List[tuple]) -> Tuple[pd.DataFrame, List[tuple]]:
+        """the new rates of the markets less than `BULK_FUNDING_MAX_DAYS` (7) behind, from the all-markets endpoint
+        (Binance `GET /fapi/v1/fundingRate` without a symbol), a few requests instead of one per market
+
+        :param tasks: the (market, from, to) of `get_data_foreach_market`
+        :return: the rates of those markets, and the tasks left to page one market at a time (new listings, markets
+            far behind)
+        """
+        max_lag = timedelta(days=float(os.getenv("BULK_FUNDING_MAX_DAYS", 7)))
+        now = datetime.utcnow()
+
+        tail = {
+            self.ticker_of(market): pd.Timestamp(from_time_dt)
+            for market, from_time_dt, _ in tasks
+            if now - from_time_dt <= max_lag
+        }
+        remaining = [task for task in tasks if self.ticker_of(task[0]) not in tail]
+
+        if len(tail) == 0:
+            return pd.DataFrame(), remaining
+
+        rates, requests = page_funding_forward(
+            fetch_page=lambda since_ms: self._retry_fetch_function(
+                callable_function=self.exchange.fetchFundingRateHistory,
+                startTime=str(since_ms),
+                limit=self.limit,
+            ),
+            since_ms=int(min(tail.values()).timestamp() * 1000),
+            limit=self.limit,
+        )
+
+        with self.instrumentation.span("parse"):
+            df = pd.DataFrame(
+                {
+                    self.unified_timestamp_name: pd.to_datetime(
+                        [rate.get("timestamp") for rate in rates], unit="ms"
+                    ).floor("s"),
+                    self.unified_market_name: [rate.get("symbol") for rate in rates],
+                    "fundingRate": np.array(
+                        [rate.get("fundingRate") for rate in rates], dtype=np.float64
+                    ),
+                }
+            )
+
+            # the endpoint also returns the markets paged one by one, or not tracked
+            since = df[self.unified_market_name].map(tail)
+            df = df[since.notna() & (df[self.unified_timestamp_name] >= since)]
+            df = df.drop_duplicates([self.unified_market_name, self.unified_timestamp_name])
+            df = df.sort_values([self.unified_market_name, self.unified_timestamp_name])
+            df[self.unified_market_name] = df[self.unified_market_name].astype("category")
+
+        self.instrumentation.count("rows_fetched", len(df))
+
+        logger.info(
+            f"{len(tail)} markets updated in {requests} requests ({len(df)} rates), "
+            f"{len(remaining)} left to fetch one by one"
+        )
+
+        return df.reset_index(drop=True), remaining
+
+    def fetch_data(
+        self,
+        upload: bool = False,
+        upload_one_at_a_time: bool = False,
+        repair_gaps: bool = False,
+        gap_lookback: timedelta = None,
+        bulk: bool = True,
+    ):
+        """fetch the new rates of every market
+
+        :param bulk: on Binance, fetch the markets that are up to date together, see `get_bulk_funding`. OKX has no
+            all-markets history endpoint, its markets are always fetched one by one
+        """
 
         self.get_data_foreach_market(
             fetch_data_function=self.get_all_funding,
             upload=upload,
             upload_one_at_a_time=upload_one_at_a_time,
+            unique_col="fundingRate",
+            repair_gaps=repair_gaps,
+            gap_lookback=gap_lookback,
+            bulk_fetch_function=(
+                self.get_bulk_funding if bulk and self.exchange_id == "binance" else None
+            ),
         )
 
+    @property
+    def period_to_pandas(self) -> dict:
+        return {"8h": "8h"}
+
     @property
     def schema(self):
         schema = [
@@ -153,14 +295,6 @@ class CCXTDriverFunding(CCXTBase):
         ]
         return schema
 
-    def time_partitioning(self, table: bigquery.Table):
-        table.time_partitioning = bigquery.TimePartitioning(
-            type_=bigquery.TimePartitioningType.HOUR,
-            field=self.unified_timestamp_name,  # name of column to use for partitioning
-        )
-
-        return table
-
     @property
     def limit(self):
         if self.exchange_id == "binance":
@@ -1,14 +1,64 @@
 from google.cloud import bigquery
 from datetime import datetime, timedelta
-import sys
 import logging
+import os
+import threading
+from typing import Callable, Iterable, List
+from drivers.base import PARTIAL_FETCH
 from drivers.ccxt_driver.ccxt_base import CCXTBase
 import pandas as pd
-from utils.bigquery_util import get_time_partitionning_type
+from utils.candle_buffer_util import CandleBuffer
+from utils.compact_util import constant_category
+from utils.resample_util import compare_ohlcv, resample_ohlcv, timeframe_step
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# ranges up to this many pages are fetched forward from the watermark instead of backwards from now
+TAIL_MAX_PAGES = 10
+
+OHLCV_FIELDS = ["open", "high", "low", "close", "volume"]
+
+
+def to_ms(dt) -> int:
+    """milliseconds since epoch, naive datetimes are considered UTC"""
+    return int(pd.Timestamp(dt).value // 1_000_000)
+
+
+def page_forward(
+        fetch_page: Callable[[int, int], list],
+        since_ms: int,
+        to_ms: int,
+        timeframe_ms: int,
+        max_limit: int,
+) -> List[list]:
+    """fetch the candles opening in [since_ms, to_ms] oldest first, asking for no more candles than needed
+
+    :param fetch_page: called with (since in ms, limit), returns a list of ccxt ohlcv rows
+    :param since_ms: open time of the first candle
+    :param to_ms: open time of the last candle
+    :param timeframe_ms: the candle size in ms
+    :param max_limit: the most candles the exchange returns per request
+    :return: the pages in chronological order
+    """
+    pages = []
+
+    while since_ms <= to_ms:
+        limit = min(max_limit, (to_ms - since_ms) // timeframe_ms + 1)
+        ohlcv = fetch_page(since_ms, limit)
+
+        if len(ohlcv) == 0:
+            break
+
+        pages.append(ohlcv)
+
+        if len(ohlcv) < limit:
+            break
+
+        since_ms = ohlcv[-1][0] + 1
+
+    return pages
+
 
 class CCXTDriverOHLCV(CCXTBase):
     def __init__(
@@ -19,7 +69,13 @@ class CCXTDriverOHLCV(CCXTBase):
             timeframe,
             instrument_type,
             upload_data: bool = False,
+            max_workers: int = None,
+            derived_timeframes: List[str] = None,
     ):
+        """
+        :param derived_timeframes: coarser timeframes derived from the fetched candles instead of being fetched, e.g.
+            ["8h", "1d"] for 1h candles, each is written to its own table
+        """
 
         table_name = "OHLCV"
 
@@ -33,25 +89,83 @@ class CCXTDriverOHLCV(CCXTBase):
             instrument_type=instrument_type,
             timeframe=timeframe,
             upload_data=upload_data,
+            max_workers=max_workers,
         )
 
+        # the drivers of the derived tables, they never fetch
+        self.derived = {}
+        for derived_timeframe in derived_timeframes or []:
+            if self.exchange_id != "binance":
+                raise NotImplementedError(f"derived timeframes not implemented for {self.exchange_id}")
+            if timeframe_step(derived_timeframe) % timeframe_step(timeframe) != pd.Timedelta(0):
+                raise ValueError(f"{derived_timeframe} candles can't be derived from {timeframe} candles")
+
+            self.derived[derived_timeframe] = CCXTDriverOHLCV(
+                ccxt_exchange_id=ccxt_exchange_id,
+                coinapi_exchange_id=coinapi_exchange_id,
+                coinapi_symbol_type=coinapi_symbol_type,
+                timeframe=derived_timeframe,
+                instrument_type=instrument_type,
+                upload_data=upload_data,
+                max_workers=max_workers,
+            )
+
+        # number of markets whose derived candles are compared with the exchange's own each run
+        self.resample_validation_sample = int(os.getenv("RESAMPLE_VALIDATION_SAMPLE", 3))
+        self.resample_validated = 0
+        self.resample_validation_lock = threading.Lock()
+
     def get_all_ohlcv_binance(
             self, market: str, from_time_dt: datetime, to_time_dt
     ) -> pd.DataFrame:
         """this function goes back in time and fetches to fetch historical values
 
+        On Binance, when `from_time_dt` is recent (the usual daily update) the few missing candles are fetched
+        forward from it instead, see `page_forward`.
+
         :param market: the ticker/market name
         :param from_time_dt: the earliest point in time to fetch
         :param to_time_dt: the latest point in time to fetch
         :return: a pandas Dataframe
         """
-        to_time_dt = pd.to_datetime(to_time_dt).floor(self.timeframe)
+        to_time_dt = pd.to_datetime(to_time_dt).floor(self.timeframe_timedelta)
+
+        if (
+                self.exchange_id == "binance"
+                and to_time_dt - from_time_dt <= self.timedelta_window * TAIL_MAX_PAGES
+        ):
+            pages = page_forward(
+                fetch_page=lambda since, limit: self._retry_fetch_function(
+                    callable_function=self.exchange.fetch_ohlcv,
+                    symbol=market,
+                    timeframe=self.timeframe,
+                    since=since,
+                    limit=limit,
+                ),
+                since_ms=to_ms(from_time_dt),
+                to_ms=to_ms(to_time_dt),
+                timeframe_ms=int(self.timeframe_timedelta.total_seconds() * 1000),
+                max_limit=self.limit,
+            )
+            buffer = CandleBuffer(OHLCV_FIELDS)
+            for page in pages:
+                buffer.append_rows(page)
+
+            logger.info(
+                f"{market} tail {from_time_dt} -> {to_time_dt}: "
+                f"{len(buffer)} candles in {len(pages)} requests"
+            )
+            return self.ohlcv_to_dataframe(buffer, market, from_time_dt)
+
         fetch_since_temp = max(from_time_dt, to_time_dt - self.timedelta_window)
 
         if self.exchange_id == "okx":
             fetch_since_temp = to_time_dt
 
-        all_ohlcv = []
+        # older pages are prepended in place, without copying what was already fetched
+        buffer = CandleBuffer(OHLCV_FIELDS)
+        # whether a page failed before the start of the range (or of the history) was reached
+        partial = False
 
         while True:
 
@@ -72,7 +186,8 @@ class CCXTDriverOHLCV(CCXTBase):
                         limit=self.limit,
                     )
             except Exception as e:
-                logger.info(e)
+                logger.warning(f"{market}: stopped fetching before {fetch_since_temp}: {e}")
+                partial = True
                 break
 
             if len(ohlcv) == 0:
@@ -80,11 +195,11 @@ class CCXTDriverOHLCV(CCXTBase):
 
             earliest_datetime = datetime.utcfromtimestamp(ohlcv[0][0] / 1000)
             latest_datetime = datetime.utcfromtimestamp(ohlcv[-1][0] / 1000)
-            all_ohlcv = ohlcv + all_ohlcv
+            buffer.prepend_rows(ohlcv)
 
             logger.info(
                 f"{market} {earliest_datetime} ({earliest_datetime.timestamp()}) -> "
-                f"{latest_datetime} ({latest_datetime.timestamp()}) {len(ohlcv)}/{len(all_ohlcv)} : "
+                f"{latest_datetime} ({latest_datetime.timestamp()}) {len(ohlcv)}/{len(buffer)} : "
                 f"fetch_since_temp {fetch_since_temp} ({fetch_since_temp.timestamp()})"
             )
 
@@ -108,19 +223,37 @@ class CCXTDriverOHLCV(CCXTBase):
                     + (self.timeframe_timedelta * 5)
             )
 
-        df = pd.DataFrame(
-            all_ohlcv, columns=["timestamp", "open", "high", "low", "close", "volume"]
-        )
-        df["timestamp"] = pd.to_datetime(df["timestamp"], unit="ms")
-        df.rename(columns={"timestamp": self.unified_timestamp_name}, inplace=True)
-        df.drop_duplicates("startTime", inplace=True)
-        df.sort_values("startTime", inplace=True)
-        df["ticker"] = market
+        df = self.ohlcv_to_dataframe(buffer, market, from_time_dt)
+        df.attrs[PARTIAL_FETCH] = partial
+        return df
+
+    def ohlcv_to_dataframe(
+            self, buffer: CandleBuffer, market: str, from_time_dt: datetime
+    ) -> pd.DataFrame:
+        """the fetched candles as a DataFrame, the overlaps between pages are dropped"""
+        with self.instrumentation.span("parse"):
+            df = buffer.to_frame(timestamp_col=self.unified_timestamp_name)
+            df.drop_duplicates("startTime", inplace=True)
+            df.sort_values("startTime", inplace=True)
+            df["ticker"] = constant_category(market, len(df))
 
-        df = df[df["startTime"] >= from_time_dt]
+            df = df[df["startTime"] >= from_time_dt]
+
+        self.instrumentation.count("rows_fetched", len(df))
 
         return df
 
+    def get_all_ohlcv_binance_cached(
+            self, market: str, from_time_dt: datetime, to_time_dt
+    ) -> pd.DataFrame:
+        """same as `get_all_ohlcv_binance` but only the ranges missing from the candle cache are fetched"""
+        return self.fetch_with_cache(
+            market=market,
+            from_time_dt=from_time_dt,
+            to_time_dt=to_time_dt,
+            fetch_function=self.get_all_ohlcv_binance,
+        )
+
     def get_all_ohlcv_okx(
             self, market: str, from_time_dt: datetime, to_time_dt
     ) -> bool:
@@ -134,7 +267,7 @@ class CCXTDriverOHLCV(CCXTBase):
 
         fetch_since_temp = to_time_dt - self.timedelta_window
 
-        all_ohlcv = []
+        fetched = 0
 
         if self.instrument_type == "future":
             ccxt_function = self.exchange.public_get_market_history_candles
@@ -166,24 +299,19 @@ class CCXTDriverOHLCV(CCXTBase):
 
             earliest_datetime = datetime.utcfromtimestamp(int(ohlcv[-1][0]) / 1000)
             latest_datetime = datetime.utcfromtimestamp(int(ohlcv[0][0]) / 1000)
-            all_ohlcv = ohlcv + all_ohlcv
-
-            data_size_mb = sys.getsizeof(all_ohlcv) / 1e6
+            # OKX returns the newest candle first
+            buffer = CandleBuffer(OHLCV_FIELDS)
+            buffer.append_rows(ohlcv[::-1])
+            fetched += len(buffer)
 
             logger.info(
                 f"{market} {earliest_datetime} ({earliest_datetime.timestamp()}) -> "
-                f"{latest_datetime} ({latest_datetime.timestamp()}) {len(ohlcv)}/{len(all_ohlcv)} : "
-                f"fetch_since_temp {fetch_since_temp} ({fetch_since_temp.timestamp()}) "
-                f"({data_size_mb:,.4f}MB)"
+                f"{latest_datetime} ({latest_datetime.timestamp()}) {len(ohlcv)}/{fetched} : "
+                f"fetch_since_temp {fetch_since_temp} ({fetch_since_temp.timestamp()})"
             )
 
-            if data_size_mb > self.max_upload_size_mb:
-                try:
-                    self.process_and_upload_ohlcv(all_ohlcv, market, from_time_dt)
-                except Exception as e:
-                    logger.error(f"Couldn't upload {market}: {e}")
-                else:
-                    all_ohlcv = []
+            # each page is handed to the upload coalescer, which batches them by size across markets
+            self.process_and_upload_ohlcv(buffer, market, from_time_dt)
 
             if earliest_datetime < from_time_dt:
                 logger.info(
@@ -193,51 +321,142 @@ class CCXTDriverOHLCV(CCXTBase):
 
             fetch_since_temp = earliest_datetime
 
-        if len(all_ohlcv) == 0:
-            return False
-
-        self.process_and_upload_ohlcv(all_ohlcv, market, from_time_dt)
-
-        return True
+        return fetched > 0
 
     def process_and_upload_ohlcv(
-            self, all_ohlcv: dict, symbol: str, from_time_dt: datetime
+            self, buffer: CandleBuffer, symbol: str, from_time_dt: datetime
     ):
 
-        column_names = [
-            self.unified_timestamp_name,
-            "open",
-            "high",
-            "low",
-            "close",
-            "volume",
-        ]
+        with self.instrumentation.span("parse"):
+            df = buffer.to_frame(timestamp_col=self.unified_timestamp_name)
+
+            df.drop_duplicates(self.unified_timestamp_name, inplace=True)
+            df.sort_values(self.unified_timestamp_name, inplace=True)
+            df[self.unified_market_name] = constant_category(symbol, len(df))
+
+            df = df.astype(
+                {
+                    "open": float,
+                    "high": float,
+                    "low": float,
+                    "close": float,
+                    "volume": float,
+                }
+            )
 
-        df = pd.DataFrame(all_ohlcv)
-        df = df[list(range(len(column_names)))]
-        df.columns = column_names
-        df[self.unified_timestamp_name] = pd.to_datetime(
-            df[self.unified_timestamp_name], unit="ms"
-        )
+            df = df[df[self.unified_timestamp_name] >= from_time_dt]
 
-        df.drop_duplicates(self.unified_timestamp_name, inplace=True)
-        df.sort_values(self.unified_timestamp_name, inplace=True)
-        df[self.unified_market_name] = symbol
-
-        df = df.astype(
-            {
-                "open": float,
-                "high": float,
-                "low": float,
-                "close": float,
-                "volume": float,
+        self.instrumentation.count("rows_fetched", len(df))
+
+        if self.upload_data:
+            self.queue_upload(df, unique_col="close")
+
+    def next_open_times(self, tickers: Iterable[str]) -> dict:
+        """the open time of the first candle missing from the table, for the tickers it has"""
+        latest = self.get_latest_date(tickers=tickers)
+        return {
+            ticker: pd.Timestamp(max_start_time) + self.timeframe_timedelta
+            for ticker, max_start_time in zip(
+                latest[self.unified_market_name], latest["maxStartTime"]
+            )
+        }
+
+    def derive_while_fetching(self, fetch_function: Callable, upload: bool) -> Callable:
+        """wrap `fetch_function` so that the `self.derived` candles of each market are derived from what it fetched
+
+        The fetched range is extended back to the first candle missing from the derived tables, which is the start of
+        a bucket, so every derived candle is aggregated from all of its finer candles.
+        """
+        tickers = list(self.get_symbols().values())
+        next_open_times = {
+            timeframe: derived.next_open_times(tickers)
+            for timeframe, derived in self.derived.items()
+        }
+
+        def fetch_and_derive(market: str, from_time_dt: datetime, to_time_dt) -> pd.DataFrame:
+            derived_since = {
+                timeframe: open_times.get(market, pd.Timestamp(datetime(2010, 1, 1)))
+                for timeframe, open_times in next_open_times.items()
             }
+
+            df = fetch_function(
+                market=market,
+                from_time_dt=min([pd.Timestamp(from_time_dt), *derived_since.values()]),
+                to_time_dt=to_time_dt,
+            )
+
+            if not isinstance(df, pd.DataFrame) or df.empty:
+                return df
+
+            for timeframe, since in derived_since.items():
+                self.derive(market, df, timeframe, since, upload)
+
+            return df[df[self.unified_timestamp_name] >= from_time_dt]
+
+        return fetch_and_derive
+
+    def derive(
+            self, market: str, df: pd.DataFrame, timeframe: str, since: datetime, upload: bool
+    ) -> pd.DataFrame:
+        """derive the closed `timeframe` candles of `market` opening from `since`, and queue them for upload"""
+        with self.instrumentation.span("resample"):
+            candles = resample_ohlcv(
+                df[df[self.unified_timestamp_name] >= since],
+                timeframe=timeframe,
+                base_timeframe=self.timeframe,
+                timestamp_col=self.unified_timestamp_name,
+                market_col=self.unified_market_name,
+            )
+
+        self.instrumentation.count("rows_derived", len(candles))
+
+        if len(candles) == 0:
+            return candles
+
+        with self.resample_validation_lock:
+            validate = self.resample_validated < self.resample_validation_sample
+            self.resample_validated += int(validate)
+
+        if validate:
+            self.validate_derived(market, candles, timeframe)
+
+        if upload:
+            self.derived[timeframe].queue_upload(candles, unique_col="close")
+
+        return candles
+
+    def validate_derived(self, market: str, candles: pd.DataFrame, timeframe: str) -> pd.DataFrame:
+        """compare the latest derived candles of `market` with the exchange's own, in a single request
+
+        :return: the mismatching candles, see `compare_ohlcv`
+        """
+        recent = candles.tail(self.limit)
+
+        ohlcv = self._retry_fetch_function(
+            callable_function=self.exchange.fetch_ohlcv,
+            symbol=market,
+            timeframe=timeframe,
+            since=to_ms(recent[self.unified_timestamp_name].iloc[0]),
+            limit=len(recent),
         )
+        buffer = CandleBuffer(OHLCV_FIELDS)
+        buffer.append_rows(ohlcv)
 
-        df = df[df[self.unified_timestamp_name] >= from_time_dt]
+        mismatches = compare_ohlcv(
+            recent,
+            buffer.to_frame(timestamp_col=self.unified_timestamp_name),
+            timestamp_col=self.unified_timestamp_name,
+        )
 
-        if self.upload_data:
-            self.load_from_dataframe(df, unique_col="close")
+        self.instrumentation.count("resample_checked", len(recent))
+        if len(mismatches) > 0:
+            self.instrumentation.count("resample_mismatches", len(mismatches))
+            logger.warning(
+                f"{market}: {len(mismatches)}/{len(recent)} derived {timeframe} candles differ from the exchange's, "
+                f"e.g. {mismatches.iloc[0].to_dict()}"
+            )
+
+        return mismatches
 
     @property
     def period_to_pandas(self) -> dict:
@@ -245,17 +464,48 @@ class CCXTDriverOHLCV(CCXTBase):
         https://pandas.pydata.org/pandas-docs/stable/user_guide/timeseries.html#offset-aliases"""
         return {"8h": "8H", "1m": "1min", "1h": "1H"}
 
-    def fetch_data(self):
+    def fetch_data(
+            self,
+            upload: bool = False,
+            upload_one_at_a_time: bool = False,
+            repair_gaps: bool = False,
+            gap_lookback: timedelta = None,
+    ):
+        """fetch the new candles of every market
+
+        :param upload: upload the candles, OKX candles are always uploaded as they are fetched if `upload_data` is set
+        :param upload_one_at_a_time: upload each market as soon as it's fetched
+        :param repair_gaps: also re-fetch the holes inside the stored series
+        :param gap_lookback: only look for holes within this period
+
+        The `derived_timeframes` tables are updated from the candles fetched for this one.
+        """
 
         func = None
         if self.exchange_id == "binance":
-            func = self.get_all_ohlcv_binance
+            func = self.get_all_ohlcv_binance_cached
         elif self.exchange_id == "okx":
             func = self.get_all_ohlcv_okx
         else:
             raise NotImplementedError(f"{self.exchange_id} not implemented")
 
-        self.get_data_foreach_market(fetch_data_function=func)
+        if len(self.derived) > 0:
+            func = self.derive_while_fetching(func, upload=upload or self.upload_data)
+
+        try:
+            self.get_data_foreach_market(
+                fetch_data_function=func,
+                upload=upload,
+                upload_one_at_a_time=upload_one_at_a_time,
+                unique_col="close",
+                repair_gaps=repair_gaps,
+                gap_lookback=gap_lookback,
+            )
+        finally:
+            # the candles derived from the markets that were fetched, even if others failed
+            for derived in self.derived.values():
+                derived.commit_uploads()
+                derived.report_instrumentation()
 
     @property
     def schema(self):
@@ -274,17 +524,6 @@ class CCXTDriverOHLCV(CCXTBase):
         ]
         return schema
 
-    def time_partitioning(self, table: bigquery.Table):
-
-        time_partition_type = get_time_partitionning_type(self.timeframe_timedelta)
-
-        table.time_partitioning = bigquery.TimePartitioning(
-            type_=time_partition_type,
-            field=self.unified_timestamp_name,  # name of column to use for partitioning
-        )
-
-        return table
-
     @property
     def limit(self):
         if self.exchange_id == "binance":
@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, List, Tuple
+
+import aiohttp
+
+from utils.retry_util import RetryPolicy
+
+logger = logging.getLogger(__name__)
+
+DYDX_HOST = "https://api.dydx.exchange"
+
+# dYdX limits public GETs per IP over a 10s window, stay well below it since both dYdX jobs share the IP
+MAX_REQUESTS = 100
+RATE_LIMIT_PERIOD_S = 10
+
+# requests in flight, for all markets together
+MAX_CONNECTIONS = 16
+
+# the most rows dYdX returns per request, for both candles and historical funding
+MAX_SAMPLES = 100
+
+FetchPage = Callable[[datetime, datetime], Awaitable[List[dict]]]
+
+
+def parse_iso(value: str) -> datetime:
+    """dYdX ISO timestamp ("2023-01-01T00:00:00.000Z") to a naive UTC datetime"""
+    dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def to_iso(dt: datetime) -> str:
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+class AsyncRateLimiter:
+    """at most `max_requests` every `period_s` seconds (sliding window), waiters are served in order"""
+
+    def __init__(self, max_requests: int = MAX_REQUESTS, period_s: float = RATE_LIMIT_PERIOD_S):
+        self.max_requests = max_requests
+        self.period_s = period_s
+        self.sent = deque()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                while self.sent and now - self.sent[0] >= self.period_s:
+                    self.sent.popleft()
+
+                if len(self.sent) < self.max_requests:
+                    self.sent.append(now)
+                    return
+
+                await asyncio.sleep(self.period_s - (now - self.sent[0]))
+
+
+class AsyncDydxClient:
+    """Public dYdX v3 endpoints over a pooled aiohttp session, to be used as `async with AsyncDydxClient() as client`
+
+    Every request goes through the same rate limiter and is retried with `RetryPolicy`.
+
+    :param host: the API host
+    :param max_requests: requests allowed per `period_s`
+    :param period_s: the rate limit window
+    :param max_connections: requests in flight
+    :param retry_policy: defaults to `RetryPolicy()`
+    """
+
+    def __init__(
+        self,
+        host: str = DYDX_HOST,
+        max_requests: int = MAX_REQUESTS,
+        period_s: float = RATE_LIMIT_PERIOD_S,
+        max_connections: int = MAX_CONNECTIONS,
+        retry_policy: RetryPolicy = None,
+    ):
+        self.host = host.rstrip("/")
+        self.max_connections = max_connections
+        self.rate_limiter = AsyncRateLimiter(max_requests, period_s)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.session = None
+        self.requests = 0
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_connections),
+            timeout=aiohttp.ClientTimeout(total=30),
+            raise_for_status=True,
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+        self.session = None
+
+    async def _get_once(self, path: str, params: dict) -> dict:
+        await self.rate_limiter.acquire()
+        self.requests += 1
+        async with self.session.get(f"{self.host}{path}", params=params) as response:
+            return await response.json()
+
+    async def get(self, path: str, params: dict = None) -> dict:
+        return await self.retry_policy.call_async(self._get_once, path, params or {})
+
+    async def get_markets(self) -> dict:
+        return (await self.get("/v3/markets"))["markets"]
+
+    async def get_candles(
+        self,
+        market: str,
+        resolution: str,
+        from_iso: str,
+        to_iso: str,
+        limit: int = MAX_SAMPLES,
+    ) -> List[dict]:
+        """candles with startedAt in [from_iso, to_iso], newest first"""
+        data = await self.get(
+            f"/v3/candles/{market}",
+            {"resolution": resolution, "fromISO": from_iso, "toISO": to_iso, "limit": str(limit)},
+        )
+        return data["candles"]
+
+    async def get_historical_funding(self, market: str, effective_before_or_at: str) -> List[dict]:
+        """the latest funding payments effective before or at `effective_before_or_at`, newest first"""
+        data = await self.get(
+            f"/v3/historical-funding/{market}",
+            {"effectiveBeforeOrAt": effective_before_or_at},
+        )
+        return data["historicalFunding"]
+
+
+def time_slices(
+    from_time: datetime, to_time: datetime, step: timedelta, max_samples: int = MAX_SAMPLES
+) -> List[Tuple[datetime, datetime]]:
+    """split [from_time, to_time) in slices of `max_samples` steps, i.e. a single request each, newest first"""
+    width = step * max_samples
+    slices = []
+    end = to_time
+    while end > from_time:
+        start = max(end - width, from_time)
+        slices.append((start, end))
+        end = start
+    return slices
+
+
+async def fetch_slice(
+    fetch_page: FetchPage,
+    start: datetime,
+    end: datetime,
+    time_key: str,
+    max_samples: int = MAX_SAMPLES,
+) -> List[dict]:
+    """rows with `time_key` in [start, end), paging back in case the slice holds more than one page
+
+    :param fetch_page: returns the newest rows with `time_key` in [start, end], newest first
+    """
+    rows = []
+    page_end = end - timedelta(seconds=1)
+
+    while page_end >= start:
+        page = await fetch_page(start, page_end)
+        if not page:
+            break
+
+        times = [parse_iso(row[time_key]) for row in page]
+        rows.extend(row for row, t in zip(page, times) if start <= t < end)
+
+        oldest = min(times)
+        if len(page) < max_samples or oldest <= start:
+            break
+        page_end = oldest - timedelta(seconds=1)
+
+    return rows
+
+
+async def fetch_history(
+    fetch_page: FetchPage,
+    from_time: datetime,
+    to_time: datetime,
+    step: timedelta,
+    time_key: str,
+    concurrency: int = 8,
+    max_samples: int = MAX_SAMPLES,
+) -> List[dict]:
+    """Fetch [from_time, to_time) as independent time slices, `concurrency` slices at a time
+
+    Slices are fetched newest first. Once a whole batch of slices is empty a single request looks for the newest row
+    before it: slicing resumes from there after a hole (e.g. a trading halt), and we stop if there is none, i.e.
+    before the market was listed, so starting from a date far in the past only costs a few requests.
+
+    :return: the rows, oldest first, without duplicates
+    """
+    batches = []
+    end = to_time
+
+    while end > from_time:
+        slices = time_slices(from_time, end, step, max_samples)[:concurrency]
+        results = await asyncio.gather(
+            *(
+                fetch_slice(fetch_page, slice_start, slice_end, time_key, max_samples)
+                for slice_start, slice_end in slices
+            )
+        )
+        batches.extend(results)
+        end = slices[-1][0]
+
+        if any(results) or end <= from_time:
+            continue
+
+        older = await fetch_page(from_time, end - timedelta(seconds=1))
+        if not older:
+            break
+
+        newest = max(parse_iso(row[time_key]) for row in older)
+        logger.info(f"No rows in [{end}, {slices[0][1]}), resuming from {newest}")
+        end = min(newest + step, end)
+
+    rows = {}
+    # slices are newest first, oldest rows end up first
+    for slice_rows in reversed(batches):
+        for row in sorted(slice_rows, key=lambda row: row[time_key]):
+            rows.setdefault(row[time_key], row)
+
+    return list(rows.values())
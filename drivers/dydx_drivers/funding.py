@@ -1,16 +1,20 @@
+import asyncio
 from dydx3 import Client
 import pandas as pd
 from datetime import datetime, timedelta, timezone
 import logging
 from drivers.base import DataDriver
 from google.cloud import bigquery
+from utils.retry_util import RetryPolicy
+from drivers.dydx_drivers.async_client import AsyncDydxClient, fetch_history, to_iso
+from utils.compact_util import constant_category
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
 class DYDXFunding(DataDriver):
-    def __init__(self):
+    def __init__(self, market_concurrency: int = 4, slice_concurrency: int = 8):
 
         self.TABLE_NAME = f"funding"
         self.DATASET_ID = "dydx"
@@ -28,124 +32,164 @@ class DYDXFunding(DataDriver):
 
         self.max_samples = 100  # as far as I can see this is most you can get from API
 
-        super().__init__(dataset_id=self.DATASET_ID, table_name=self.TABLE_NAME)
+        # markets fetched at once, and slices of a market's history fetched at once
+        self.market_concurrency = market_concurrency
+        self.slice_concurrency = slice_concurrency
 
-    def get_funding_df(
-        self, market_str: str, from_time: datetime, to_time: datetime
-    ) -> pd.DataFrame:
-        """slide window back in time retrieving 100 hourly funding payments at a time"""
-
-        assert market_str in self.markets.columns, f"{market_str} not available on DYDX"
-
-        # funding on dydx is hourly
-        res_in_seconds = 3600
-        delta_window = timedelta(seconds=res_in_seconds)
+        self.retry_policy = RetryPolicy()
 
-        count = 0
-        master = pd.DataFrame()
+        super().__init__(
+            dataset_id=self.DATASET_ID,
+            table_name=self.TABLE_NAME,
+            timeframe=self.timeframe,
+        )
 
-        to_time = to_time.replace(tzinfo=None)
+    async def get_funding_df(
+        self,
+        client: AsyncDydxClient,
+        market_str: str,
+        from_time: datetime,
+        to_time: datetime,
+    ) -> pd.DataFrame:
+        """fetch [from_time, to_time) as concurrent slices of 100 hourly funding payments each"""
 
-        from_time_original = from_time
+        assert market_str in self.markets.columns, f"{market_str} not available on DYDX"
 
         logger.info(f"{'COLLECTING: ' + market_str:-^70}")
 
-        while True:
-
-            try:
-                funding = self.public_client.public.get_historical_funding(
-                    market=market_str,
-                    effective_before_or_at=from_time.isoformat(),
+        async def fetch_page(start: datetime, end: datetime):
+            with self.instrumentation.span("fetch_page"):
+                return await client.get_historical_funding(
+                    market=market_str, effective_before_or_at=to_iso(end)
                 )
-            except Exception as e:
-                logger.warning(e)
-
-            funding_data = funding.data["historicalFunding"]
-            funding_df = pd.DataFrame(funding_data)
 
-            if funding_df.empty:
-                logger.info(f"DONE: no more funding found...")
-                break
+        rows = await fetch_history(
+            fetch_page,
+            from_time.replace(tzinfo=None),
+            to_time.replace(tzinfo=None),
+            step=self.timeframe_timedelta,
+            time_key="effectiveAt",
+            concurrency=self.slice_concurrency,
+            max_samples=self.max_samples,
+        )
 
-            funding_df.index = (
-                pd.to_datetime(funding_df["effectiveAt"])
-                .round("1h")
-                .dt.tz_localize(None)
+        if len(rows) == 0:
+            logger.info(f"{market_str}: no funding found...")
+            return pd.DataFrame()
+
+        with self.instrumentation.span("parse"):
+            funding_df = pd.DataFrame(rows)
+
+            master = pd.DataFrame(
+                {
+                    self.unified_timestamp_name: pd.to_datetime(
+                        funding_df["effectiveAt"], utc=True
+                    )
+                    .dt.round("1h")
+                    .dt.tz_localize(None),
+                    "rate": funding_df["rate"].astype(float),
+                    "price": funding_df["price"].astype(float),
+                }
             )
 
-            master = pd.concat([funding_df, master])
-
-            to_time = funding_df.index[0].replace(tzinfo=None)
-            from_time = funding_df.index[-1].replace(tzinfo=None)
-
             logger.info(
-                f"{market_str}({count}) {from_time} -> {to_time} ({len(funding_df)})"
+                f"{market_str}: {master[self.unified_timestamp_name].iloc[0]} -> "
+                f"{master[self.unified_timestamp_name].iloc[-1]} ({len(master)})"
             )
 
-            if from_time_original and from_time <= from_time_original:
-                logger.debug(f"FINISHED")
-                break
-
-            from_time = from_time - delta_window
-            count += 1
-
-        if master.empty:
-            return master
-
-        if from_time_original is not None:
-            master = master[master.index >= from_time_original]
-
-        cols_float = ["rate", "price"]
-        cold_categorial = ["market"]
-
-        master[cols_float] = master[cols_float].astype(float)
-        master[cold_categorial] = master[cold_categorial].astype("category")
+            master.insert(
+                1, self.unified_market_name, constant_category(market_str, len(master))
+            )
+            master.sort_values(self.unified_timestamp_name, inplace=True, kind="mergesort")
 
-        master.rename(columns={"market": self.unified_market_name}, inplace=True)
-        master.drop(columns="effectiveAt", inplace=True)
-        master.sort_index(inplace=True)
-        master = master.rename_axis(self.unified_timestamp_name)
+        self.instrumentation.count("rows_fetched", len(master))
 
-        return master.reset_index()
+        return master.reset_index(drop=True)
 
     def fetch_data(self, upload: bool, upload_one_at_a_time: bool):
-        now = datetime.now()
-
-        tracked_assets = self.get_latest_date()
-
-        master = pd.DataFrame()
+        try:
+            asyncio.run(self.fetch_data_async(upload, upload_one_at_a_time))
+        finally:
+            self.report_instrumentation()
 
-        for market in self.markets:
-
-            if market in tracked_assets["ticker"].to_list():
-                from_time = tracked_assets[tracked_assets["ticker"] == market][
-                    "maxStartTime"
-                ].iloc[0]
-                logger.info(f"{market} found in DB, starting from {from_time}")
-            else:
-                from_time = datetime(2010, 1, 1)
-                logger.info(f"{market} not found in DB, starting from {from_time}")
+    async def fetch_data_async(self, upload: bool, upload_one_at_a_time: bool):
+        now = datetime.now()
 
-            df = self.get_funding_df(
-                market_str=market, from_time=from_time, to_time=now
+        tracked_assets = self.get_latest_date(tickers=self.markets.columns)
+
+        failed = []
+        master = []
+
+        try:
+            async with AsyncDydxClient(retry_policy=self.retry_policy) as client:
+                market_slots = asyncio.Semaphore(self.market_concurrency)
+
+                async def fetch_market(market: str) -> pd.DataFrame:
+                    async with market_slots:
+                        if market in tracked_assets["ticker"].to_list():
+                            from_time = tracked_assets[tracked_assets["ticker"] == market][
+                                "maxStartTime"
+                            ].iloc[0]
+                            logger.info(f"{market} found in DB, starting from {from_time}")
+                        else:
+                            from_time = datetime(2010, 1, 1)
+                            logger.info(
+                                f"{market} not found in DB, starting from {from_time}"
+                            )
+
+                        df = await self.get_funding_df(
+                            client, market_str=market, from_time=from_time, to_time=now
+                        )
+
+                        if df.empty:
+                            logger.warning(f"couldn't find {market}")
+
+                        return df
+
+                async def collect(market: str) -> pd.DataFrame:
+                    try:
+                        return await fetch_market(market)
+                    except Exception as e:
+                        # e.g. out of retries, or a delisted market, the other markets are still committed
+                        logger.error(f"Couldn't fetch {market}: {e}")
+                        failed.append(market)
+                        return pd.DataFrame()
+
+                for task in asyncio.as_completed([collect(market) for market in self.markets]):
+                    df = await task
+
+                    if df.empty:
+                        continue
+
+                    if upload and upload_one_at_a_time:
+                        # off the event loop, it blocks while too much data is waiting to be uploaded
+                        await asyncio.get_running_loop().run_in_executor(None, self.queue_upload, df, "rate")
+                    elif upload:
+                        master.append(df)
+
+                logger.info(f"{client.requests} requests, {self.retry_policy.metrics}")
+
+            if upload and not upload_one_at_a_time and len(master) > 0:
+                self.load_from_dataframe(pd.concat(master), "rate")
+        finally:
+            # what was queued is committed even if the run stops half way
+            if upload:
+                self.commit_uploads()
+
+        if len(failed) > 0:
+            raise RuntimeError(
+                f"Couldn't fetch {len(failed)}/{len(self.markets.columns)} markets of {self.TABLE_ID}: "
+                f"{', '.join(sorted(failed))}"
             )
 
-            if df.empty:
-                logger.warning(f"couldn't find {market}")
-                continue
-
-            if upload and upload_one_at_a_time:
-                self.load_from_dataframe(df)
-            elif upload:
-                master = pd.concat([df, master])
-
-        if upload and not upload_one_at_a_time:
-            self.load_from_dataframe(master)
-
     @property
     def possible_resolutions(self):
         pass
 
+    @property
+    def period_to_pandas(self) -> dict:
+        return {"1h": "1h"}
+
     @property
     def schema(self):
         schema = [
@@ -1,19 +1,27 @@
+import asyncio
 from dydx3 import Client
 import pandas as pd
 from datetime import datetime, timedelta, timezone
 import logging
 from drivers.base import DataDriver
 from google.cloud import bigquery
+from utils.retry_util import RetryPolicy
+from drivers.dydx_drivers.async_client import AsyncDydxClient, fetch_history, to_iso
+from utils.compact_util import constant_category
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
 class DYDXFutures(DataDriver):
-    def __init__(self, timeframe):
-
-        self.timeframe = timeframe
-        self.TABLE_NAME = f"OHLCV_{self.timeframe}"
+    def __init__(
+        self, timeframe, market_concurrency: int = 4, slice_concurrency: int = 8
+    ):
+
+        # the dYdX resolution, e.g. 1HOUR, `timeframe` is the pandas equivalent
+        self.resolution = timeframe
+        self.instrument_type = "future"
+        self.TABLE_NAME = f"OHLCV_{self.resolution}"
         self.DATASET_ID = "dydx"
 
         self.public_client = Client(
@@ -26,11 +34,25 @@ class DYDXFutures(DataDriver):
 
         self.max_samples = 100  # as far as I can see this is most you can get from API
 
+        # markets fetched at once, and slices of a market's history fetched at once
+        self.market_concurrency = market_concurrency
+        self.slice_concurrency = slice_concurrency
+
+        self.retry_policy = RetryPolicy()
+
         assert (
-            self.timeframe in self.possible_resolutions.keys()
+            self.resolution in self.possible_resolutions.keys()
         ), f"{timeframe} timeframe not supported"
 
-        super().__init__(dataset_id=self.DATASET_ID, table_name=self.TABLE_NAME)
+        self.timeframe_timedelta = timedelta(
+            seconds=self.possible_resolutions[self.resolution]
+        )
+
+        super().__init__(
+            dataset_id=self.DATASET_ID,
+            table_name=self.TABLE_NAME,
+            timeframe=self.period_to_pandas[self.resolution],
+        )
 
     @property
     def possible_resolutions(self):
@@ -44,137 +66,195 @@ class DYDXFutures(DataDriver):
             "1MIN": 60,
         }
 
+    @property
+    def period_to_pandas(self) -> dict:
+        return {
+            "1DAY": "1D",
+            "4HOURS": "4h",
+            "1HOUR": "1h",
+            "30MINS": "30min",
+            "15MINS": "15min",
+            "5MINS": "5min",
+            "1MIN": "1min",
+        }
+
     @property
     def resolution_to_offset_alias(self):
         return {
             "1DAY": "D",
-            "4HOURS": "H",
-            "1HOUR": "H",
-            "30MINS": "T",
-            "15MINS": "T",
-            "5MINS": "T",
-            "1MIN": "T",
+            "4HOURS": "h",
+            "1HOUR": "h",
+            "30MINS": "min",
+            "15MINS": "min",
+            "5MINS": "min",
+            "1MIN": "min",
         }
 
-    def get_candles_df(
-        self, market_str: str, from_time: datetime, to_time: datetime
+    @property
+    def candle_fields(self):
+        return [
+            "low",
+            "high",
+            "open",
+            "close",
+            "baseTokenVolume",
+            "usdVolume",
+            "startingOpenInterest",
+            "trades",
+        ]
+
+    async def get_candles_df(
+        self,
+        client: AsyncDydxClient,
+        market_str: str,
+        from_time: datetime,
+        to_time: datetime,
     ) -> pd.DataFrame:
-        """slide window back in time retrieving 100 hourly funding payments at a time"""
+        """fetch [from_time, to_time) as concurrent slices of 100 candles each"""
 
         assert market_str in self.markets.columns, f"{market_str} not available on DYDX"
 
         market = self.markets[market_str]
 
-        res_in_seconds = self.possible_resolutions.get(self.timeframe)
+        res_in_seconds = self.possible_resolutions.get(self.resolution)
         assert res_in_seconds, "incorrect resolution"
 
-        count = 0
-        master = pd.DataFrame()
-
-        from_time_original = from_time
-
-        while True:
-
-            if (
-                to_time - from_time
-            ).total_seconds() / res_in_seconds > self.max_samples:
-                from_time = to_time - timedelta(hours=self.max_samples)
-
-            if from_time_original and from_time_original > from_time:
-                from_time = from_time_original
-
-            try:
-                candles = self.public_client.public.get_candles(
+        async def fetch_page(start: datetime, end: datetime):
+            with self.instrumentation.span("fetch_page"):
+                return await client.get_candles(
                     market=market_str,
-                    resolution=self.timeframe,
-                    from_iso=from_time.isoformat(),
-                    to_iso=to_time.isoformat(),
+                    resolution=self.resolution,
+                    from_iso=to_iso(start),
+                    to_iso=to_iso(end),
                     limit=self.max_samples,
                 )
-            except Exception as e:
-                logger.warning(e)
-
-            candles_data = candles.data["candles"]
-            candles_df = pd.DataFrame(candles_data)
 
-            if candles_df.empty:
-                logger.info(f"DONE: no candles found...")
-                break
+        rows = await fetch_history(
+            fetch_page,
+            from_time.replace(tzinfo=None),
+            to_time.replace(tzinfo=None),
+            step=timedelta(seconds=res_in_seconds),
+            time_key="startedAt",
+            concurrency=self.slice_concurrency,
+            max_samples=self.max_samples,
+        )
 
-            candles_df.set_index("startedAt", inplace=True)
+        if len(rows) == 0:
+            logger.info(f"{market_str}: no candles found...")
+            return pd.DataFrame()
+
+        with self.instrumentation.span("parse"):
+            candles_df = pd.DataFrame(rows)
+
+            offset_alias = self.resolution_to_offset_alias.get(self.resolution)
+            master = pd.DataFrame(
+                {
+                    self.unified_timestamp_name: pd.to_datetime(
+                        candles_df["startedAt"], utc=True
+                    )
+                    .dt.tz_localize(None)
+                    .dt.round(offset_alias)
+                }
+            )
+            for field in self.candle_fields:
+                master[field] = candles_df[field].astype(float)
 
-            offset_alias = self.resolution_to_offset_alias.get(self.timeframe)
-            candles_df.index = pd.to_datetime(candles_df.index).round(offset_alias)
-            candles_df = candles_df.loc[~candles_df.index.duplicated(keep="first")]
+            master = master.drop_duplicates(self.unified_timestamp_name, keep="first")
 
-            count += 1
-            master = pd.concat([candles_df, master])
+            logger.info(
+                f"{market_str}: {master[self.unified_timestamp_name].iloc[0]} -> "
+                f"{master[self.unified_timestamp_name].iloc[-1]} ({len(master)})"
+            )
 
-            end = candles_df.index[0].replace(tzinfo=None)
-            start = candles_df.index[-1].replace(tzinfo=None)
-            logger.info(f"{market_str}({count}) {start} -> {end} ({len(candles_df)})")
+            master[self.unified_market_name] = constant_category(market_str, len(master))
+            master["status"] = constant_category(market["status"], len(master))
 
-            to_time = start
-            from_time = to_time - timedelta(hours=self.max_samples)
+            master["trades"] = master["trades"].astype(int)
+            master.sort_values(self.unified_timestamp_name, inplace=True, kind="mergesort")
 
-            if from_time_original and start <= from_time_original:
-                logger.info(f"FINISHED")
-                break
+        self.instrumentation.count("rows_fetched", len(master))
 
-        master["status"] = market["status"]
-
-        cols_float = [
-            "low",
-            "high",
-            "open",
-            "close",
-            "baseTokenVolume",
-            "usdVolume",
-            "startingOpenInterest",
-        ]
-        cols_int = ["trades"]
-        cold_categorial = ["status", "market"]
-
-        master[cols_float] = master[cols_float].astype(float)
-        master[cols_int] = master[cols_int].astype(int)
-        master[cold_categorial] = master[cold_categorial].astype("category")
-        master.drop(columns=["updatedAt", "resolution"], inplace=True)
-        master.rename(columns={"market": self.unified_market_name}, inplace=True)
-        master = master.rename_axis(self.unified_timestamp_name)
-        master.sort_index(inplace=True)
-
-        return master.reset_index()
+        return master.reset_index(drop=True)
 
     def fetch_data(self, upload: bool = False, upload_one_at_a_time: bool = False):
+        try:
+            asyncio.run(self.fetch_data_async(upload, upload_one_at_a_time))
+        finally:
+            self.report_instrumentation()
+
+    async def fetch_data_async(
+        self, upload: bool = False, upload_one_at_a_time: bool = False
+    ):
         now = datetime.now()
-        tracked_assets = self.get_latest_date()
-
-        master = pd.DataFrame()
-        for market in self.markets:
-
-            logger.info(f"{'COLLECTING: ' + market:-^70}")
-
-            if market in tracked_assets["ticker"].to_list():
-                from_time = tracked_assets[tracked_assets["ticker"] == market][
-                    "maxStartTime"
-                ].iloc[0]
-                logger.info(f"{market} found in DB, starting from {from_time}")
-            else:
-                from_time = datetime(2010, 1, 1)
-                logger.info(f"{market} not found in DB, starting from {from_time}")
-
-            df = self.get_candles_df(
-                market_str=market, from_time=from_time, to_time=now
+        tracked_assets = self.get_latest_date(tickers=self.markets.columns)
+
+        failed = []
+        master = []
+
+        try:
+            async with AsyncDydxClient(retry_policy=self.retry_policy) as client:
+                market_slots = asyncio.Semaphore(self.market_concurrency)
+
+                async def fetch_market(market: str) -> pd.DataFrame:
+                    async with market_slots:
+                        logger.info(f"{'COLLECTING: ' + market:-^70}")
+
+                        if market in tracked_assets["ticker"].to_list():
+                            from_time = tracked_assets[tracked_assets["ticker"] == market][
+                                "maxStartTime"
+                            ].iloc[0]
+                            logger.info(f"{market} found in DB, starting from {from_time}")
+                        else:
+                            from_time = datetime(2010, 1, 1)
+                            logger.info(
+                                f"{market} not found in DB, starting from {from_time}"
+                            )
+
+                        return await self.fetch_with_cache_async(
+                            market=market,
+                            from_time_dt=from_time,
+                            to_time_dt=now,
+                            fetch_function=lambda market, start, end: self.get_candles_df(
+                                client, market, start, end
+                            ),
+                        )
+
+                async def collect(market: str) -> pd.DataFrame:
+                    try:
+                        return await fetch_market(market)
+                    except Exception as e:
+                        # e.g. out of retries, or a delisted market, the other markets are still committed
+                        logger.error(f"Couldn't fetch {market}: {e}")
+                        failed.append(market)
+                        return pd.DataFrame()
+
+                for task in asyncio.as_completed([collect(market) for market in self.markets]):
+                    df = await task
+
+                    if df.empty:
+                        continue
+
+                    if upload and upload_one_at_a_time:
+                        # off the event loop, it blocks while too much data is waiting to be uploaded
+                        await asyncio.get_running_loop().run_in_executor(None, self.queue_upload, df, "close")
+                    elif upload:
+                        master.append(df)
+
+                logger.info(f"{client.requests} requests, {self.retry_policy.metrics}")
+
+            if upload and not upload_one_at_a_time and len(master) > 0:
+                self.load_from_dataframe(pd.concat(master), "close")
+        finally:
+            # what was queued is committed even if the run stops half way
+            if upload:
+                self.commit_uploads()
+
+        if len(failed) > 0:
+            raise RuntimeError(
+                f"Couldn't fetch {len(failed)}/{len(self.markets.columns)} markets of {self.TABLE_ID}: "
+                f"{', '.join(sorted(failed))}"
             )
 
-            if upload and upload_one_at_a_time:
-                self.load_from_dataframe(df)
-            elif upload:
-                master = pd.concat([df, master])
-
-        if upload and not upload_one_at_a_time:
-            self.load_from_dataframe(master)
-
     @property
     def schema(self):
         schema = [
@@ -8,6 +8,7 @@ from dotenv import load_dotenv
 import utils.yfinance_util as yfinance
 from datetime import datetime, timezone, timedelta
 from typing import Union
+from utils.retry_util import RetryPolicy
 
 pd.options.mode.chained_assignment = None
 
@@ -49,23 +50,17 @@ class FTXFutures(FTXBase):
             self, market_name, start_time, end_time, max_attempts, limit=None
     ):
 
-        for i in range(max_attempts):
-
-            try:
-                ohlc = self.FTX_client.get_historical_data(
-                    market_name=market_name,
-                    start_time=start_time,
-                    end_time=end_time,
-                    resolution=self.resolution,
-                    limit=limit,
-                )
-                return ohlc
-            except Exception as e:
-                sleep_time = 1 * (1 + i)
-                logger.error(
-                    f"Attempt {i + 1}/{max_attempts} sleep({sleep_time}) ERROR: {e}"
-                )
-                time.sleep(sleep_time)
+        try:
+            return RetryPolicy(max_attempts=max_attempts).call(
+                self.FTX_client.get_historical_data,
+                market_name=market_name,
+                start_time=start_time,
+                end_time=end_time,
+                resolution=self.resolution,
+                limit=limit,
+            )
+        except Exception as e:
+            logger.error(f"{market_name} failed after {max_attempts} attempts: {e}")
 
         return None
 
@@ -3,9 +3,12 @@ import os
 import sys
 import time
 import zipfile
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logging.basicConfig(level=logging.INFO)
 
@@ -18,8 +21,24 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+CDN_URL = "https://static.okx.com/cdn/okex/traderecords"
+LISTING_URL = "https://www.okx.com/priapi/v5/broker/public/orderRecord"
+
+# large buffers, the daily archives are tens to hundreds of MB
+CHUNK_SIZE = 1024 * 1024
+
+
 class OKXWebscaper:
-    def __init__(self, data_type: str, period: str, resume_path: Path = None):
+    def __init__(
+        self,
+        data_type: str,
+        period: str,
+        resume_path: Path = None,
+        max_workers: int = 4,
+        start_date: date = date(2021, 10, 1),
+        cdn_url: str = CDN_URL,
+        listing_url: str = LISTING_URL,
+    ):
 
         self.resume_path = resume_path
         self.data_type = data_type
@@ -39,59 +58,146 @@ class OKXWebscaper:
             self.data_folder_path = self.cwd_path / self.data_folder_name
             self.data_folder_path.mkdir(parents=True, exist_ok=True)
 
-        self.all_dates = pd.date_range(start=date(2021, 10, 1), end=date.today())
-        self.all_months_str = list(set(self.all_dates.strftime("%Y%m")))
+        self.all_dates = pd.date_range(start=start_date, end=date.today())
+        self.all_months_str = sorted(set(self.all_dates.strftime("%Y%m")))
 
         self.all_dates_str = list(set(self.all_dates.strftime("%Y-%m-%d")))
         self.all_dates_str.sort()
 
         self.PAUSE_TIME = 0.5
 
+        self.max_workers = max_workers
+        self.cdn_url = cdn_url
+        self.listing_url = listing_url
+
+        # one pooled session shared by the download threads, so connections are kept alive between files
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=max_workers,
+            pool_maxsize=max_workers,
+            max_retries=Retry(
+                total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504]
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
     def validate_zip_file(self, zip_file: str) -> bool:
-        """Validate zip file."""
-        the_zip_file = zipfile.ZipFile(zip_file)
-        ret = the_zip_file.testzip()
+        """Validate zip file, a truncated file isn't valid."""
+        try:
+            with zipfile.ZipFile(zip_file) as the_zip_file:
+                ret = the_zip_file.testzip()
+        except (zipfile.BadZipFile, OSError):
+            return False
         return ret is None
 
     def download(self, url: str, output_file: str) -> bool:
-        """Download a zip file, skip if it exists."""
+        """Download a zip file, skip if it exists.
+
+        The file is written to `{output_file}.part` and renamed once it's complete, a partial file left over
+        by an interrupted run is resumed with an HTTP Range request.
+        """
         assert output_file.endswith(".zip")
-        if os.path.exists(output_file) and self.validate_zip_file(output_file):
-            logging.info(f"Skipped {url}")
-            return True
-        logging.info(f"Downloading {url}")
-        resp = requests.get(url, stream=True)
-        with open(output_file, "wb") as f_out:
-            for chunk in resp.iter_content(chunk_size=4096):
-                if chunk:  # filter out keep-alive new chunks
-                    f_out.write(chunk)
+        if os.path.exists(output_file):
+            if self.validate_zip_file(output_file):
+                logger.info(f"Skipped {url}")
+                return True
+            # truncated file written in place by an older run, resume it
+            os.replace(output_file, f"{output_file}.part")
+
+        part_file = f"{output_file}.part"
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+
+        logger.info(f"Downloading {url}" + (f" from byte {offset}" if offset else ""))
+
+        with self.session.get(url, stream=True, headers=headers, timeout=60) as resp:
+            if resp.status_code == 416:
+                # nothing left to download, the part file is already complete
+                pass
+            else:
+                resp.raise_for_status()
+                # the server ignored the Range header, start over
+                mode = "ab" if resp.status_code == 206 else "wb"
+                with open(part_file, mode) as f_out:
+                    for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                        if chunk:  # filter out keep-alive new chunks
+                            f_out.write(chunk)
+
+        if not self.validate_zip_file(part_file):
+            logger.error(f"{part_file} is not a valid zip file, removing it")
+            os.remove(part_file)
+            return False
+
+        os.replace(part_file, output_file)
+
         return True
 
     def list_files(self, month: int) -> List[str]:
         """List files in a month."""
-        url = f"https://www.okx.com/priapi/v5/broker/public/orderRecord?t={int(time.time() * 1000)}&path=cdn/okex/traderecords/{self.data_type}/monthly/{month}"
-        obj = requests.get(url).json()
+        params = {
+            "t": int(time.time() * 1000),
+            "path": f"cdn/okex/traderecords/{self.data_type}/monthly/{month}",
+        }
+        obj = self.session.get(self.listing_url, params=params, timeout=30).json()
         if obj["code"] != "0":
             raise ValueError(obj)
         return [x["fileName"] for x in obj["data"]]
 
+    def missing_files(self, prefix: str = "allswap-") -> List[Tuple[str, str]]:
+        """Files listed for each month that aren't in the data folder yet
+
+        :param prefix: only keep the files starting with it (i.e. the instrument type)
+        :return: the list of (year_month, file name) to download
+        """
+        missing = []
+
+        for year_month in self.all_months_str:
+            try:
+                file_names = self.list_files(year_month)
+            except Exception as e:
+                logger.warning(f"Couldn't list the files of {year_month}: {e}")
+                # fall back to the expected daily file names
+                file_names = [
+                    f"{prefix}{self.data_type}-{date_str}.zip"
+                    for date_str in self.all_dates_str
+                    if date_str.replace("-", "").startswith(year_month)
+                ]
+
+            for file_name in sorted(file_names):
+                if not file_name.startswith(prefix):
+                    continue
+                output_file = self.data_folder_path / file_name
+                if output_file.exists() and self.validate_zip_file(str(output_file)):
+                    continue
+                missing.append((year_month, file_name))
+
+        return missing
+
     def okx_download(self) -> bool:
         """Download OKX data"""
 
-        for date_str in self.all_dates_str:
-            year_month = "".join(date_str.split("-")[:2])
-            file_name_future = f"allfuture-aggtrades-{date_str}.zip"
-            file_name_spot = f"allspot-aggtrades-{date_str}.zip"
-            file_name_swap = f"allswap-aggtrades-{date_str}.zip"
-            url = f"https://static.okx.com/cdn/okex/traderecords/{self.data_type}/monthly/{year_month}/{file_name_swap}"
-            output_file = self.data_folder_path.resolve() / file_name_swap
-            downloaded = self.download(url, str(output_file))
+        def download_file(year_month: str, file_name: str) -> bool:
+            url = f"{self.cdn_url}/{self.data_type}/monthly/{year_month}/{file_name}"
+            output_file = self.data_folder_path.resolve() / file_name
+            try:
+                downloaded = self.download(url, str(output_file))
+            except Exception as e:
+                logger.error(f"ERROR: couldn't download {file_name}: {e}")
+                return False
             if downloaded:
-                logger.info(f"SUCESS: downloaded {file_name_swap}")
+                logger.info(f"SUCESS: downloaded {file_name}")
             else:
-                logger.error(f"ERROR: downloaded {file_name_swap}")
+                logger.error(f"ERROR: downloaded {file_name}")
+            return downloaded
 
-        return True
+        missing = self.missing_files()
+        logger.info(f"{len(missing)} files to download")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(lambda args: download_file(*args), missing))
+
+        return all(results)
 
     @property
     def available_data_type(self):
@@ -1,15 +1,259 @@
 import pandas as pd
 from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from functools import partial
+import argparse
+import time
+import zipfile
 import logging
+import pyarrow as pa
+import pyarrow.parquet as pq
 from drivers.base import DataDriver
 from google.cloud import bigquery
+from utils.validation_util import timeframe_to_ns
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+AGGTRADES_COLUMNS = ["instId", "tradeId", "side", "sz", "px", "ts"]
+AGGTRADES_DTYPES = {
+    "instId": "category",
+    "tradeId": "int64",
+    "side": "category",
+    "sz": "float64",
+    "px": "float64",
+    "ts": "int64",
+}
+CANDLE_KEYS = ["instId", "bucket"]
+SWAPRATES_COLUMNS = [
+    "instrument_name",
+    "contract_type",
+    "funding_rate",
+    "real_funding_rate",
+    "funding_time",
+]
+
+
+def has_header(file: Path) -> bool:
+    """some files start with a (non utf-8) header line, the data lines end with a ms timestamp"""
+    with zipfile.ZipFile(file) as zip_file:
+        with zip_file.open(zip_file.namelist()[0]) as f:
+            first_line = f.readline()
+    return not first_line.strip().split(b",")[-1].isdigit()
+
+
+def read_aggtrades_chunks(file: Path, chunksize: int) -> Iterator[pd.DataFrame]:
+    """read a daily aggtrades zip in chunks of `chunksize` rows with pinned dtypes"""
+    skiprows = 1 if has_header(file) else 0
+
+    return pd.read_csv(
+        file,
+        names=AGGTRADES_COLUMNS,
+        header=None,
+        skiprows=skiprows,
+        dtype=AGGTRADES_DTYPES,
+        usecols=["instId", "sz", "px", "ts"],
+        encoding="iso-8859-1",
+        chunksize=chunksize,
+    )
+
+
+def aggregate_trades(trades: pd.DataFrame, freq_ns: int) -> pd.DataFrame:
+    """OHLCV of every (instrument, bucket) in one vectorized group by
+
+    `first_ts` and `last_ts` are kept so that partial candles from different chunks can be merged later on.
+    """
+    ts = trades["ts"].to_numpy() * 1_000_000
+
+    df = pd.DataFrame(
+        {
+            "instId": trades["instId"].astype(str).to_numpy(),
+            "bucket": ts - ts % freq_ns,
+            "ts": ts,
+            "px": trades["px"].to_numpy(),
+            "sz": trades["sz"].to_numpy(),
+        }
+    )
+    df.sort_values(["instId", "ts"], kind="mergesort", inplace=True)
+
+    candles = df.groupby(CANDLE_KEYS, sort=False).agg(
+        open=("px", "first"),
+        high=("px", "max"),
+        low=("px", "min"),
+        close=("px", "last"),
+        volume=("sz", "sum"),
+        first_ts=("ts", "min"),
+        last_ts=("ts", "max"),
+    )
+
+    return candles.reset_index()
+
+
+def merge_candles(candles: pd.DataFrame) -> pd.DataFrame:
+    """merge partial candles of the same (instrument, bucket), e.g. split across chunks or files"""
+    if not candles.duplicated(CANDLE_KEYS).any():
+        return candles.reset_index(drop=True)
+
+    by_first = candles.sort_values("first_ts", kind="mergesort")
+    merged = by_first.groupby(CANDLE_KEYS, sort=False).agg(
+        open=("open", "first"),
+        high=("high", "max"),
+        low=("low", "min"),
+        volume=("volume", "sum"),
+        first_ts=("first_ts", "min"),
+        last_ts=("last_ts", "max"),
+    )
+    merged["close"] = (
+        candles.sort_values("last_ts", kind="mergesort")
+        .groupby(CANDLE_KEYS, sort=False)["close"]
+        .last()
+    )
+
+    return merged.reset_index()[candles.columns]
+
+
+class CandleAccumulator:
+    """Carries the latest (potentially incomplete) candle of each instrument across chunks and files"""
+
+    def __init__(self):
+        self.open_candles = None
+
+    def add(self, candles: pd.DataFrame) -> pd.DataFrame:
+        """add the candles of a new chunk and return the ones that are complete"""
+        if self.open_candles is not None:
+            candles = merge_candles(pd.concat([self.open_candles, candles]))
+
+        latest_bucket = candles.groupby("instId")["bucket"].transform("max")
+        is_open = (candles["bucket"] == latest_bucket).to_numpy()
+
+        self.open_candles = candles[is_open]
+
+        return candles[~is_open]
+
+    def flush(self) -> pd.DataFrame:
+        """return the remaining candles, once all files have been processed"""
+        candles = self.open_candles
+        self.open_candles = None
+        return candles
+
+
+def aggregate_aggtrades_file(
+    file: Path, freq_ns: int, chunksize: int
+) -> Tuple[Optional[pd.DataFrame], float]:
+    """all the candles of one daily zip, the first/last candle of each instrument may still be partial
+
+    Runs in the worker processes, so it only depends on the file and returns its processing time.
+
+    :param file: the aggtrades zip file
+    :param freq_ns: the candle size in nanoseconds
+    :param chunksize: number of trades read at a time
+    :return: the candles (None if the file has no trades) and the processing time in seconds
+    """
+    started = time.perf_counter()
+
+    accumulator = CandleAccumulator()
+    completed = [
+        accumulator.add(aggregate_trades(chunk, freq_ns))
+        for chunk in read_aggtrades_chunks(file, chunksize=chunksize)
+    ]
+
+    remaining = accumulator.flush()
+    if remaining is not None:
+        completed.append(remaining)
+
+    candles = pd.concat(completed, ignore_index=True) if len(completed) > 0 else None
+
+    return candles, time.perf_counter() - started
+
+
+def read_swaprates_file(file: Path) -> Tuple[pd.DataFrame, float]:
+    """read a daily swaprates zip indexed by funding time
+
+    :param file: the swaprates zip file
+    :return: the funding rates and the processing time in seconds
+    """
+    started = time.perf_counter()
+
+    try:
+        df = pd.read_csv(file, names=SWAPRATES_COLUMNS, header=None)
+    except UnicodeDecodeError:
+        df = pd.read_csv(
+            file,
+            names=SWAPRATES_COLUMNS,
+            header=None,
+            skiprows=1,
+            encoding="iso-8859-1",
+        )
+
+    df.index = pd.to_datetime(df["funding_time"], unit="ms")
+    df.drop(columns=["funding_time"], inplace=True)
+
+    return df, time.perf_counter() - started
+
+
+def map_files(
+    function: Callable, files: List[Path], workers: int = 1
+) -> Iterator[Tuple[Path, object]]:
+    """apply `function` to each file and yield the results in file order
+
+    With more than one worker the files are processed in a process pool. At most 2 results per worker are
+    queued at any time, so a slow consumer (e.g. uploads) doesn't make the results pile up in memory.
+    """
+    if workers <= 1:
+        for file in files:
+            yield file, function(file)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        files_iter = iter(files)
+
+        for file in files_iter:
+            pending.append((file, executor.submit(function, file)))
+            if len(pending) >= 2 * workers:
+                break
+
+        while len(pending) > 0:
+            file, future = pending.popleft()
+            result = future.result()
+
+            next_file = next(files_iter, None)
+            if next_file is not None:
+                pending.append((next_file, executor.submit(function, next_file)))
+
+            yield file, result
+
+
+def iter_aggtrades_file_candles(
+    files: Iterable[Path], freq_ns: int, chunksize: int = 1_000_000, workers: int = 1
+) -> Iterator[pd.DataFrame]:
+    """completed candles of each file, in file order, then the remaining candles
+
+    Files are aggregated independently (in parallel if `workers` > 1) and their boundary candles are merged in
+    file order, so the output doesn't depend on the number of workers.
+    """
+    accumulator = CandleAccumulator()
+    function = partial(aggregate_aggtrades_file, freq_ns=freq_ns, chunksize=chunksize)
+
+    for file, (candles, elapsed) in map_files(function, list(files), workers=workers):
+        logger.info(f"Processed {file} in {elapsed:.2f}s")
+
+        if candles is None or candles.empty:
+            continue
+
+        yield accumulator.add(candles)
+
+    remaining = accumulator.flush()
+    if remaining is not None:
+        yield remaining
+
 
 class OKXCombine(DataDriver):
-    def __init__(self, data_folder: Path, timeframe: str, upload: bool = False):
+    def __init__(
+        self, data_folder: Path, timeframe: str, upload: bool = False, workers: int = 1
+    ):
 
         self.exchange_id = "okx"
         self.table_name = "funding_rate"
@@ -28,32 +272,13 @@ class OKXCombine(DataDriver):
 
         self.upload = upload
 
-    def resample_series(self, df: pd.DataFrame):
-
-        df.reset_index(inplace=True)
-        df.set_index("ts", inplace=True)
-        df.sort_index(inplace=True)
-
-        resample_px = df["px"].resample(self.timeframe).ohlc()
-        resample_sz = df["sz"].resample(self.timeframe).sum()
-        resample_sz.name = "volume"
-
-        resample_data = pd.concat(
-            [resample_px, resample_sz],
-            axis=1,
-        )
-
-        resample_data["instId"] = df["instId"][0]
-
-        return resample_data.reset_index()
-
-    def combine_all_aggtrades(self):
+        self.workers = workers
 
-        col_names = ["instId", "tradeId", "side", "sz", "px", "ts"]
+    def zip_files(self) -> List[Path]:
+        """daily zip files sorted by name (i.e. date), so partial candles can be carried from one file to the next"""
+        files = []
 
-        master_df = pd.DataFrame()
-
-        for file in self.data_folder.glob("*.zip"):
+        for file in sorted(self.data_folder.glob("*.zip")):
 
             if "(" in file.stem:
                 logger.warning(
@@ -61,95 +286,68 @@ class OKXCombine(DataDriver):
                 )
                 continue
 
-            try:
-                df = pd.read_csv(
-                    file,
-                    names=col_names,
-                    header=None,
-                )
-            except UnicodeDecodeError as e:
-                df = pd.read_csv(
-                    file,
-                    names=col_names,
-                    header=None,
-                    skiprows=1,
-                    encoding="iso-8859-1",
-                )
-            except Exception as e:
-                logger.info(e)
-
-            df["ts"] = pd.to_datetime(df["ts"], unit="ms")
-
-            resample_data = df.groupby("instId", as_index=False).apply(
-                self.resample_series
-            )
-
-            resample_data.reset_index(drop=True, inplace=True)
+            files.append(file)
+
+        return files
+
+    def iter_aggtrades_candles(self, chunksize: int = 1_000_000) -> Iterator[pd.DataFrame]:
+        """Stream the candles of every aggtrades file, one DataFrame of completed candles per file
+
+        Each zip is read in chunks of `chunksize` trades, only the latest candle of each instrument is kept in
+        memory between chunks (and files) so peak memory doesn't depend on the number of days processed.
+        Files are spread over `self.workers` processes.
+        """
+        for candles in iter_aggtrades_file_candles(
+            self.zip_files(),
+            freq_ns=timeframe_to_ns(self.timeframe),
+            chunksize=chunksize,
+            workers=self.workers,
+        ):
+            yield self.format_candles(candles)
+
+    def format_candles(self, candles: pd.DataFrame) -> pd.DataFrame:
+        df = pd.DataFrame(
+            {
+                self.unified_timestamp_name: pd.to_datetime(
+                    candles["bucket"].to_numpy(), unit="ns"
+                ),
+                self.unified_market_name: pd.Categorical(candles["instId"].astype(str)),
+                "open": candles["open"].to_numpy(),
+                "high": candles["high"].to_numpy(),
+                "low": candles["low"].to_numpy(),
+                "close": candles["close"].to_numpy(),
+                "volume": candles["volume"].to_numpy(),
+            }
+        )
+        return df.sort_values(self.unified_timestamp_name, kind="mergesort")
 
-            master_df = pd.concat([master_df, resample_data])
+    def combine_all_aggtrades(self):
 
-            logger.info(f"Processed {file}")
+        master_df = pd.concat(list(self.iter_aggtrades_candles()))
 
-        master_df.rename(
-            columns={
-                "ts": self.unified_timestamp_name,
-                "instId": self.unified_market_name,
-            },
-            inplace=True,
+        master_df.sort_values(
+            self.unified_timestamp_name, ascending=True, inplace=True, kind="mergesort"
         )
 
-        master_df.sort_values(self.unified_timestamp_name, ascending=True, inplace=True)
-
         return master_df.reset_index(drop=True)
 
     def combine_all_swaprates(self):
 
-        names = [
-            "instrument_name",
-            "contract_type",
-            "funding_rate",
-            "real_funding_rate",
-            "funding_time",
-        ]
-
-        master_df = pd.DataFrame()
-
-        for file in self.data_folder.glob("*.zip"):
+        frames = []
 
-            if "(" in file.stem:
-                logger.warning(
-                    f"Skipping {file.name} since it's potentially a duplicate"
-                )
-                continue
+        for file, (df, elapsed) in map_files(
+            read_swaprates_file, self.zip_files(), workers=self.workers
+        ):
+            frames.append(df)
+            logger.info(f"Loaded {file} in {elapsed:.2f}s")
 
-            try:
-                df = pd.read_csv(
-                    file,
-                    names=names,
-                    header=None,
-                )
-            except UnicodeDecodeError as e:
-                df = pd.read_csv(
-                    file,
-                    names=names,
-                    header=None,
-                    skiprows=1,
-                    encoding="iso-8859-1",
-                )
-            except Exception as e:
-                logger.info(e)
-
-            df.index = pd.to_datetime(df["funding_time"], unit="ms")
-            df.drop(columns=["funding_time"], inplace=True)
-            master_df = pd.concat([master_df, df])
-
-            logger.info(f"Loaded {file}")
+        master_df = pd.concat(frames) if len(frames) > 0 else pd.DataFrame()
 
         master_df.rename_axis(self.unified_timestamp_name, inplace=True)
         master_df.rename(
             columns={"instrument_name": self.unified_market_name}, inplace=True
         )
-        master_df.sort_index(ascending=True, inplace=True)
+        master_df.sort_index(ascending=True, inplace=True, kind="mergesort")
 
         return master_df.reset_index(drop=False)
 
@@ -174,32 +372,65 @@ class OKXCombine(DataDriver):
         ]
         return schema
 
-    def fetch_data(self):
-        try:
-            if "swaprates" in str(self.data_folder):
-                master_df = okx.combine_all_swaprates()
-            elif "aggtrades" in str(self.data_folder):
-                master_df = okx.combine_all_aggtrades()
-                master_df = self.validate_df(
-                    master_df, savefig_path=Path("./data_check.jpg"), unique_col="close"
-                )
-            else:
-                raise NotImplementedError
-        except Exception as e:
-            logger.error(e)
+    def fetch_data(self, output_path: Path = None):
+        """combine the downloaded files and upload them
+
+        :param output_path: if set, aggtrades candles are also written to this Parquet file as they are produced
+        """
+        if "swaprates" in str(self.data_folder):
+            master_df = self.combine_all_swaprates()
+            if self.upload:
+                self.load_from_dataframe(master_df, unique_col="funding_rate")
+        elif "aggtrades" in str(self.data_folder):
+            writer = None
+            for candles in self.iter_aggtrades_candles():
+                if candles.empty:
+                    continue
+                if output_path is not None:
+                    table = pa.Table.from_pandas(candles, preserve_index=False)
+                    if writer is None:
+                        writer = pq.ParquetWriter(output_path, table.schema)
+                    writer.write_table(table)
+                if self.upload:
+                    self.load_from_dataframe(candles, unique_col="close")
+            if writer is not None:
+                writer.close()
+        else:
+            raise NotImplementedError
 
         if self.upload:
-            self.load_from_dataframe(master_df)
+            self.commit_uploads()
 
     def possible_resolutions(self):
         return ["8h"]
 
+    @property
+    def period_to_pandas(self) -> dict:
+        """frequency needs to be mapped to these offset aliases:
+        https://pandas.pydata.org/pandas-docs/stable/user_guide/timeseries.html#offset-aliases"""
+        return {"8h": "8H", "1m": "1min", "1h": "1H", "1H": "1H"}
 
-if __name__ == "__main__":
 
-    data_folder = Path("2023-01-20_18-14-34_aggtrades_monthly")
+if __name__ == "__main__":
 
-    okx = OKXCombine(data_folder=data_folder, timeframe="1H", upload=True)
-    okx.fetch_data()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--data-folder", type=Path, default=Path("2023-01-20_18-14-34_aggtrades_monthly")
+    )
+    parser.add_argument("--timeframe", default="1H")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="number of processes reading the zip files"
+    )
+    parser.add_argument("--output", type=Path, default=None)
+    parser.add_argument("--no-upload", action="store_true")
+    args = parser.parse_args()
+
+    okx = OKXCombine(
+        data_folder=args.data_folder,
+        timeframe=args.timeframe,
+        upload=not args.no_upload,
+        workers=args.workers,
+    )
+    okx.fetch_data(output_path=args.output)
 
     pass
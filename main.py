@@ -7,6 +7,9 @@ from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.date import DateTrigger
 from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR
+from utils.scheduler_util import create_executors, get_job_defaults, scheduled_job
+from utils.bigquery_util import get_bigquery_client
+from utils.merge_util import compact_tables
 
 # load_dotenv()
 logging.basicConfig(level=logging.INFO)
@@ -19,6 +22,8 @@ discord = Discord()
 HOUR = 12
 UPLOAD = True
 UPLOAD_ONE_AT_A_TIME = True
+# datasets de-duplicated by the weekly compaction
+COMPACTED_DATASETS = ["binance", "dydx", "okx"]
 
 
 def tick():
@@ -26,50 +31,37 @@ def tick():
     return {"hello": "world"}
 
 
-def updateBinance1hSpot():
+@scheduled_job(exchange="binance")
+def updateBinanceSpot():
+    """1h candles, the 1d candles are derived from them"""
     ccxt_ohlcv = CCXTDriverOHLCV(
         ccxt_exchange_id="binance",
         timeframe="1h",
-        default_type="spot",
+        instrument_type="spot",
         coinapi_exchange_id="BINANCE",
         coinapi_symbol_type="SPOT",
+        derived_timeframes=["1d"],
     )
     ccxt_ohlcv.fetch_data(upload=UPLOAD, upload_one_at_a_time=UPLOAD_ONE_AT_A_TIME)
+    return ccxt_ohlcv.instrumentation.summary()
 
 
-def updateBinance1dSpot():
-    ccxt_ohlcv = CCXTDriverOHLCV(
-        ccxt_exchange_id="binance",
-        timeframe="1d",
-        default_type="spot",
-        coinapi_exchange_id="BINANCE",
-        coinapi_symbol_type="SPOT",
-    )
-    ccxt_ohlcv.fetch_data(upload=UPLOAD, upload_one_at_a_time=UPLOAD_ONE_AT_A_TIME)
-
-
-def updateBinance1hFuture():
+@scheduled_job(exchange="binance")
+def updateBinanceFuture():
+    """1h candles, the 8h candles are derived from them"""
     ccxt_ohlcv = CCXTDriverOHLCV(
         ccxt_exchange_id="binance",
         timeframe="1h",
-        default_type="future",
-        coinapi_exchange_id="BINANCEFTS",
-        coinapi_symbol_type="PERPETUAL",
-    )
-    ccxt_ohlcv.fetch_data(upload=UPLOAD, upload_one_at_a_time=UPLOAD_ONE_AT_A_TIME)
-
-
-def updateBinance8hFuture():
-    ccxt_ohlcv = CCXTDriverOHLCV(
-        ccxt_exchange_id="binance",
-        timeframe="8h",
-        default_type="future",
+        instrument_type="future",
         coinapi_exchange_id="BINANCEFTS",
         coinapi_symbol_type="PERPETUAL",
+        derived_timeframes=["8h"],
     )
     ccxt_ohlcv.fetch_data(upload=UPLOAD, upload_one_at_a_time=UPLOAD_ONE_AT_A_TIME)
+    return ccxt_ohlcv.instrumentation.summary()
 
 
+@scheduled_job(exchange="binance")
 def updateBinanceFunding():
     ccxt_funding = CCXTDriverFunding(
         ccxt_exchange_id="binance",
@@ -77,78 +69,75 @@ def updateBinanceFunding():
         coinapi_symbol_type="PERPETUAL",
     )
     ccxt_funding.fetch_data(upload=UPLOAD, upload_one_at_a_time=UPLOAD_ONE_AT_A_TIME)
+    return ccxt_funding.instrumentation.summary()
 
 
+@scheduled_job(exchange="dydx")
 def updateDYDXFunding():
     dydx = DYDXFunding()
     dydx.fetch_data(upload=UPLOAD, upload_one_at_a_time=UPLOAD_ONE_AT_A_TIME)
+    return dydx.instrumentation.summary()
 
 
+@scheduled_job(exchange="dydx")
 def updateDYDX1hFuture():
     dydx_futures = DYDXFutures(timeframe="1HOUR")
     dydx_futures.fetch_data(upload=UPLOAD, upload_one_at_a_time=UPLOAD_ONE_AT_A_TIME)
+    return dydx_futures.instrumentation.summary()
+
+
+@scheduled_job()
+def updateCompactTables():
+    """remove the rows appended twice (e.g. by reruns with the `load` sink), with one MERGE per table"""
+    project_id = os.environ.get("project_id")
+    removed = compact_tables(
+        get_bigquery_client(project_id),
+        project_id,
+        COMPACTED_DATASETS,
+        key_columns=["ticker", "startTime"],
+    )
+    compacted = {table_id: rows for table_id, rows in removed.items() if rows > 0}
+    return f"removed {sum(compacted.values()):,} duplicated rows from {len(compacted)}/{len(removed)} tables"
 
 
 def scheduler_callback(event):
     logger.info(f"Job: {event.job_id} completed, with exception:{event.exception}")
-    discord.send_embed(job_id=event.job_id, exception=event.exception)
-
-
-def schedule_all_jobs(start_scheduler: bool = True):
-    scheduler = BlockingScheduler()
-    scheduler.add_listener(scheduler_callback, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
-    # scheduler.add_executor('processpool')
-
-    # adding one job per driver is a good idea since if one fatally fails the others won't be compromised
-
-    scheduler.add_job(
-        func=updateBinance1hSpot,
-        trigger=CronTrigger(hour=HOUR),
-        id="updateBinance1hSpot",
-    )
-    logger.debug("Added job 'updateBinance1hSpot'.")
-
-    scheduler.add_job(
-        func=updateBinance1dSpot,
-        trigger=CronTrigger(hour=HOUR),
-        id="updateBinance1dSpot",
+    # the jobs return the summary of their instrumentation, see `DataDriver.report_instrumentation`
+    discord.send_embed(
+        job_id=event.job_id,
+        exception=event.exception,
+        execution_message=getattr(event, "retval", None),
     )
-    logger.debug("Added job 'updateBinance1dSpot'.")
 
-    scheduler.add_job(
-        func=updateBinance1hFuture,
-        trigger=CronTrigger(hour=HOUR),
-        id="updateBinance1hFuture",
-    )
-    logger.debug("Added job 'updateBinance1hFuture'.")
 
-    scheduler.add_job(
-        func=updateBinance8hFuture,
-        trigger=CronTrigger(hour=HOUR),
-        id="updateBinance8hFuture",
-    )
-    logger.debug("Added job 'updateBinance8hFuture'.")
+# the executor of each job, validating the large hourly tables is CPU heavy so they run in the process pool, and the
+# cron fields of those that don't run daily at HOUR
+JOBS = [
+    (updateBinanceSpot, "processpool"),
+    (updateBinanceFuture, "processpool"),
+    (updateBinanceFunding, "default"),
+    (updateDYDXFunding, "default"),
+    (updateDYDX1hFuture, "default"),
+    # on sundays once the updates are done, so its MERGEs don't queue behind the merge sink's
+    (updateCompactTables, "default", {"day_of_week": "sun", "hour": HOUR + 6}),
+]
 
-    scheduler.add_job(
-        func=updateBinanceFunding,
-        trigger=CronTrigger(hour=HOUR),
-        id="updateBinanceFunding",
-    )
-    logger.debug("Added job 'updateBinanceFunding'.")
 
-    scheduler.add_job(
-        func=updateDYDXFunding,
-        trigger=CronTrigger(hour=HOUR),
-        id="updateDYDXFunding",
+def schedule_all_jobs(start_scheduler: bool = True):
+    scheduler = BlockingScheduler(
+        executors=create_executors(), job_defaults=get_job_defaults()
     )
-    logger.debug("Added job 'updateDYDXFunding'.")
+    scheduler.add_listener(scheduler_callback, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
 
-    scheduler.add_job(
-        func=updateDYDX1hFuture,
-        trigger=CronTrigger(hour=HOUR),
-        id="updateDYDX1hFuture",
-    )
-    logger.debug("Added job 'updateDYDX1hFuture'.")
+    # adding one job per driver is a good idea since if one fatally fails the others won't be compromised
+    for func, executor, *cron in JOBS:
+        scheduler.add_job(
+            func=func,
+            trigger=CronTrigger(**(cron[0] if cron else {"hour": HOUR})),
+            id=func.__name__,
+            executor=executor,
+        )
+        logger.debug(f"Added job '{func.__name__}' to the {executor} executor.")
 
     # scheduler.add_job(
     #     func=tick,
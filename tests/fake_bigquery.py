@@ -0,0 +1,299 @@
+"""In-memory stand-in for the `bigquery.Client` calls the drivers make, to run them offline
+
+Tables are kept as DataFrames. `query` only answers the queries the drivers send (see `QUERY_HANDLERS`), anything
+else raises so a new query can't silently return nothing.
+"""
+import re
+import threading
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+from google.cloud import bigquery
+from google.cloud.exceptions import BadRequest, Conflict, NotFound
+
+from utils.gap_util import GAP_COLUMNS, find_gaps
+
+
+class FakeJob:
+    def __init__(self, df: pd.DataFrame = None, error_result: dict = None):
+        self.df = df if df is not None else pd.DataFrame()
+        self.error_result = error_result
+        self.errors = [error_result] if error_result is not None else None
+
+    def result(self, *args, **kwargs):
+        # like a failed `bigquery.LoadJob`
+        if self.error_result is not None:
+            raise BadRequest(self.error_result["message"], errors=self.errors)
+        return self
+
+    def to_dataframe(self, *args, **kwargs) -> pd.DataFrame:
+        return self.df.copy()
+
+
+def _table_key(table) -> str:
+    if isinstance(table, str):
+        return table.replace("`", "")
+    return f"{table.project}.{table.dataset_id}.{table.table_id}"
+
+
+def watermark_query(client: "FakeBigQueryClient", match: re.Match) -> pd.DataFrame:
+    """`DataDriver.get_latest_date`, see `utils.partition_util.watermark_query`"""
+    timestamp_col, table_id, where, market_col = match.group(1), match.group(2), match.group(3), match.group(4)
+    df = client.table_data(table_id)
+    columns = ["maxStartTime", "minStartTime", "countStartTime", market_col]
+    if df.empty:
+        return pd.DataFrame(columns=columns)
+
+    since = re.search(r">= DATETIME\('([^']+)'\)", where or "")
+    if since:
+        df = df[df[timestamp_col] >= pd.Timestamp(since.group(1))]
+    tickers = re.search(r"IN \(([^)]*)\)", where or "")
+    if tickers:
+        df = df[df[market_col].astype(str).isin(re.findall(r"'((?:[^'\\]|\\.)*)'", tickers.group(1)))]
+
+    df = df.groupby(market_col, observed=True)[timestamp_col].agg(["max", "min", "count"]).reset_index()
+    df.columns = [market_col, "maxStartTime", "minStartTime", "countStartTime"]
+    df[market_col] = df[market_col].astype(str)
+    return df[columns].sort_values("maxStartTime", ascending=False, ignore_index=True)
+
+
+def gap_query(client: "FakeBigQueryClient", match: re.Match) -> pd.DataFrame:
+    """`DataDriver.get_gaps`, see `utils.gap_util.gap_query`"""
+    sql = match.string
+    unique_col = match.group(1)
+    market_col = re.search(r"(\w+) AS ticker", sql).group(1)
+    timestamp_col = re.search(r"(\w+) AS ts", sql).group(1)
+    table_id = re.search(r"FROM `([^`]+)`", sql).group(1)
+    step = pd.Timedelta(seconds=int(re.search(r"INTERVAL (\d+) SECOND", sql).group(1)))
+
+    df = client.table_data(table_id)
+    if df.empty:
+        return pd.DataFrame(columns=GAP_COLUMNS)
+
+    since = re.search(r">= DATETIME\('([^']+)'\)", sql)
+    if since:
+        df = df[df[timestamp_col] >= pd.Timestamp(since.group(1))]
+
+    return find_gaps(df, timestamp_col, market_col, unique_col, step)
+
+
+def create_table_as_select(client: "FakeBigQueryClient", match: re.Match) -> pd.DataFrame:
+    """`utils.partition_util.migrate_table`, the copy keeps the schema of the source table"""
+    new_id, timestamp_col, partition_type, market_col, source_id = match.groups()
+    source = client.get_table(source_id)
+    table = bigquery.Table(new_id, schema=source.schema)
+    table.time_partitioning = bigquery.TimePartitioning(type_=partition_type, field=timestamp_col)
+    table.clustering_fields = [market_col]
+    client.create_table(table)
+    client.load_table_from_dataframe(client.table_data(source_id), new_id)
+    return pd.DataFrame()
+
+
+def rename_table(client: "FakeBigQueryClient", match: re.Match) -> pd.DataFrame:
+    table_id, new_name = match.groups()
+    new_id = f"{table_id.rsplit('.', 1)[0]}.{new_name}"
+    with client.lock:
+        table = client.tables.pop(table_id)
+        client.tables[new_id] = bigquery.Table(new_id, schema=table.schema)
+        client.tables[new_id].time_partitioning = table.time_partitioning
+        client.tables[new_id].clustering_fields = table.clustering_fields
+        client.data[new_id] = client.data.pop(table_id)
+    return pd.DataFrame()
+
+
+def drop_table(client: "FakeBigQueryClient", match: re.Match) -> pd.DataFrame:
+    with client.lock:
+        client.tables.pop(match.group(1))
+        client.data.pop(match.group(1))
+    return pd.DataFrame()
+
+
+def _key_columns(sql: str) -> List[str]:
+    return [column.strip() for column in re.search(r"PARTITION BY (.+?) ORDER BY", sql).group(1).split(",")]
+
+
+def _plain_keys(df: pd.DataFrame, key_columns: List[str]) -> pd.DataFrame:
+    """categorical keys (compact frames) as strings, so that keys of different frames compare"""
+    df = df.copy()
+    for column in key_columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype(str)
+    return df
+
+
+def _dedup(df: pd.DataFrame, key_columns: List[str]) -> pd.DataFrame:
+    """`utils.merge_util.dedup_select`: one row per key, the one with the fewest NULLs"""
+    value_columns = [column for column in df.columns if column not in key_columns]
+    nulls = df[value_columns].isna().sum(axis=1)
+    order = np.argsort(nulls.to_numpy(), kind="stable")
+    return df.iloc[order].drop_duplicates(key_columns).sort_index().reset_index(drop=True)
+
+
+def merge(client: "FakeBigQueryClient", match: re.Match) -> pd.DataFrame:
+    """`utils.merge_util.merge_query`, the partition filter of the ON clause is ignored"""
+    table_id, staging_id = match.groups()
+    key_columns = _key_columns(match.string)
+
+    source = _dedup(_plain_keys(client.table_data(staging_id), key_columns), key_columns)
+    target = client.table_data(table_id)
+
+    if target.empty:
+        result = source
+    else:
+        target = _plain_keys(target, key_columns)
+        value_columns = [column for column in target.columns if column not in key_columns]
+
+        target_keys = pd.MultiIndex.from_frame(target[key_columns])
+        source_keys = pd.MultiIndex.from_frame(source[key_columns])
+        matched = target_keys.isin(source_keys)
+
+        # WHEN MATCHED AND S has no more NULLs than T THEN UPDATE
+        updates = source.set_index(key_columns).reindex(target_keys[matched])
+        update = (
+            updates[value_columns].isna().sum(axis=1).to_numpy()
+            <= target.loc[matched, value_columns].isna().sum(axis=1).to_numpy()
+        )
+        rows = target.index[np.flatnonzero(matched)[update]]
+        for column in value_columns:
+            target.loc[rows, column] = updates[column].to_numpy()[update]
+
+        # WHEN NOT MATCHED THEN INSERT
+        inserted = source[~source_keys.isin(target_keys)]
+        result = pd.concat([target, inserted], ignore_index=True)
+
+    with client.lock:
+        client.data[table_id] = [result]
+    return pd.DataFrame()
+
+
+def duplicates(client: "FakeBigQueryClient", match: re.Match) -> pd.DataFrame:
+    """`utils.merge_util.duplicates_query`"""
+    table_id, keys = match.groups()
+    df = client.table_data(table_id)
+    count = 0 if df.empty else int(df.duplicated([key.strip() for key in keys.split(",")]).sum())
+    return pd.DataFrame({"duplicates": [count]})
+
+
+def compact(client: "FakeBigQueryClient", match: re.Match) -> pd.DataFrame:
+    """`utils.merge_util.compact_query`, the table keeps its metadata"""
+    table_id = match.group(1)
+    key_columns = _key_columns(match.string)
+    df = client.table_data(table_id)
+    if not df.empty:
+        df = _dedup(_plain_keys(df, key_columns), key_columns)
+    with client.lock:
+        client.data[table_id] = [df]
+    return pd.DataFrame()
+
+
+QUERY_HANDLERS: List[Tuple[re.Pattern, Callable]] = [
+    (re.compile(r"MERGE `([\w.-]+)` T\s+USING \(\s+SELECT [^()]*TRUE AS _delete", re.DOTALL), compact),
+    (re.compile(r"MERGE `([\w.-]+)` T\s+USING \(.*?FROM `([\w.-]+)`", re.DOTALL), merge),
+    (re.compile(r"SUM\(n - 1\).*?FROM `([\w.-]+)` GROUP BY (.+?) HAVING", re.DOTALL), duplicates),
+    (
+        re.compile(
+            r"max\((\w+)\) as maxStartTime.*?FROM\s+`?([\w.-]+)`?\s+(WHERE .*?)?GROUP BY (\w+)",
+            re.IGNORECASE | re.DOTALL,
+        ),
+        watermark_query,
+    ),
+    (re.compile(r"LOGICAL_AND\((\w+) IS NULL\) AS is_null"), gap_query),
+    (
+        re.compile(
+            r"CREATE TABLE `([\w.-]+)`\s+PARTITION BY DATETIME_TRUNC\((\w+), (\w+)\)\s+CLUSTER BY (\w+)"
+            r"\s+AS SELECT \* FROM `([\w.-]+)`"
+        ),
+        create_table_as_select,
+    ),
+    (re.compile(r"ALTER TABLE `([\w.-]+)` RENAME TO `(\w+)`"), rename_table),
+    (re.compile(r"DROP TABLE `([\w.-]+)`"), drop_table),
+]
+
+
+class FakeBigQueryClient:
+    """the subset of `bigquery.Client` used by `DataDriver` and the sinks
+
+    :param project: the project of the datasets
+    """
+
+    def __init__(self, project: str = "replay-project"):
+        self.project = project
+        self.datasets = set()
+        self.tables: Dict[str, bigquery.Table] = {}
+        self.data: Dict[str, List[pd.DataFrame]] = {}
+        self.queries: List[str] = []
+        self.query_handlers = list(QUERY_HANDLERS)
+        # the error of the next load jobs, which then load nothing
+        self.load_error: dict = None
+        self.lock = threading.RLock()
+
+    def get_dataset(self, dataset_id: str):
+        if dataset_id not in self.datasets:
+            raise NotFound(f"Dataset {dataset_id}")
+        return bigquery.Dataset(f"{self.project}.{dataset_id}")
+
+    def create_dataset(self, dataset_id: str, exists_ok: bool = False):
+        with self.lock:
+            if dataset_id in self.datasets and not exists_ok:
+                raise Conflict(f"Already Exists: Dataset {self.project}:{dataset_id}")
+            self.datasets.add(dataset_id)
+        return bigquery.Dataset(f"{self.project}.{dataset_id}")
+
+    def create_table(self, table: bigquery.Table, exists_ok: bool = False) -> bigquery.Table:
+        key = _table_key(table)
+        with self.lock:
+            if key in self.tables and not exists_ok:
+                raise Conflict(f"Already Exists: Table {key}")
+            self.tables.setdefault(key, table)
+            self.data.setdefault(key, [])
+        return self.tables[key]
+
+    def get_table(self, table_id) -> bigquery.Table:
+        key = _table_key(table_id)
+        if key not in self.tables:
+            raise NotFound(f"Not found: Table {key}")
+        return self.tables[key]
+
+    def list_tables(self, dataset) -> List[bigquery.Table]:
+        prefix = f"{dataset}."
+        return [table for key, table in self.tables.items() if key.startswith(prefix)]
+
+    def delete_table(self, table, not_found_ok: bool = False):
+        key = _table_key(table)
+        with self.lock:
+            if key not in self.tables:
+                if not_found_ok:
+                    return
+                raise NotFound(f"Not found: Table {key}")
+            self.tables.pop(key)
+            self.data.pop(key, None)
+
+    def load_table_from_dataframe(self, df: pd.DataFrame, table, *args, job_config=None, **kwargs) -> FakeJob:
+        key = _table_key(table)
+        self.get_table(key)
+        if self.load_error is not None:
+            return FakeJob(error_result=self.load_error)
+        with self.lock:
+            if job_config is not None and job_config.write_disposition == bigquery.WriteDisposition.WRITE_TRUNCATE:
+                self.data[key] = []
+            self.data[key].append(df.copy())
+        return FakeJob()
+
+    def table_data(self, table_id: str) -> pd.DataFrame:
+        """everything loaded into the table so far"""
+        frames = [frame for frame in self.data.get(_table_key(table_id), []) if len(frame) > 0]
+        if len(frames) == 0:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+    def query(self, sql: str, *args, **kwargs) -> FakeJob:
+        with self.lock:
+            self.queries.append(sql)
+
+        for pattern, handler in self.query_handlers:
+            match = pattern.search(sql)
+            if match:
+                return FakeJob(handler(self, match))
+
+        raise NotImplementedError(f"FakeBigQueryClient can't answer: {sql[:200]}")
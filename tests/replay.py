@@ -0,0 +1,213 @@
+"""Record the HTTP responses the drivers get and replay them offline
+
+Everything going through `requests` (ccxt, dydx3, CoinAPI, the OKX downloader) and the aiohttp dYdX client is
+captured into a gzipped JSON cassette in record mode, and served from it in replay mode without touching the network.
+Responses are matched on the method and URL (secrets removed) and replayed in the order they were recorded.
+
+`datetime.now()` (and `date.today()`) is frozen in the drivers at the time of the recording, in the timezone of the
+recording, so a replay asks for the same ranges. Drivers converting naive datetimes with `.timestamp()` (ccxt's) still
+use the local timezone, those should be replayed in the timezone of the recording.
+
+Usage:
+    with replay("tests/fixtures/replay/binance_funding.json.gz", mode="record"):
+        driver = CCXTDriverFunding(...)
+        driver.fetch_data()
+"""
+import base64
+import gzip
+import importlib
+import json
+import threading
+from collections import defaultdict, deque
+from contextlib import ExitStack, contextmanager
+from datetime import date, datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterable, Tuple
+from unittest import mock
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from drivers.dydx_drivers.async_client import AsyncDydxClient
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures" / "replay"
+
+# left out of the request keys: secrets, and values changing on every call (the OKX listing's cache buster `t`)
+IGNORED_PARAMS = {"apikey", "api_key", "signature", "timestamp", "recvwindow", "t"}
+SKIPPED_HEADERS = {"set-cookie", "content-encoding", "transfer-encoding", "content-length"}
+
+# modules doing `from datetime import datetime` whose clock is frozen
+FROZEN_MODULES = [
+    "drivers.base",
+    "drivers.ccxt_driver.ccxt_base",
+    "drivers.ccxt_driver.ohlcv",
+    "drivers.ccxt_driver.funding",
+    "drivers.dydx_drivers.futures",
+    "drivers.dydx_drivers.funding",
+    "drivers.okx_drivers.webscraper.downloader",
+]
+
+
+class ReplayMissError(Exception):
+    """a request that isn't in the cassette, the 404 makes `RetryPolicy` give up right away"""
+
+    status_code = 404
+
+
+def request_key(method: str, url: str, body: bytes = None) -> str:
+    scheme, netloc, path, query, _ = urlsplit(url)
+    params = sorted(
+        (key, value) for key, value in parse_qsl(query, keep_blank_values=True) if key.lower() not in IGNORED_PARAMS
+    )
+    key = f"{method.upper()} {urlunsplit((scheme, netloc, path, urlencode(params), ''))}"
+    if body:
+        key += f" {body.decode(errors='replace') if isinstance(body, bytes) else body}"
+    return key
+
+
+class Cassette:
+    """recorded responses, by request key in the order they were received"""
+
+    def __init__(self, path: Path, recorded_at: datetime = None):
+        self.path = Path(path)
+        self.recorded_at = recorded_at
+        self.responses: Dict[str, deque] = defaultdict(deque)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: Path) -> "Cassette":
+        with gzip.open(path, "rt") as file:
+            data = json.load(file)
+
+        cassette = cls(path, datetime.fromisoformat(data["recorded_at"]))
+        for interaction in data["interactions"]:
+            cassette.responses[interaction["key"]].append(interaction)
+        return cassette
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        interactions = [interaction for responses in self.responses.values() for interaction in responses]
+        with gzip.open(self.path, "wt") as file:
+            json.dump(
+                {"recorded_at": self.recorded_at.isoformat(), "interactions": interactions},
+                file,
+            )
+
+    def record(self, key: str, status: int, headers: Iterable[Tuple[str, str]], body: bytes):
+        interaction = {
+            "key": key,
+            "status": status,
+            "headers": {name: value for name, value in headers if name.lower() not in SKIPPED_HEADERS},
+            "body": base64.b64encode(body).decode(),
+        }
+        with self.lock:
+            self.responses[key].append(interaction)
+
+    def play(self, key: str) -> Tuple[int, dict, bytes]:
+        with self.lock:
+            if not self.responses.get(key):
+                raise ReplayMissError(f"not in {self.path.name}: {key}")
+            interaction = self.responses[key].popleft()
+        return interaction["status"], interaction["headers"], base64.b64decode(interaction["body"])
+
+    def __len__(self):
+        return sum(len(responses) for responses in self.responses.values())
+
+
+def frozen_clock(recorded_at: datetime) -> Tuple[type, type]:
+    """`datetime` and `date` classes whose now/utcnow/today are `recorded_at` (timezone aware, naive times are the
+    wall clock of the recording)"""
+
+    class FrozenDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            if tz is None:
+                return recorded_at.replace(tzinfo=None)
+            return recorded_at.astimezone(tz)
+
+        @classmethod
+        def utcnow(cls):
+            return recorded_at.astimezone(timezone.utc).replace(tzinfo=None)
+
+    class FrozenDate(date):
+        @classmethod
+        def today(cls):
+            return recorded_at.date()
+
+    return FrozenDatetime, FrozenDate
+
+
+def _patch_requests(cassette: Cassette, mode: str):
+    send = HTTPAdapter.send
+
+    def replay_send(adapter, request, *args, **kwargs):
+        key = request_key(request.method, request.url, request.body)
+
+        if mode == "record":
+            response = send(adapter, request, *args, **kwargs)
+            cassette.record(key, response.status_code, response.headers.items(), response.content)
+            return response
+
+        status, headers, body = cassette.play(key)
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = body
+        response._content_consumed = True
+        response.url = request.url
+        response.request = request
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        return response
+
+    return mock.patch.object(HTTPAdapter, "send", replay_send)
+
+
+def _patch_aiohttp(cassette: Cassette, mode: str):
+    get_once = AsyncDydxClient._get_once
+
+    async def replay_get_once(client, path: str, params: dict) -> dict:
+        key = request_key("GET", f"{client.host}{path}?{urlencode(params)}")
+
+        if mode == "record":
+            data = await get_once(client, path, params)
+            cassette.record(key, 200, [], json.dumps(data).encode())
+            return data
+
+        await client.rate_limiter.acquire()
+        client.requests += 1
+        return json.loads(cassette.play(key)[2])
+
+    return mock.patch.object(AsyncDydxClient, "_get_once", replay_get_once)
+
+
+@contextmanager
+def replay(path: Path, mode: str = "replay"):
+    """serve the drivers' HTTP requests from the cassette at `path`, or record them into it
+
+    :param path: the cassette file
+    :param mode: `replay` or `record`
+    """
+    if mode == "record":
+        cassette = Cassette(path, recorded_at=datetime.now(timezone.utc).astimezone())
+    elif mode == "replay":
+        cassette = Cassette.load(path)
+    else:
+        raise ValueError(f"unknown replay mode {mode}")
+
+    with ExitStack() as stack:
+        stack.enter_context(_patch_requests(cassette, mode))
+        stack.enter_context(_patch_aiohttp(cassette, mode))
+
+        frozen_datetime, frozen_date = frozen_clock(cassette.recorded_at)
+        for name in FROZEN_MODULES:
+            module = importlib.import_module(name)
+            stack.enter_context(mock.patch.object(module, "datetime", frozen_datetime))
+            if getattr(module, "date", None) is date:
+                stack.enter_context(mock.patch.object(module, "date", frozen_date))
+
+        yield cassette
+
+    if mode == "record":
+        cassette.save()
@@ -0,0 +1,68 @@
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import bigquery
+from google.oauth2 import service_account
+
+from drivers.base import DataDriver
+from utils import bigquery_util
+from utils.bigquery_util import ensure_once, get_bigquery_client
+
+
+class DummyDriver(DataDriver):
+    schema = []
+    possible_resolutions = ["1h"]
+    period_to_pandas = {"1h": "1h"}
+
+    def fetch_data(self):
+        pass
+
+
+def test_client_is_shared_per_project():
+    credentials = AnonymousCredentials()
+
+    client = get_bigquery_client("test-project-shared", credentials=credentials)
+
+    assert get_bigquery_client("test-project-shared") is client
+    assert get_bigquery_client("test-project-other", credentials=credentials) is not client
+
+
+def test_service_account_session_is_scoped():
+    # unscoped, as built by `get_bigquery_credentials`, nothing is signed before a request
+    credentials = service_account.Credentials(
+        signer=None,
+        service_account_email="uploader@test-project.iam.gserviceaccount.com",
+        token_uri="https://oauth2.googleapis.com/token",
+    )
+
+    client = get_bigquery_client("test-project-scoped", credentials=credentials)
+
+    # the session refreshes its own token, an unscoped JWT grant is rejected with invalid_scope
+    assert tuple(client._http.credentials.scopes) == tuple(bigquery.Client.SCOPE)
+    assert client._http.credentials is client._credentials
+
+
+def test_ensure_once_retries_after_failure():
+    calls = []
+
+    def create():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("transient")
+
+    try:
+        ensure_once(("table", "test.ensure.once"), create)
+    except RuntimeError:
+        pass
+
+    ensure_once(("table", "test.ensure.once"), create)
+    ensure_once(("table", "test.ensure.once"), create)
+
+    assert len(calls) == 2
+
+
+def test_driver_creates_no_client_until_used(monkeypatch):
+    monkeypatch.setenv("WATERMARK_DB_PATH", "")
+    clients_before = dict(bigquery_util._clients)
+
+    DummyDriver(dataset_id="dataset", table_name="table", timeframe="1h")
+
+    assert bigquery_util._clients == clients_before
@@ -0,0 +1,80 @@
+from datetime import datetime
+
+import pandas as pd
+
+from drivers.base import PARTIAL_FETCH
+from tests.test_bigquery_util import DummyDriver
+from utils.cache_util import CandleCache
+
+
+KEY = ("binance", "future", "1h", "BTC/USDT:USDT")
+
+
+def make_candles(start, periods):
+    return pd.DataFrame(
+        {
+            "startTime": pd.date_range(start, periods=periods, freq="1h"),
+            "close": range(periods),
+        }
+    )
+
+
+def test_only_missing_ranges_are_fetched(tmp_path):
+
+    cache = CandleCache(tmp_path, timestamp_col="startTime")
+
+    start, end = datetime(2023, 1, 1), datetime(2023, 1, 2)
+    assert cache.missing_ranges(KEY, start, end) == [(pd.Timestamp(start), pd.Timestamp(end))]
+    assert cache.metrics.misses == 1
+
+    cache.write(KEY, make_candles("2023-01-01 06:00", 6), datetime(2023, 1, 1, 6), datetime(2023, 1, 1, 12))
+
+    assert cache.missing_ranges(KEY, start, end) == [
+        (pd.Timestamp(start), pd.Timestamp("2023-01-01 06:00")),
+        (pd.Timestamp("2023-01-01 12:00"), pd.Timestamp(end)),
+    ]
+
+    # adjacent ranges are merged into one file
+    cache.write(KEY, make_candles("2023-01-01 12:00", 12), datetime(2023, 1, 1, 12), end)
+    assert cache.covered_ranges(KEY) == [(pd.Timestamp("2023-01-01 06:00"), pd.Timestamp(end))]
+
+    df = cache.read(KEY, datetime(2023, 1, 1, 10), datetime(2023, 1, 1, 14))
+    assert df["startTime"].tolist() == list(pd.date_range("2023-01-01 10:00", periods=4, freq="1h"))
+    assert cache.metrics.hits == 1
+
+
+def test_least_recently_used_files_are_evicted(tmp_path):
+
+    cache = CandleCache(tmp_path, timestamp_col="startTime")
+
+    cache.write(("okx",) + KEY[1:], make_candles("2023-01-01", 24), datetime(2023, 1, 1), datetime(2023, 1, 2))
+    size = cache.size_bytes()
+
+    cache.max_size_bytes = int(size * 1.5)
+    cache.write(KEY, make_candles("2023-01-01", 24), datetime(2023, 1, 1), datetime(2023, 1, 2))
+
+    assert cache.metrics.evictions == 1
+    assert cache.covered_ranges(("okx",) + KEY[1:]) == []
+    assert len(cache.covered_ranges(KEY)) == 1
+
+
+def test_partial_fetches_are_only_cached_from_their_earliest_candle(tmp_path, monkeypatch):
+    monkeypatch.setenv("CANDLE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("WATERMARK_DB_PATH", "")
+    driver = DummyDriver(dataset_id="dataset", table_name="table", timeframe="1h")
+
+    def failing_fetch(market, from_time_dt, to_time_dt):
+        # the newest 6 candles, the older pages failed
+        df = make_candles("2023-01-01 18:00", 6)
+        df.attrs[PARTIAL_FETCH] = True
+        return df
+
+    driver.fetch_with_cache("BTC", datetime(2023, 1, 1), datetime(2023, 1, 2), failing_fetch)
+
+    key = driver.cache_key("BTC")
+    # the latest candle isn't cached either, the older part is fetched again next time
+    assert driver.candle_cache.covered_ranges(key) == [
+        (pd.Timestamp("2023-01-01 18:00"), pd.Timestamp("2023-01-01 23:00"))
+    ]
+    missing = driver.candle_cache.missing_ranges(key, datetime(2023, 1, 1), datetime(2023, 1, 2))
+    assert missing[0] == (pd.Timestamp("2023-01-01"), pd.Timestamp("2023-01-01 18:00"))
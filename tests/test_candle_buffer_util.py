@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.candle_buffer_util import CandleBuffer, to_epoch_ms
+
+
+def test_prepend_and_append_keep_order_across_growth():
+    buffer = CandleBuffer(["close"], capacity=4)
+
+    buffer.append(timestamps=[10, 11], close=[1.0, 1.1])
+    for start in range(8, -12, -2):
+        buffer.prepend_rows([[start, start / 10], [start + 1, (start + 1) / 10]])
+    buffer.append_rows([[12, "1.2"]])
+
+    assert buffer.timestamps.tolist() == list(range(-10, 13))
+    np.testing.assert_allclose(buffer.column("close"), np.arange(-10, 13) / 10)
+    assert buffer.capacity >= len(buffer) == 23
+    assert buffer.nbytes == 23 * 16
+
+
+def test_to_frame_and_missing_fields():
+    buffer = CandleBuffer(["open", "close"])
+    buffer.append_rows([[1672531200000, 1, 2, "ignored"]])
+
+    df = buffer.to_frame(timestamp_col="startTime")
+
+    assert df.columns.tolist() == ["startTime", "open", "close"]
+    assert df["startTime"].iloc[0] == pd.Timestamp("2023-01-01")
+
+    with pytest.raises(ValueError):
+        buffer.append(timestamps=[0], open=[1.0])
+
+
+def test_to_epoch_ms_converts_to_utc():
+    assert to_epoch_ms(["2023-01-01T01:00:00.000Z"]).tolist() == [1672534800000]
+
+    paris = pd.DatetimeIndex([pd.Timestamp("2023-01-01 02:00", tz="Europe/Paris")])
+    assert to_epoch_ms(paris).tolist() == [1672534800000]
+
+    naive = pd.DatetimeIndex([pd.Timestamp("2023-01-01 01:00")])
+    assert to_epoch_ms(naive).tolist() == [1672534800000]
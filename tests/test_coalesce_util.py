@@ -0,0 +1,105 @@
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from tests.fake_bigquery import FakeBigQueryClient
+from tests.test_bigquery_util import DummyDriver
+from utils.bigquery_util import set_bigquery_client
+from utils.coalesce_util import UploadCoalescer, arrow_nbytes
+
+
+def candles(ticker: str, n: int = 100, start: str = "2023-01-01") -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "startTime": pd.date_range(start, periods=n, freq="h"),
+            "ticker": ticker,
+            "close": range(n),
+        }
+    )
+
+
+def test_frames_are_batched_by_arrow_size():
+    frame_bytes = arrow_nbytes(candles("T0"))
+    batches = []
+    coalescer = UploadCoalescer(batches.append, target_bytes=frame_bytes * 3, max_age_s=60)
+
+    for i in range(7):
+        coalescer.add(candles(f"T{i}"))
+    coalescer.close()
+
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert coalescer.metrics.rows == 700
+    assert coalescer.inflight_bytes == 0
+
+
+def test_old_frames_are_flushed_without_waiting_for_a_full_batch():
+    flushed = threading.Event()
+    coalescer = UploadCoalescer(lambda frames: flushed.set(), target_bytes=10**9, max_age_s=0.05)
+
+    coalescer.add(candles("BTC"))
+
+    assert flushed.wait(2)
+    coalescer.close()
+
+
+def test_inflight_memory_is_bounded():
+    frame_bytes = arrow_nbytes(candles("T0"))
+    release = threading.Event()
+    inflight = []
+
+    def slow_flush(frames):
+        release.wait(5)
+
+    coalescer = UploadCoalescer(
+        slow_flush, target_bytes=frame_bytes, max_age_s=60, max_inflight_bytes=frame_bytes * 2
+    )
+
+    def fetch():
+        for i in range(6):
+            coalescer.add(candles(f"T{i}"))
+            inflight.append(coalescer.inflight_bytes)
+
+    thread = threading.Thread(target=fetch)
+    thread.start()
+    time.sleep(0.2)
+
+    # the first flush is stuck, the fetching thread waits instead of buffering everything
+    assert thread.is_alive()
+    assert len(inflight) == 2
+
+    release.set()
+    thread.join(5)
+    coalescer.close()
+
+    assert max(inflight) <= frame_bytes * 2
+    assert coalescer.metrics.waits > 0
+
+
+def test_upload_errors_are_raised_to_the_fetching_threads():
+    def failing_flush(frames):
+        raise ValueError("quota exceeded")
+
+    coalescer = UploadCoalescer(failing_flush, target_bytes=1, max_age_s=60)
+    coalescer.add(candles("BTC"))
+
+    with pytest.raises(ValueError, match="quota exceeded"):
+        coalescer.close()
+
+
+def test_markets_are_uploaded_together(monkeypatch):
+    monkeypatch.setenv("WATERMARK_DB_PATH", "")
+    monkeypatch.setenv("project_id", "coalesced-project")
+    client = FakeBigQueryClient("coalesced-project")
+    set_bigquery_client("coalesced-project", client)
+
+    driver = DummyDriver(dataset_id="dataset", table_name="table", timeframe="1h")
+    for ticker in ["BTC", "ETH", "SOL"]:
+        driver.queue_upload(candles(ticker), unique_col="close")
+    driver.commit_uploads()
+
+    # one load job for the three markets
+    assert len(client.data["coalesced-project.dataset.table"]) == 1
+    uploaded = client.table_data("coalesced-project.dataset.table")
+    assert uploaded.groupby("ticker").size().to_dict() == {"BTC": 100, "ETH": 100, "SOL": 100}
@@ -0,0 +1,110 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from utils import coinAPI_util
+from utils.coinAPI_util import CoinAPI
+
+RESPONSES = {
+    "/v1/exchanges": [{"exchange_id": "BINANCEFTS", "name": "Binance Futures", "volume_1day_usd": 1.0}],
+    "/v1/symbols/BINANCEFTS": [
+        {
+            "symbol_id": "BINANCEFTS_PERP_BTC_USDT",
+            "exchange_id": "BINANCEFTS",
+            "symbol_type": "PERPETUAL",
+            "symbol_id_exchange": "BTCUSDT",
+            "asset_id_base_exchange": "BTC",
+            "asset_id_quote_exchange": "USDT",
+            "data_trade_start": "2019-09-08T00:00:00.0000000Z",
+            "data_trade_end": "2023-01-20T00:00:00.0000000Z",
+            "volume_1hrs": 123.0,
+        },
+        {
+            "symbol_id": "BINANCEFTS_SPOT_BTC_USDT",
+            "exchange_id": "BINANCEFTS",
+            "symbol_type": "SPOT",
+            "symbol_id_exchange": "BTCUSDT",
+            "asset_id_base_exchange": "BTC",
+            "asset_id_quote_exchange": "USDT",
+        },
+    ],
+}
+
+
+class CoinAPIHandler(BaseHTTPRequestHandler):
+    """stand-in for the CoinAPI REST API with ETag support"""
+
+    requests_log = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        etag = f'"{self.path}"'
+        self.requests_log.append((self.path, self.headers.get("If-None-Match")))
+
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = json.dumps(RESPONSES[self.path]).encode()
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    CoinAPIHandler.requests_log = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), CoinAPIHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def make_client(server, cache_dir, ttl_seconds=3600):
+    client = CoinAPI(cache_dir=cache_dir, ttl_seconds=ttl_seconds)
+    client.enpoint = server
+    return client
+
+
+def test_catalog_is_fetched_once_and_pruned(server, tmp_path):
+
+    assets = make_client(server, tmp_path).get_all_assets_for_exchange("BINANCEFTS", "PERPETUAL")
+
+    assert assets["symbol_id_exchange"].tolist() == ["BTCUSDT"]
+    assert "volume_1hrs" not in assets.columns
+    assert str(assets["data_trade_start"].iloc[0].date()) == "2019-09-08"
+    assert len(CoinAPIHandler.requests_log) == 2
+
+    # another driver in the same process
+    make_client(server, tmp_path).get_all_assets_for_exchange("BINANCEFTS", "SPOT")
+    assert len(CoinAPIHandler.requests_log) == 2
+
+    # a new process starts from the snapshot
+    coinAPI_util._catalog.clear()
+    assets = make_client(server, tmp_path).get_all_assets_for_exchange("BINANCEFTS", "PERPETUAL")
+    assert assets["symbol_id_exchange"].tolist() == ["BTCUSDT"]
+    assert len(CoinAPIHandler.requests_log) == 2
+
+
+def test_expired_catalog_is_revalidated_with_etag(server, tmp_path):
+
+    make_client(server, tmp_path).get_all_assets_for_exchange("BINANCEFTS", "PERPETUAL")
+
+    assets = make_client(server, tmp_path, ttl_seconds=0).get_all_assets_for_exchange(
+        "BINANCEFTS", "PERPETUAL"
+    )
+
+    assert assets["symbol_id_exchange"].tolist() == ["BTCUSDT"]
+    assert CoinAPIHandler.requests_log[2:] == [
+        ("/v1/exchanges", '"/v1/exchanges"'),
+        ("/v1/symbols/BINANCEFTS", '"/v1/symbols/BINANCEFTS"'),
+    ]
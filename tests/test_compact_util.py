@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+from google.cloud import bigquery
+
+from utils.compact_util import (
+    PRICE_COLUMNS,
+    compact_dtypes,
+    concat_compact,
+    constant_category,
+    from_compact,
+    to_compact,
+)
+
+SCHEMA = [
+    bigquery.SchemaField(name="startTime", field_type="DATETIME", mode="REQUIRED"),
+    bigquery.SchemaField(name="ticker", field_type="STRING", mode="REQUIRED"),
+    bigquery.SchemaField(name="close", field_type="FLOAT", mode="REQUIRED"),
+    bigquery.SchemaField(name="volume", field_type="FLOAT", mode="NULLABLE"),
+    bigquery.SchemaField(name="trades", field_type="INTEGER", mode="NULLABLE"),
+]
+
+
+def make_market(ticker: str) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "startTime": pd.date_range("2023-01-01", periods=3, freq="1h"),
+            "ticker": constant_category(ticker, 3),
+            "close": [1.5, 2.5, 3.5],
+            "volume": [10.0, np.nan, 30.0],
+            "trades": [1, 2, 3],
+        }
+    )
+
+
+def test_schema_mapping():
+    assert compact_dtypes(SCHEMA) == {
+        "startTime": "int64",
+        "ticker": "category",
+        "close": "float64",
+        "volume": "float64",
+        "trades": "Int64",
+    }
+    assert compact_dtypes(SCHEMA, PRICE_COLUMNS)["close"] == "float32"
+
+
+def test_round_trip_keeps_values_and_categories():
+    frames = [to_compact(make_market(ticker), compact_dtypes(SCHEMA, PRICE_COLUMNS)) for ticker in ["BTC", "ETH"]]
+
+    df = concat_compact(frames)
+
+    assert df["startTime"].dtype == np.int64
+    assert df["startTime"].iloc[0] == 1672531200000
+    assert isinstance(df["ticker"].dtype, pd.CategoricalDtype)
+    assert df["ticker"].tolist() == ["BTC"] * 3 + ["ETH"] * 3
+    assert df["close"].dtype == np.float32
+
+    expanded = from_compact(df, ["startTime"])
+
+    assert expanded["startTime"].tolist() == make_market("BTC")["startTime"].tolist() * 2
+    assert expanded["close"].dtype == np.float64
+    # 1.5 and friends are exact in float32
+    assert expanded["close"].tolist() == [1.5, 2.5, 3.5] * 2
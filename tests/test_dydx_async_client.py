@@ -0,0 +1,143 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from drivers.dydx_drivers.async_client import (
+    AsyncDydxClient,
+    AsyncRateLimiter,
+    fetch_history,
+    parse_iso,
+    time_slices,
+    to_iso,
+)
+from utils.retry_util import RetryPolicy
+
+HOUR = timedelta(hours=1)
+LISTED = datetime(2022, 12, 1)
+NOW = datetime(2023, 1, 20)
+
+
+def candle(started_at: datetime) -> dict:
+    """a page row as recorded from /v3/candles"""
+    close = str(1000 + (started_at - LISTED) // HOUR)
+    return {
+        "startedAt": to_iso(started_at),
+        "updatedAt": to_iso(started_at + HOUR),
+        "market": "BTC-USD",
+        "resolution": "1HOUR",
+        "low": close,
+        "high": close,
+        "open": close,
+        "close": close,
+        "baseTokenVolume": "1.5",
+        "trades": "10",
+        "usdVolume": "1500",
+        "startingOpenInterest": "100",
+    }
+
+
+def make_app(requests_log: list, fail_first: int = 0, halt: tuple = None) -> web.Application:
+    """fake /v3/candles of a market listed at LISTED, without candles in [halt[0], halt[1]) if set"""
+    failures = [fail_first]
+
+    async def candles(request):
+        requests_log.append(dict(request.query))
+
+        if failures[0] > 0:
+            failures[0] -= 1
+            return web.json_response({"errors": [{"msg": "rate limited"}]}, status=429)
+
+        from_time = max(parse_iso(request.query["fromISO"]), LISTED)
+        to_time = min(parse_iso(request.query["toISO"]), NOW)
+        limit = int(request.query["limit"])
+
+        rows = []
+        t = to_time.replace(minute=0, second=0)
+        while t >= from_time and len(rows) < limit:
+            if halt is None or not halt[0] <= t < halt[1]:
+                rows.append(candle(t))
+            t -= HOUR
+        return web.json_response({"candles": rows})
+
+    app = web.Application()
+    app.router.add_get("/v3/candles/{market}", candles)
+    return app
+
+
+async def fetch_candles(requests_log, from_time, to_time, fail_first=0, concurrency=8, halt=None):
+    server = TestServer(make_app(requests_log, fail_first, halt))
+    await server.start_server()
+    try:
+        policy = RetryPolicy(base_delay=0.01, max_delay=0.02)
+        async with AsyncDydxClient(host=str(server.make_url("/")), retry_policy=policy) as client:
+
+            def fetch_page(start, end):
+                return client.get_candles("BTC-USD", "1HOUR", to_iso(start), to_iso(end))
+
+            rows = await fetch_history(
+                fetch_page, from_time, to_time, HOUR, "startedAt", concurrency=concurrency
+            )
+        return rows, policy
+    finally:
+        await server.close()
+
+
+def test_slices_are_merged_in_order():
+    requests_log = []
+
+    rows, _ = asyncio.run(fetch_candles(requests_log, datetime(2010, 1, 1), NOW))
+
+    times = [parse_iso(row["startedAt"]) for row in rows]
+    expected_hours = (NOW - LISTED) // HOUR
+    assert len(times) == expected_hours
+    assert times[0] == LISTED and times[-1] == NOW - HOUR
+    assert times == sorted(times)
+
+    # 12 slices with data over 2 batches of 8, then a batch of 8 empty slices and a request finding nothing older
+    # before the listing stop the fetch
+    assert len(requests_log) == 25
+
+
+def test_resumes_after_a_halt_longer_than_a_batch():
+    halt = (datetime(2022, 12, 20), datetime(2023, 1, 5))
+    requests_log = []
+
+    rows, _ = asyncio.run(fetch_candles(requests_log, datetime(2010, 1, 1), NOW, concurrency=2, halt=halt))
+
+    times = [parse_iso(row["startedAt"]) for row in rows]
+    assert times[0] == LISTED
+    assert times[-1] == NOW - HOUR
+    assert len(times) == (NOW - LISTED) // HOUR - (halt[1] - halt[0]) // HOUR
+
+
+def test_matches_a_serial_fetch_and_retries():
+    serial_log, parallel_log = [], []
+
+    serial, _ = asyncio.run(fetch_candles(serial_log, LISTED, NOW, concurrency=1))
+    parallel, policy = asyncio.run(fetch_candles(parallel_log, LISTED, NOW, fail_first=2))
+
+    assert parallel == serial
+    assert policy.metrics.retries == 2
+    assert policy.metrics.reasons == {"rate_limit": 2}
+
+
+def test_time_slices_cover_the_range_newest_first():
+    slices = time_slices(datetime(2023, 1, 1), datetime(2023, 1, 10, 5), HOUR)
+
+    assert slices[0] == (datetime(2023, 1, 6, 1), datetime(2023, 1, 10, 5))
+    assert slices[-1][0] == datetime(2023, 1, 1)
+    assert all(newer[0] == older[1] for newer, older in zip(slices, slices[1:]))
+
+
+def test_rate_limiter_spaces_requests():
+    async def run():
+        limiter = AsyncRateLimiter(max_requests=5, period_s=0.2)
+        start = time.monotonic()
+        await asyncio.gather(*(limiter.acquire() for _ in range(12)))
+        return time.monotonic() - start
+
+    # 5 right away, 5 after one window, 2 after two windows
+    assert 0.4 <= asyncio.run(run()) < 1.0
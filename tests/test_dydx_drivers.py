@@ -0,0 +1,56 @@
+import pandas as pd
+import pytest
+
+from drivers.dydx_drivers.funding import DYDXFunding
+from drivers.dydx_drivers.futures import DYDXFutures
+from utils.retry_util import RetryPolicy
+
+MARKETS = ["BTC-USD", "ETH-USD", "LUNA-USD"]
+
+
+class ApiError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+def make_driver(driver_class, failing: dict):
+    """a dYdX driver without BigQuery, `failing` markets raise their error"""
+    driver = driver_class.__new__(driver_class)
+    driver.markets = pd.DataFrame(columns=MARKETS)
+    driver.market_concurrency = 2
+    driver.retry_policy = RetryPolicy()
+    driver.TABLE_ID = "project.dydx.table"
+    driver.get_latest_date = lambda tickers: pd.DataFrame(columns=["ticker", "maxStartTime"])
+
+    driver.queued, driver.commits = [], 0
+
+    async def fetch(market):
+        if market in failing:
+            raise failing[market]
+        return pd.DataFrame({"ticker": [market], "startTime": [pd.Timestamp("2023-01-01")]})
+
+    def commit_uploads():
+        driver.commits += 1
+
+    driver.fetch_with_cache_async = lambda market, **kwargs: fetch(market)
+    driver.get_funding_df = lambda client, market_str, **kwargs: fetch(market_str)
+    driver.queue_upload = lambda df, unique_col: driver.queued.append(df["ticker"].iloc[0])
+    driver.commit_uploads = commit_uploads
+    driver.report_instrumentation = lambda: None
+    return driver
+
+
+@pytest.mark.parametrize("driver_class", [DYDXFutures, DYDXFunding])
+def test_failed_markets_are_raised_once_the_others_are_committed(driver_class):
+    driver = make_driver(
+        driver_class,
+        # out of retries on rate limits, and a delisted market
+        failing={"ETH-USD": ApiError(429), "LUNA-USD": ApiError(404)},
+    )
+
+    with pytest.raises(RuntimeError, match="2/3 markets of project.dydx.table: ETH-USD, LUNA-USD"):
+        driver.fetch_data(upload=True, upload_one_at_a_time=True)
+
+    assert driver.queued == ["BTC-USD"]
+    assert driver.commits == 1
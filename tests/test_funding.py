@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+
+from drivers.ccxt_driver.funding import CCXTDriverFunding, page_funding_forward
+from tests.test_symbol_index_util import MARKETS, catalog
+from utils.gap_util import FetchRange
+from utils.retry_util import RetryPolicy
+from utils.symbol_index_util import SymbolIndex
+
+HOURS_8_MS = 8 * 3600 * 1000
+
+
+def make_exchange(markets, settlements, limit):
+    """fake all-markets funding endpoint, every market settles at the same times"""
+    calls = []
+
+    def fetch_page(since):
+        calls.append(since)
+        rates = [
+            {"symbol": market, "timestamp": ts, "fundingRate": 0.0001}
+            for ts in range(0, settlements * HOURS_8_MS, HOURS_8_MS)
+            for market in markets
+            if ts >= since
+        ]
+        return rates[:limit]
+
+    return fetch_page, calls
+
+
+def test_pages_split_in_the_middle_of_a_settlement():
+    markets = [f"M{i}/USDT:USDT" for i in range(7)]
+    fetch_page, calls = make_exchange(markets, settlements=6, limit=10)
+
+    rates, requests = page_funding_forward(fetch_page, HOURS_8_MS, limit=10)
+
+    # 5 settlements of 7 markets, without duplicates
+    assert sorted((rate["symbol"], rate["timestamp"]) for rate in rates) == sorted(
+        (market, ts) for ts in range(HOURS_8_MS, 6 * HOURS_8_MS, HOURS_8_MS) for market in markets
+    )
+    assert requests == len(calls) == 5
+
+
+def test_daily_update_is_a_single_request():
+    markets = [f"M{i}/USDT:USDT" for i in range(300)]
+    fetch_page, calls = make_exchange(markets, settlements=30, limit=1000)
+
+    rates, requests = page_funding_forward(fetch_page, 27 * HOURS_8_MS, limit=1000)
+
+    assert len(rates) == 3 * 300
+    assert requests == 1
+
+
+def test_stops_when_a_settlement_is_larger_than_a_page():
+    fetch_page, calls = make_exchange([f"M{i}" for i in range(20)], settlements=2, limit=10)
+
+    rates, requests = page_funding_forward(fetch_page, HOURS_8_MS, limit=10)
+
+    # rather than asking for the same page forever
+    assert requests == 1
+    assert len(rates) == 10
+
+
+def make_driver(symbols: dict = None) -> CCXTDriverFunding:
+    """a funding driver without exchange, every market up to date and nothing uploaded"""
+    driver = CCXTDriverFunding.__new__(CCXTDriverFunding)
+    driver._symbol_index = SymbolIndex.build(catalog(), MARKETS, exchange_id="binance", instrument_type="future")
+    driver.TABLE_ID = "project.binance.funding_future_8h"
+    driver.unified_market_name = "ticker"
+    driver.timeframe_timedelta = timedelta(hours=8)
+    driver.max_workers = 1
+    driver.upload_data = False
+    driver.retry_policy = RetryPolicy()
+
+    driver.get_symbols = lambda: symbols or {}
+    driver.get_latest_date = lambda tickers: pd.DataFrame(columns=["ticker", "maxStartTime"])
+    driver.get_gap_plan = lambda unique_col, since=None: []
+    driver.commits = 0
+    driver.commit_uploads = lambda: setattr(driver, "commits", driver.commits + 1)
+    driver.report_instrumentation = lambda: ""
+    return driver
+
+
+def test_gaps_are_fetched_with_the_exchange_ids():
+    driver = make_driver()
+    driver.get_gap_plan = lambda unique_col, since=None: [
+        FetchRange("ETH/USDT:USDT", datetime(2023, 1, 1), datetime(2023, 1, 2)),
+        FetchRange("LUNAUSDT", datetime(2022, 5, 1), datetime(2022, 5, 2)),
+    ]
+
+    fetched = []
+
+    def fetch(market, from_time_dt, to_time_dt):
+        fetched.append((market, from_time_dt, to_time_dt))
+        return pd.DataFrame()
+
+    driver.get_data_foreach_market(fetch, unique_col="fundingRate", repair_gaps=True)
+
+    # the end of a gap is the next stored rate
+    assert sorted(fetched) == [
+        ("ETHUSDT", datetime(2023, 1, 1), datetime(2023, 1, 1, 16)),
+        ("LUNAUSDT", datetime(2022, 5, 1), datetime(2022, 5, 1, 16)),
+    ]
+
+
+def test_failed_markets_are_raised_once_the_others_are_committed():
+    driver = make_driver({"BTC-USDT-SWAP": "BTCUSDT", "ETH-USDT-SWAP": "ETHUSDT"})
+    fetched = []
+
+    def fetch(market, from_time_dt, to_time_dt):
+        if market == "ETHUSDT":
+            raise ConnectionError("503 Service Unavailable")
+        fetched.append(market)
+        return pd.DataFrame()
+
+    with pytest.raises(RuntimeError, match="1/2 markets .*: ETHUSDT"):
+        driver.get_data_foreach_market(fetch, unique_col="fundingRate")
+
+    assert fetched == ["BTCUSDT"]
+    assert driver.commits == 1
@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from utils.gap_util import FetchRange, find_gaps, gap_query, plan_fetches
+
+HOUR = timedelta(hours=1)
+
+
+def make_series():
+    times = pd.date_range("2023-01-01", periods=10, freq="1h")
+    btc = pd.DataFrame({"startTime": times, "ticker": "BTC", "close": np.arange(10.0)})
+    # hole of 3 candles, then 2 forward-filled (NULL) rows right after it
+    btc = btc.drop(index=[3, 4, 5])
+    btc.loc[[6, 7], "close"] = np.nan
+    eth = pd.DataFrame({"startTime": times, "ticker": "ETH", "close": np.arange(10.0)})
+    eth = eth.drop(index=[8])
+    return pd.concat([eth, btc]).sample(frac=1.0, random_state=0)
+
+
+def test_gaps_are_merged_into_minimal_ranges():
+    gaps = find_gaps(make_series(), "startTime", "ticker", "close", HOUR)
+
+    assert len(gaps) == 4
+
+    plan = plan_fetches(gaps)
+
+    assert plan == [
+        FetchRange("BTC", datetime(2023, 1, 1, 3), datetime(2023, 1, 1, 8)),
+        FetchRange("ETH", datetime(2023, 1, 1, 8), datetime(2023, 1, 1, 9)),
+    ]
+
+
+def test_plan_includes_the_tail():
+    watermarks = pd.DataFrame(
+        {"maxStartTime": [datetime(2023, 1, 1, 9), datetime(2023, 1, 1, 12)], "ticker": ["BTC", "ETH"]}
+    )
+    gaps = pd.DataFrame(
+        {"ticker": ["BTC"], "start": [datetime(2023, 1, 1, 3)], "end": [datetime(2023, 1, 1, 5)]}
+    )
+
+    plan = plan_fetches(gaps, watermarks, to_time_dt=datetime(2023, 1, 1, 12), step=HOUR)
+
+    assert plan == [
+        FetchRange("BTC", datetime(2023, 1, 1, 3), datetime(2023, 1, 1, 5)),
+        FetchRange("BTC", datetime(2023, 1, 1, 10), datetime(2023, 1, 1, 12)),
+    ]
+    assert plan_fetches(gaps.iloc[:0]) == []
+
+
+def test_gap_query_uses_the_step_and_lookback():
+    query = gap_query(
+        "project.binance.OHLCV_future_1h", "startTime", "ticker", "close", HOUR, since=datetime(2023, 1, 1)
+    )
+
+    assert "> 3600" in query
+    assert "INTERVAL 3600 SECOND" in query
+    assert "startTime >= DATETIME('2023-01-01 00:00:00')" in query
+    assert "LOGICAL_AND(close IS NULL)" in query
+
+
+def test_null_rows_are_no_longer_gaps_once_repaired():
+    df = make_series()
+    # the load sink appends the repaired candles next to the NULL rows
+    repaired = df[(df["ticker"] == "BTC") & df["close"].isna()].assign(close=1.0)
+
+    gaps = find_gaps(pd.concat([df, repaired]), "startTime", "ticker", "close", HOUR)
+
+    assert plan_fetches(gaps) == [
+        FetchRange("BTC", datetime(2023, 1, 1, 3), datetime(2023, 1, 1, 6)),
+        FetchRange("ETH", datetime(2023, 1, 1, 8), datetime(2023, 1, 1, 9)),
+    ]
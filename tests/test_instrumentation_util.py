@@ -0,0 +1,99 @@
+import json
+import threading
+from types import SimpleNamespace
+
+import pandas as pd
+
+import main
+from tests.fake_bigquery import FakeBigQueryClient
+from tests.test_bigquery_util import DummyDriver
+from utils.bigquery_util import set_bigquery_client
+from utils.instrumentation_util import Instrumentation, current_job
+from utils.scheduler_util import scheduled_job
+
+
+def test_spans_and_counters_are_exported():
+    instrumentation = Instrumentation(table_id="project.dataset.table")
+
+    def fetch():
+        for _ in range(5):
+            with instrumentation.span("fetch_page"):
+                instrumentation.count("rows_fetched", 10)
+
+    threads = [threading.Thread(target=fetch) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with instrumentation.span("validate"):
+        pass
+
+    metrics = instrumentation.as_dict()
+    assert metrics["spans"]["fetch_page"]["count"] == 20
+    assert metrics["spans"]["validate"]["count"] == 1
+    assert metrics["counters"] == {"rows_fetched": 200}
+
+    record = json.loads(instrumentation.to_json_line("updateSomething"))
+    assert record["job_id"] == "updateSomething"
+    assert record["table_id"] == "project.dataset.table"
+    assert record["counters"] == {"rows_fetched": 200}
+
+    prometheus = instrumentation.to_prometheus("updateSomething")
+    assert "# TYPE driver_span_seconds_total counter" in prometheus
+    assert (
+        'driver_span_count_total{job="updateSomething",table="project.dataset.table",span="fetch_page"} 20'
+        in prometheus
+    )
+    assert 'driver_rows_fetched_total{job="updateSomething",table="project.dataset.table"} 200' in prometheus
+
+    assert instrumentation.summary().startswith("fetch_page 20x")
+
+
+def test_driver_run_is_exported_under_the_job(tmp_path, monkeypatch):
+    monkeypatch.setenv("WATERMARK_DB_PATH", "")
+    monkeypatch.setenv("project_id", "instrumented-project")
+    monkeypatch.setenv("JOB_RUNTIME_LOG", "")
+    monkeypatch.setenv("JOB_METRICS_LOG", str(tmp_path / "metrics.jsonl"))
+    monkeypatch.setenv("JOB_METRICS_PROM_DIR", str(tmp_path))
+    set_bigquery_client("instrumented-project", FakeBigQueryClient("instrumented-project"))
+
+    @scheduled_job()
+    def updateDummy():
+        assert current_job.get() == "updateDummy"
+        driver = DummyDriver(dataset_id="dataset", table_name="table", timeframe="1h")
+        df = pd.DataFrame(
+            {
+                "startTime": pd.to_datetime(["2023-01-01 00:00", "2023-01-01 01:00"]),
+                "ticker": "BTC",
+                "close": [1.0, 2.0],
+            }
+        )
+        driver.load_from_dataframe(df, unique_col="close")
+        driver.commit_uploads()
+        return driver.report_instrumentation()
+
+    summary = updateDummy()
+
+    assert "validate 1x" in summary and "upload 1x" in summary and "rows_uploaded 2" in summary
+    assert current_job.get() is None
+
+    record = json.loads((tmp_path / "metrics.jsonl").read_text())
+    assert record["job_id"] == "updateDummy"
+    assert record["counters"]["rows_uploaded"] == 2
+    assert set(record["spans"]) == {"validate", "upload", "commit"}
+
+    prometheus = (tmp_path / "updateDummy.prom").read_text()
+    assert 'driver_rows_uploaded_total{job="updateDummy",table="instrumented-project.dataset.table"} 2' in prometheus
+
+
+def test_job_summary_is_sent_to_discord(monkeypatch):
+    sent = []
+    monkeypatch.setattr(main, "discord", SimpleNamespace(send_embed=lambda **kwargs: sent.append(kwargs)))
+
+    event = SimpleNamespace(job_id="updateSomething", exception=None, retval="fetch_page 3x 1.2s")
+    main.scheduler_callback(event)
+
+    assert sent == [
+        {"job_id": "updateSomething", "exception": None, "execution_message": "fetch_page 3x 1.2s"}
+    ]
@@ -0,0 +1,113 @@
+import threading
+
+import pandas as pd
+
+from drivers.base import DataDriver
+from drivers.ccxt_driver.ohlcv import CCXTDriverOHLCV, page_forward
+from tests.fake_bigquery import FakeBigQueryClient
+from utils.bigquery_util import set_bigquery_client
+from utils.compact_util import constant_category
+from utils.resample_util import resample_ohlcv, timeframe_step
+from utils.retry_util import RetryPolicy
+
+HOUR_MS = 3600 * 1000
+
+
+def make_exchange(first_ms, last_ms, max_limit):
+    """fake fetch_ohlcv returning hourly candles opening in [first_ms, last_ms]"""
+    calls = []
+
+    def fetch_page(since, limit):
+        calls.append((since, limit))
+        start = max(first_ms, since + (-since) % HOUR_MS)
+        opens = range(start, last_ms + 1, HOUR_MS)
+        return [[ts, 1.0, 1.0, 1.0, 1.0, 1.0] for ts in opens][: min(limit, max_limit)]
+
+    return fetch_page, calls
+
+
+def test_tail_is_fetched_with_a_right_sized_limit():
+    fetch_page, calls = make_exchange(0, 100 * HOUR_MS, max_limit=1500)
+
+    pages = page_forward(fetch_page, 98 * HOUR_MS, 100 * HOUR_MS, HOUR_MS, 1500)
+
+    assert calls == [(98 * HOUR_MS, 3)]
+    assert [row[0] for page in pages for row in page] == [98 * HOUR_MS, 99 * HOUR_MS, 100 * HOUR_MS]
+
+
+def test_pages_forward_without_gaps_or_overlaps():
+    fetch_page, calls = make_exchange(0, 1000 * HOUR_MS, max_limit=300)
+
+    pages = page_forward(fetch_page, 10 * HOUR_MS, 1000 * HOUR_MS, HOUR_MS, 300)
+    opens = [row[0] for page in pages for row in page]
+
+    assert opens == list(range(10 * HOUR_MS, 1001 * HOUR_MS, HOUR_MS))
+    assert len(calls) == 4
+    assert calls[-1][1] == 991 - 3 * 300
+
+
+def make_driver(timeframe: str, derived_timeframes=()) -> CCXTDriverOHLCV:
+    """a Binance driver without exchange, fetching BTCUSDT only"""
+    driver = CCXTDriverOHLCV.__new__(CCXTDriverOHLCV)
+    driver.exchange_id = "binance"
+    driver.instrument_type = "future"
+    driver.ccxt_default_type = "future"
+    driver.timeframe_timedelta = timeframe_step(timeframe).to_pytimedelta()
+    driver.max_workers = 1
+    driver.upload_data = False
+    driver.retry_policy = RetryPolicy()
+    driver.resample_validation_sample = 0
+    driver.resample_validated = 0
+    driver.resample_validation_lock = threading.Lock()
+    driver.get_symbols = lambda: {"BTC-USDT-SWAP": "BTCUSDT"}
+    driver.derived = {derived: make_driver(derived) for derived in derived_timeframes}
+    DataDriver.__init__(driver, dataset_id="binance", table_name=f"OHLCV_future_{timeframe}", timeframe=timeframe)
+    return driver
+
+
+def hourly_candles(start, end) -> pd.DataFrame:
+    times = pd.date_range(start, end, freq="1h", inclusive="left")
+    df = pd.DataFrame({"startTime": times, "open": 1.0, "high": 2.0, "low": 0.5, "close": 1.5, "volume": 10.0})
+    df["ticker"] = constant_category("BTCUSDT", len(df))
+    return df
+
+
+def test_derived_candles_are_fetched_and_committed_with_the_hourly_ones(monkeypatch):
+    monkeypatch.setenv("WATERMARK_DB_PATH", "")
+    monkeypatch.setenv("JOB_METRICS_LOG", "")
+    monkeypatch.setenv("BIGQUERY_SINK", "load")
+    monkeypatch.setenv("project_id", "derived-project")
+    client = FakeBigQueryClient("derived-project")
+    set_bigquery_client("derived-project", client)
+
+    driver = make_driver("1h", derived_timeframes=["8h"])
+    derived = driver.derived["8h"]
+    # the hourly table is a day ahead of the 8h one, e.g. the 8h table was added later
+    client.load_table_from_dataframe(hourly_candles("2023-01-01", "2023-01-02 01:00"), driver.BQ_client.get_table(driver.TABLE_ID))
+    client.load_table_from_dataframe(
+        resample_ohlcv(hourly_candles("2023-01-01", "2023-01-01 16:00"), "8h", "1h"),
+        derived.BQ_client.get_table(derived.TABLE_ID),
+    )
+
+    fetched = []
+
+    def fetch(market, from_time_dt, to_time_dt):
+        fetched.append((market, pd.Timestamp(from_time_dt)))
+        return hourly_candles(from_time_dt, "2023-01-03")
+
+    driver.get_all_ohlcv_binance_cached = fetch
+    driver.fetch_data(upload=True, upload_one_at_a_time=True)
+
+    # extended back to the first candle missing from the 8h table
+    assert fetched == [("BTCUSDT", pd.Timestamp("2023-01-01 16:00"))]
+
+    # the hourly table only gets the candles after its watermark
+    uploaded = client.data[driver.TABLE_ID][-1]
+    assert uploaded["startTime"].min() == pd.Timestamp("2023-01-02 01:00")
+    assert len(uploaded) == 23
+
+    # the buckets closed by the fetched candles, committed to the 8h table
+    candles = client.data[derived.TABLE_ID][-1]
+    assert candles["startTime"].tolist() == list(pd.date_range("2023-01-01 16:00", periods=4, freq="8h"))
+    assert candles["volume"].tolist() == [80.0] * 4
+    assert derived.sink.metrics.commits == 1
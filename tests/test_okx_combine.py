@@ -0,0 +1,90 @@
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from drivers.okx_drivers.webscraper.okx_combine import (
+    CandleAccumulator,
+    aggregate_trades,
+    iter_aggtrades_file_candles,
+)
+
+HOUR_NS = 3600 * 10**9
+DAY_MS = 24 * 3600 * 1000
+
+
+def make_trades(rows):
+    return pd.DataFrame(rows, columns=["instId", "sz", "px", "ts"])
+
+
+def test_partial_candles_are_carried_across_chunks():
+
+    chunks = [
+        make_trades(
+            [
+                ["BTC-USDT-SWAP", 1.0, 100.0, 0],
+                ["BTC-USDT-SWAP", 2.0, 110.0, 60_000],
+            ]
+        ),
+        make_trades(
+            [
+                ["BTC-USDT-SWAP", 1.0, 90.0, 120_000],
+                ["BTC-USDT-SWAP", 1.0, 105.0, 3_600_000],
+            ]
+        ),
+    ]
+
+    accumulator = CandleAccumulator()
+    completed = [accumulator.add(aggregate_trades(chunk, HOUR_NS)) for chunk in chunks]
+    completed.append(accumulator.flush())
+    candles = pd.concat(completed).reset_index(drop=True)
+
+    assert candles["bucket"].tolist() == [0, HOUR_NS]
+    first = candles.iloc[0]
+    assert (first["open"], first["high"], first["low"], first["close"]) == (100.0, 110.0, 90.0, 90.0)
+    assert first["volume"] == 4.0
+    assert candles.iloc[1]["open"] == 105.0
+
+
+def write_aggtrades_zip(path, rows, header=False):
+    csv = "".join(f"{inst},{i},buy,{sz},{px},{ts}\n" for i, (inst, sz, px, ts) in enumerate(rows))
+    if header:
+        csv = "instrument_name,trade_id,side,size,price,created_time\n" + csv
+    with zipfile.ZipFile(path, "w") as zip_file:
+        zip_file.writestr(path.stem + ".csv", csv)
+
+
+def test_parallel_files_match_serial(tmp_path):
+
+    rng = np.random.default_rng(0)
+    files = []
+
+    for day in range(4):
+        ts = np.sort(rng.integers(day * DAY_MS, (day + 1) * DAY_MS, 2000))
+        rows = [
+            (inst, sz, px, t)
+            for inst, sz, px, t in zip(
+                rng.choice(["BTC-USDT-SWAP", "ETH-USDT-SWAP"], len(ts)),
+                rng.integers(1, 10, len(ts)).astype(float),
+                rng.integers(90, 110, len(ts)).astype(float),
+                ts,
+            )
+        ]
+        path = tmp_path / f"trades-2023-01-0{day + 1}.zip"
+        write_aggtrades_zip(path, rows, header=day == 1)
+        files.append(path)
+
+    def combine(workers):
+        return pd.concat(
+            list(iter_aggtrades_file_candles(files, HOUR_NS, chunksize=300, workers=workers))
+        ).reset_index(drop=True)
+
+    serial = combine(workers=1)
+    parallel = combine(workers=2)
+
+    pd.testing.assert_frame_equal(serial, parallel)
+    assert not serial.duplicated(["instId", "bucket"]).any()
+    assert serial["volume"].sum() == pytest.approx(
+        sum(pd.read_csv(file, header=None, comment="i")[3].sum() for file in files)
+    )
@@ -0,0 +1,126 @@
+import io
+import json
+import threading
+import zipfile
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from drivers.okx_drivers.webscraper.downloader import OKXWebscaper
+
+
+def make_zip(name: str, size: int = 200_000) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_file:
+        zip_file.writestr(name.replace(".zip", ".csv"), bytes(range(256)) * (size // 256))
+    return buffer.getvalue()
+
+
+FILES = {
+    "202301": {
+        "allswap-aggtrades-2023-01-01.zip": make_zip("allswap-aggtrades-2023-01-01.zip"),
+        "allswap-aggtrades-2023-01-02.zip": make_zip("allswap-aggtrades-2023-01-02.zip"),
+        "allspot-aggtrades-2023-01-01.zip": make_zip("allspot-aggtrades-2023-01-01.zip"),
+    },
+}
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    """stand-in for the OKX listing API and CDN, supports Range requests"""
+
+    requests_log = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.requests_log.append((url.path, self.headers.get("Range")))
+
+        if url.path == "/listing":
+            month = parse_qs(url.query)["path"][0].rsplit("/", 1)[-1]
+            data = [{"fileName": name} for name in FILES.get(month, {})]
+            body = json.dumps({"code": "0", "data": data}).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        _, _, _, year_month, file_name = url.path.rsplit("/", 4)
+        content = FILES.get(year_month, {}).get(file_name)
+        if content is None:
+            self.send_error(404)
+            return
+
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"].split("=")[1].split("-")[0])
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}"
+            )
+        else:
+            self.send_response(200)
+
+        self.send_header("Content-Length", str(len(content) - start))
+        self.end_headers()
+        self.wfile.write(content[start:])
+
+
+@pytest.fixture
+def server():
+    ArchiveHandler.requests_log = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), ArchiveHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def make_downloader(server, tmp_path):
+    return OKXWebscaper(
+        data_type="aggtrades",
+        period="monthly",
+        resume_path=tmp_path,
+        max_workers=2,
+        start_date=date(2023, 1, 1),
+        cdn_url=f"{server}/cdn",
+        listing_url=f"{server}/listing",
+    )
+
+
+def test_downloads_only_missing_swap_files(server, tmp_path):
+    existing = "allswap-aggtrades-2023-01-01.zip"
+    (tmp_path / existing).write_bytes(FILES["202301"][existing])
+
+    okx = make_downloader(server, tmp_path)
+    assert okx.missing_files() == [("202301", "allswap-aggtrades-2023-01-02.zip")]
+    assert okx.okx_download()
+
+    downloaded = "allswap-aggtrades-2023-01-02.zip"
+    assert (tmp_path / downloaded).read_bytes() == FILES["202301"][downloaded]
+    assert not (tmp_path / "allspot-aggtrades-2023-01-01.zip").exists()
+    assert not list(tmp_path.glob("*.part"))
+
+
+def test_resumes_partial_files(server, tmp_path):
+    name = "allswap-aggtrades-2023-01-01.zip"
+    content = FILES["202301"][name]
+    # truncated file left in place by an interrupted run
+    (tmp_path / name).write_bytes(content[:50_000])
+
+    okx = make_downloader(server, tmp_path)
+    url = f"{server}/cdn/aggtrades/monthly/202301/{name}"
+    assert okx.download(url, str(tmp_path / name))
+
+    assert (tmp_path / name).read_bytes() == content
+    assert (f"/cdn/aggtrades/monthly/202301/{name}", "bytes=50000-") in ArchiveHandler.requests_log
@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+from google.cloud import bigquery
+
+from tests.fake_bigquery import FakeBigQueryClient
+from tests.test_bigquery_util import DummyDriver
+from utils.bigquery_util import set_bigquery_client
+from utils.partition_util import MAX_PARTITIONS, PARTITION_HISTORY, migrate_table, partitioning_type
+
+SCHEMA = [
+    bigquery.SchemaField("startTime", "DATETIME"),
+    bigquery.SchemaField("ticker", "STRING"),
+    bigquery.SchemaField("close", "FLOAT"),
+]
+
+
+def test_partitions_stay_within_the_limit():
+    assert partitioning_type(timedelta(minutes=1)) == "DAY"
+    assert partitioning_type(timedelta(hours=1)) == "MONTH"
+    assert partitioning_type(timedelta(hours=8)) == "MONTH"
+    assert partitioning_type(timedelta(days=1)) == "YEAR"
+
+    # hourly partitions of minute candles would be far over the limit
+    assert PARTITION_HISTORY / timedelta(hours=1) > MAX_PARTITIONS
+    assert partitioning_type(timedelta(minutes=1), history=timedelta(days=100)) == "HOUR"
+
+
+def make_driver(monkeypatch, client: FakeBigQueryClient) -> DummyDriver:
+    monkeypatch.setenv("WATERMARK_DB_PATH", "")
+    monkeypatch.setenv("project_id", client.project)
+    set_bigquery_client(client.project, client)
+    return DummyDriver(dataset_id="dataset", table_name="table", timeframe="1h")
+
+
+def test_tables_are_created_partitioned_and_clustered(monkeypatch):
+    client = FakeBigQueryClient("partitioned-project")
+    driver = make_driver(monkeypatch, client)
+
+    driver.BQ_client
+
+    table = client.get_table(driver.TABLE_ID)
+    assert table.time_partitioning.type_ == "MONTH"
+    assert table.time_partitioning.field == "startTime"
+    assert table.clustering_fields == ["ticker"]
+
+
+def test_watermarks_only_read_recent_partitions(monkeypatch):
+    client = FakeBigQueryClient("pruned-project")
+    driver = make_driver(monkeypatch, client)
+    now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    client.create_table(bigquery.Table(driver.TABLE_ID, schema=SCHEMA))
+    client.load_table_from_dataframe(
+        pd.DataFrame(
+            {
+                "startTime": [datetime(2020, 1, 1), now - timedelta(hours=2), now - timedelta(hours=1), datetime(2021, 1, 1)],
+                "ticker": ["BTC", "BTC", "BTC", "DELISTED"],
+                "close": [1.0, 2.0, 3.0, 4.0],
+            }
+        ),
+        driver.TABLE_ID,
+    )
+
+    df = driver.get_latest_date(tickers=["BTC", "DELISTED", "NEW"])
+
+    # BTC comes from the recent partitions, DELISTED from its clustered blocks
+    recent_query, tickers_query = client.queries
+    assert "startTime >= DATETIME(" in recent_query and "ticker IN" not in recent_query
+    assert "ticker IN ('DELISTED', 'NEW')" in tickers_query
+    assert df.set_index("ticker")["maxStartTime"].to_dict() == {
+        "BTC": pd.Timestamp(now - timedelta(hours=1)),
+        "DELISTED": pd.Timestamp(2021, 1, 1),
+    }
+    assert df.set_index("ticker")["countStartTime"].to_dict() == {"BTC": 2, "DELISTED": 1}
+
+
+def test_existing_tables_are_migrated(monkeypatch):
+    client = FakeBigQueryClient("migrated-project")
+    table_id = "migrated-project.dataset.table"
+    client.create_table(bigquery.Table(table_id, schema=SCHEMA))
+    rows = pd.DataFrame({"startTime": [datetime(2023, 1, 1)], "ticker": ["BTC"], "close": [1.0]})
+    client.load_table_from_dataframe(rows, table_id)
+
+    assert migrate_table(client, table_id, "startTime", "ticker", step=timedelta(hours=1))
+
+    table = client.get_table(table_id)
+    assert table.time_partitioning.type_ == "MONTH"
+    assert table.clustering_fields == ["ticker"]
+    pd.testing.assert_frame_equal(client.table_data(table_id), rows)
+    pd.testing.assert_frame_equal(client.table_data("migrated-project.dataset.table_unpartitioned"), rows)
+
+    assert not migrate_table(client, table_id, "startTime", "ticker", step=timedelta(hours=1))
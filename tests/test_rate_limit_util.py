@@ -0,0 +1,39 @@
+from utils import rate_limit_util
+from utils.rate_limit_util import SlidingWindowLimiter, request_weight
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_no_window_goes_over_the_limit(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit_util, "time", clock)
+    limiter = SlidingWindowLimiter(max_weight=100, window_s=60)
+
+    sent = []
+    for _ in range(50):
+        limiter.acquire(10)
+        sent.append(clock.now)
+
+    # the first window too, a full token bucket would have allowed 100 + its refill
+    assert sum(10 for at in sent if at < 60) == 100
+    for start in sent:
+        assert sum(10 for at in sent if start <= at < start + 60) <= 100
+    assert sent[-1] == 4 * 60
+
+
+def test_requests_heavier_than_the_window_still_go_through(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit_util, "time", clock)
+    limiter = SlidingWindowLimiter(max_weight=1.6, window_s=2)
+
+    assert limiter.acquire(request_weight("binance", "future", 1500)) == 0
+    assert limiter.acquire(1) == 2
@@ -0,0 +1,98 @@
+import asyncio
+
+import pandas as pd
+import pytest
+from aiohttp.test_utils import TestServer
+
+import drivers.base
+from drivers.dydx_drivers.async_client import AsyncDydxClient
+from tests.fake_bigquery import FakeBigQueryClient
+from tests.replay import ReplayMissError, replay
+from tests.test_bigquery_util import DummyDriver
+from tests.test_dydx_async_client import make_app
+from tests.test_okx_downloader import ArchiveHandler, FILES, make_downloader, server  # noqa: F401 (fixture)
+from utils.bigquery_util import set_bigquery_client
+
+
+def test_downloader_replays_offline(server, tmp_path):
+    cassette = tmp_path / "okx.json.gz"
+    for folder in ["recorded", "replayed", "again"]:
+        (tmp_path / folder).mkdir()
+
+    with replay(cassette, mode="record"):
+        assert make_downloader(server, tmp_path / "recorded").okx_download()
+        recorded_now = drivers.base.datetime.now()
+
+    requests_served = len(ArchiveHandler.requests_log)
+
+    with replay(cassette) as played:
+        assert make_downloader(server, tmp_path / "replayed").okx_download()
+        assert drivers.base.datetime.now() == recorded_now
+
+        # every recorded response is served once
+        assert len(played) == 0
+        with pytest.raises(ReplayMissError):
+            make_downloader(server, tmp_path / "again").list_files("202301")
+
+    assert len(ArchiveHandler.requests_log) == requests_served
+
+    for name in ["allswap-aggtrades-2023-01-01.zip", "allswap-aggtrades-2023-01-02.zip"]:
+        assert (tmp_path / "replayed" / name).read_bytes() == FILES["202301"][name]
+
+
+def test_async_client_replays_offline(tmp_path):
+    cassette = tmp_path / "dydx.json.gz"
+
+    async def fetch(host):
+        async with AsyncDydxClient(host=host) as client:
+            return await client.get_candles(
+                "BTC-USD", "1HOUR", "2023-01-01T00:00:00.000Z", "2023-01-02T00:00:00.000Z"
+            )
+
+    async def record():
+        test_server = TestServer(make_app([]))
+        await test_server.start_server()
+        try:
+            host = str(test_server.make_url("/"))
+            return host, await fetch(host)
+        finally:
+            await test_server.close()
+
+    with replay(cassette, mode="record"):
+        host, recorded = asyncio.run(record())
+
+    # the server is closed, the candles come from the cassette
+    with replay(cassette):
+        assert asyncio.run(fetch(host)) == recorded
+
+
+def test_fake_bigquery_answers_the_driver_queries(monkeypatch):
+    monkeypatch.setenv("WATERMARK_DB_PATH", "")
+    monkeypatch.setenv("project_id", "fake-project")
+    client = FakeBigQueryClient("fake-project")
+    set_bigquery_client("fake-project", client)
+
+    driver = DummyDriver(dataset_id="dataset", table_name="table", timeframe="1h")
+    df = pd.DataFrame(
+        {
+            "startTime": pd.to_datetime(["2023-01-01 00:00", "2023-01-01 01:00", "2023-01-01 03:00"]),
+            "ticker": "BTC",
+            "close": [1.0, 2.0, 4.0],
+        }
+    )
+
+    driver.load_from_dataframe(df, unique_col="close")
+    driver.commit_uploads()
+
+    latest = driver.get_latest_date()
+    assert latest["maxStartTime"].tolist() == [pd.Timestamp("2023-01-01 03:00")]
+    assert latest["countStartTime"].tolist() == [4]
+
+    # validation filled the missing 02:00 candle with a NULL row
+    gaps = driver.get_gaps(unique_col="close")
+    assert gaps[["start", "end"]].values.tolist() == [
+        [pd.Timestamp("2023-01-01 02:00"), pd.Timestamp("2023-01-01 03:00")]
+    ]
+
+    with pytest.raises(NotImplementedError):
+        client.query("SELECT 1")
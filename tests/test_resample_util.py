@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.compact_util import constant_category
+from utils.resample_util import bucket_starts, compare_ohlcv, resample_ohlcv
+
+
+def hourly(start: str, periods: int, ticker: str = "BTCUSDT") -> pd.DataFrame:
+    opens = np.arange(periods, dtype=float)
+    df = pd.DataFrame(
+        {
+            "startTime": pd.date_range(start, periods=periods, freq="1h"),
+            "open": opens,
+            "high": opens + 2,
+            "low": opens - 2,
+            "close": opens + 1,
+            "volume": 1.5,
+        }
+    )
+    df["ticker"] = constant_category(ticker, len(df))
+    return df
+
+
+def test_ohlcv_aggregation_of_closed_buckets():
+    df = pd.concat([hourly("2023-01-01", 20), hourly("2023-01-01", 10, ticker="ETHUSDT")], ignore_index=True)
+
+    candles = resample_ohlcv(df, "8h", "1h")
+
+    # 16:00 isn't closed for BTC (4 of 8 candles), nothing is for ETH after 00:00
+    assert candles[["ticker", "startTime"]].astype(str).values.tolist() == [
+        ["BTCUSDT", "2023-01-01 00:00:00"],
+        ["BTCUSDT", "2023-01-01 08:00:00"],
+        ["ETHUSDT", "2023-01-01 00:00:00"],
+    ]
+    assert candles.iloc[1][["open", "high", "low", "close", "volume"]].tolist() == [8.0, 17.0, 6.0, 16.0, 12.0]
+    assert list(candles.columns) == list(df.columns)
+    assert candles["ticker"].dtype == df["ticker"].dtype
+
+
+def test_buckets_are_aligned_like_the_exchange():
+    timestamps = pd.Series(pd.to_datetime(["2023-01-04 23:00", "2023-01-05 07:59", "2023-01-05 08:00"]))
+
+    assert bucket_starts(timestamps, pd.Timedelta("8h")).astype(str).tolist() == [
+        "2023-01-04 16:00:00",
+        "2023-01-05 00:00:00",
+        "2023-01-05 08:00:00",
+    ]
+    # weeks open on Monday
+    assert bucket_starts(timestamps, pd.Timedelta(days=7)).tolist() == [pd.Timestamp("2023-01-02")] * 3
+
+
+def test_gap_rows_are_ignored_and_months_rejected():
+    df = hourly("2023-01-01", 24)
+    df.loc[5, ["open", "high", "low", "close", "volume"]] = np.nan
+
+    candles = resample_ohlcv(df, "1d", "1h")
+
+    assert candles["volume"].tolist() == [1.5 * 23]
+    with pytest.raises(NotImplementedError):
+        resample_ohlcv(df, "1M", "1h")
+    with pytest.raises(ValueError):
+        resample_ohlcv(df, "90min", "1h")
+
+
+def test_compare_with_native_candles():
+    derived = resample_ohlcv(hourly("2023-01-01", 48), "1d", "1h")
+    native = derived.copy()
+    native.loc[1, "high"] += 0.5
+    # volumes are sums of floats
+    native["volume"] *= 1 + 1e-9
+
+    mismatches = compare_ohlcv(derived, native)
+
+    assert mismatches["startTime"].tolist() == [pd.Timestamp("2023-01-02")]
+    assert mismatches.loc[0, "high_native"] - mismatches.loc[0, "high_derived"] == 0.5
@@ -0,0 +1,78 @@
+import ccxt
+import pytest
+import requests
+
+from utils.retry_util import RetryPolicy, classify, parse_retry_after
+
+
+def make_policy(**kwargs):
+    sleeps = []
+    policy = RetryPolicy(base_delay=0.5, max_delay=10, sleep=sleeps.append, **kwargs)
+    return policy, sleeps
+
+
+def failing(errors, result="ok"):
+    errors = list(errors)
+
+    def function():
+        if errors:
+            raise errors.pop(0)
+        return result
+
+    return function
+
+
+def test_classify():
+    assert classify(ccxt.RateLimitExceeded("429")) == (True, "rate_limit")
+    assert classify(ccxt.DDoSProtection("418")) == (True, "ddos_protection")
+    assert classify(ccxt.RequestTimeout("timeout")) == (True, "network")
+    assert classify(ccxt.BadSymbol("nope"))[0] is False
+
+    response = requests.Response()
+    response.status_code = 503
+    assert classify(requests.HTTPError(response=response)) == (True, "server")
+    response.status_code = 404
+    assert classify(requests.HTTPError(response=response))[0] is False
+
+
+def test_retries_with_bounded_jitter_and_metrics():
+    policy, sleeps = make_policy(max_attempts=5)
+
+    result = policy.call(failing([ccxt.NetworkError("a"), ccxt.RateLimitExceeded("b")]))
+
+    assert result == "ok"
+    assert len(sleeps) == 2
+    assert all(0.5 <= sleep <= 10 for sleep in sleeps)
+    assert policy.metrics.retries == 2
+    assert policy.metrics.reasons == {"network": 1, "rate_limit": 1}
+    assert policy.metrics.slept_s == pytest.approx(sum(sleeps))
+
+
+def test_non_retryable_and_exhausted_errors_are_raised():
+    policy, sleeps = make_policy(max_attempts=3)
+
+    with pytest.raises(ccxt.BadSymbol):
+        policy.call(failing([ccxt.BadSymbol("nope")]))
+    assert sleeps == []
+
+    with pytest.raises(ccxt.NetworkError):
+        policy.call(failing([ccxt.NetworkError("down")] * 3))
+    assert len(sleeps) == 2
+    assert policy.metrics.failures == 2
+
+
+def test_retry_after_and_used_weight_headers():
+    policy, sleeps = make_policy(
+        max_attempts=2, used_weight_header="x-mbx-used-weight-1m", weight_limit=2400
+    )
+    headers = {"Retry-After": "30", "X-MBX-USED-WEIGHT-1M": "2300"}
+
+    policy.call(failing([ccxt.DDoSProtection("418")]), headers=lambda: headers)
+
+    # Retry-After wins over the (smaller) backoff, then we wait for the next weight window
+    assert sleeps[0] == 30
+    assert 0 < sleeps[1] <= 60
+    assert policy.metrics.weight_pauses == 1
+
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    assert parse_retry_after(None) is None
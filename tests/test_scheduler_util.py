@@ -0,0 +1,57 @@
+import threading
+import time
+
+import pytest
+
+from utils import scheduler_util
+from utils.scheduler_util import runtime_histogram, scheduled_job
+
+
+def test_jobs_record_runtime_and_status(tmp_path, monkeypatch):
+    path = tmp_path / "runtimes.jsonl"
+    monkeypatch.setenv("JOB_RUNTIME_LOG", str(path))
+    monkeypatch.setenv("RAILWAY_GIT_COMMIT_SHA", "abc123")
+
+    @scheduled_job()
+    def updateSomething():
+        return "done"
+
+    @scheduled_job()
+    def updateFailing():
+        raise ValueError("boom")
+
+    assert updateSomething() == "done"
+    assert updateSomething.__name__ == "updateSomething"
+    with pytest.raises(ValueError):
+        updateFailing()
+
+    histogram = runtime_histogram(str(path))
+
+    assert histogram.loc[("abc123", "updateSomething"), "runs"] == 1
+    assert histogram.loc[("abc123", "updateSomething"), "<=1s"] == 1
+    assert histogram.loc[("abc123", "updateFailing"), "errors"] == 1
+
+
+def test_exchange_concurrency_is_capped(monkeypatch):
+    monkeypatch.setenv("JOB_RUNTIME_LOG", "")
+    monkeypatch.setitem(
+        scheduler_util._exchange_semaphores, "test", threading.BoundedSemaphore(1)
+    )
+
+    running = []
+    max_running = []
+
+    @scheduled_job(exchange="test")
+    def updateCapped():
+        running.append(1)
+        max_running.append(len(running))
+        time.sleep(0.05)
+        running.pop()
+
+    threads = [threading.Thread(target=updateCapped) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(max_running) == 1
@@ -0,0 +1,79 @@
+import json
+
+import pandas as pd
+
+from utils.sink_util import BaseWriter, StreamingSink
+
+
+class FakeWriter(BaseWriter):
+    """Keeps JSON encoded rows in memory, rows only become visible once committed"""
+
+    def __init__(self):
+        self.pending = {}
+        self.appends = []
+        self.committed = {}
+
+    def serialize_rows(self, table_id, rows):
+        return [json.dumps(row, default=str).encode() for row in rows]
+
+    def open_stream(self, table_id):
+        stream_name = f"{table_id}/streams/{len(self.pending)}"
+        self.pending[stream_name] = []
+        return stream_name
+
+    def append_rows(self, stream_name, serialized_rows):
+        self.appends.append((stream_name, len(serialized_rows)))
+        self.pending[stream_name].extend(serialized_rows)
+
+    def commit(self, table_id, stream_names):
+        for stream_name in stream_names:
+            rows = [json.loads(row) for row in self.pending[stream_name]]
+            self.committed.setdefault(table_id, []).extend(rows)
+
+
+def make_df(n_rows, ticker="BTC-USDT"):
+    return pd.DataFrame(
+        {
+            "startTime": pd.date_range("2023-01-01", periods=n_rows, freq="1h"),
+            "ticker": ticker,
+            "close": [float(i) for i in range(n_rows)],
+        }
+    )
+
+
+def test_streaming_sink_batches_and_commits_once_per_table():
+
+    writer = FakeWriter()
+    row_size = len(writer.serialize_rows("t", [make_df(1).iloc[0].to_dict()])[0])
+    sink = StreamingSink(writer, max_batch_bytes=10 * row_size, max_batch_age_s=3600)
+
+    for _ in range(5):
+        sink.write("project.okx.OHLCV", make_df(7))
+    sink.write("project.okx.funding", make_df(3, ticker="ETH-USDT"))
+
+    # nothing is visible before the end of the run
+    assert writer.committed == {}
+
+    sink.commit()
+
+    # one stream per table and appends never go over the byte budget
+    assert len(writer.pending) == 2
+    assert all(n_rows <= 10 for _, n_rows in writer.appends)
+    assert len(writer.committed["project.okx.OHLCV"]) == 35
+    assert len(writer.committed["project.okx.funding"]) == 3
+    assert writer.committed["project.okx.funding"][0]["ticker"] == "ETH-USDT"
+
+    assert sink.metrics.rows == 38
+    assert sink.metrics.commits == 2
+    assert sink.metrics.appends == len(writer.appends)
+    assert sink.metrics.bytes_per_s > 0
+
+
+def test_streaming_sink_flushes_old_batches():
+
+    writer = FakeWriter()
+    sink = StreamingSink(writer, max_batch_bytes=1e9, max_batch_age_s=0)
+
+    sink.write("project.okx.OHLCV", make_df(2))
+
+    assert writer.appends == [("project.okx.OHLCV/streams/0", 2)]
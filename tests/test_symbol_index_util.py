@@ -0,0 +1,83 @@
+import pandas as pd
+
+from utils import symbol_index_util
+from utils.symbol_index_util import SymbolIndex, get_symbol_index
+
+MARKETS = {
+    "BTC/USDT": {"id": "BTCUSDT", "symbol": "BTC/USDT", "type": "spot", "active": True},
+    "BTC/USDT:USDT": {"id": "BTCUSDT", "symbol": "BTC/USDT:USDT", "type": "swap", "active": True},
+    "ETH/USDT:USDT": {"id": "ETHUSDT", "symbol": "ETH/USDT:USDT", "type": "swap", "active": True},
+}
+
+
+def catalog(rows=None) -> pd.DataFrame:
+    rows = rows or [
+        ("BTCUSDT", "BTC", "USDT", "2019-09-08", None),
+        ("ETHUSDT", "ETH", "USDT", "2019-11-27", None),
+        ("LUNAUSDT", "LUNA", "USDT", "2020-01-01", "2022-05-13"),
+    ]
+    return pd.DataFrame(
+        {
+            "symbol_id_exchange": [row[0] for row in rows],
+            "asset_id_base_exchange": [row[1] for row in rows],
+            "asset_id_quote_exchange": [row[2] for row in rows],
+            "data_trade_start": pd.to_datetime([row[3] for row in rows]),
+            "data_trade_end": pd.to_datetime([row[4] for row in rows]),
+        }
+    )
+
+
+def test_maps_every_name():
+    index = SymbolIndex.build(catalog(), MARKETS, exchange_id="binance", instrument_type="future")
+
+    assert index.exchange_ids() == {
+        "BTC-USDT-SWAP": "BTCUSDT",
+        "ETH-USDT-SWAP": "ETHUSDT",
+        "LUNA-USDT-SWAP": "LUNAUSDT",
+    }
+    # the swap rather than the spot market sharing its id, delisted ids are left as is like ccxt does
+    assert index.ccxt_symbol("BTCUSDT") == "BTC/USDT:USDT"
+    assert index.ccxt_symbol("LUNAUSDT") == "LUNAUSDT"
+    assert index.exchange_id_of_ccxt_symbol("ETH/USDT:USDT") == "ETHUSDT"
+    assert index.homogenised("ETHUSDT") == "ETH-USDT-SWAP"
+    assert index.listing("LUNAUSDT") == (pd.Timestamp("2020-01-01"), pd.Timestamp("2022-05-13"))
+
+    spot = SymbolIndex.build(catalog(), MARKETS, exchange_id="binance", instrument_type="spot")
+    assert spot.ccxt_symbol("BTCUSDT") == "BTC/USDT"
+
+
+def test_okx_ids_are_built_from_the_assets():
+    index = SymbolIndex.build(catalog(), {}, exchange_id="okx", instrument_type="index")
+
+    assert index.exchange_id("BTC-USDT") == "BTC-USDT"
+    assert index.homogenised("LUNA-USDT") == "LUNA-USDT"
+
+
+def test_rebuilt_only_when_the_catalog_or_markets_change(tmp_path, monkeypatch):
+    monkeypatch.setattr(symbol_index_util, "_indexes", {})
+    builds = []
+    build = SymbolIndex.build.__func__
+
+    def counting_build(cls, *args, **kwargs):
+        builds.append(1)
+        return build(cls, *args, **kwargs)
+
+    monkeypatch.setattr(SymbolIndex, "build", classmethod(counting_build))
+
+    first = get_symbol_index(catalog(), MARKETS, "binance", "future", cache_dir=tmp_path)
+    assert get_symbol_index(catalog(), MARKETS, "binance", "future", cache_dir=tmp_path) is first
+
+    # a new process reads the snapshot
+    monkeypatch.setattr(symbol_index_util, "_indexes", {})
+    loaded = get_symbol_index(catalog(), MARKETS, "binance", "future", cache_dir=tmp_path)
+    assert loaded.exchange_ids() == first.exchange_ids()
+    assert len(builds) == 1
+
+    # a new listing
+    markets = dict(MARKETS, **{"SOL/USDT:USDT": {"id": "SOLUSDT", "symbol": "SOL/USDT:USDT", "type": "swap"}})
+    rebuilt = get_symbol_index(catalog(), markets, "binance", "future", cache_dir=tmp_path)
+    assert rebuilt.fingerprint != first.fingerprint
+    assert len(builds) == 2
+
+    get_symbol_index(catalog()[:2], markets, "binance", "future", cache_dir=tmp_path)
+    assert len(builds) == 3
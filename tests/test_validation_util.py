@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+
+from utils.validation_util import validate_timeseries, unexpected_time_mask
+
+
+def test_validate_timeseries_floors_dedups_and_fills_gaps():
+
+    df = pd.DataFrame(
+        {
+            "startTime": pd.to_datetime(
+                [
+                    "2023-01-01 02:00:00",
+                    "2023-01-01 00:00:00",
+                    "2023-01-01 00:00:00",  # duplicated
+                    "2023-01-01 00:00:05",  # misaligned seconds
+                    "2023-01-01 01:00:05",
+                ]
+            ),
+            "ticker": ["A", "A", "A", "B", "B"],
+            "close": [3.0, 1.0, 2.0, 10.0, 11.0],
+        }
+    )
+
+    clean_df, stats = validate_timeseries(
+        df, timestamp_col="startTime", market_col="ticker", timeframe="1h"
+    )
+
+    clean_df = clean_df.reset_index()
+
+    assert clean_df["startTime"].tolist() == list(
+        pd.to_datetime(
+            [
+                "2023-01-01 00:00:00",
+                "2023-01-01 00:00:00",
+                "2023-01-01 01:00:00",
+                "2023-01-01 01:00:00",
+                "2023-01-01 02:00:00",
+            ]
+        )
+    )
+    assert clean_df["ticker"].tolist() == ["A", "B", "A", "B", "A"]
+    np.testing.assert_array_equal(clean_df["close"], [1.0, 10.0, np.nan, 11.0, 3.0])
+
+    assert stats.loc["A", "duplicated"] == 1
+    assert stats.loc["A", "missing"] == 1
+    assert stats.loc["B", "duplicated"] == 0
+    assert stats.loc["B", "missing"] == 0
+
+
+def test_unexpected_time_mask():
+    index = pd.to_datetime(["2023-01-01 00:00:00", "2023-01-01 08:00:00", "2023-01-01 09:00:00"])
+    assert unexpected_time_mask(pd.DatetimeIndex(index), "8h").tolist() == [False, False, True]
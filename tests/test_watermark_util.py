@@ -0,0 +1,96 @@
+import pandas as pd
+import pytest
+from google.cloud.exceptions import BadRequest
+
+from tests.fake_bigquery import FakeBigQueryClient
+from tests.test_bigquery_util import DummyDriver
+from utils.bigquery_util import set_bigquery_client
+from utils.watermark_util import WatermarkStore, summarise
+
+
+def make_df(start, periods, ticker):
+    return pd.DataFrame(
+        {
+            "startTime": pd.date_range(start, periods=periods, freq="1h"),
+            "ticker": ticker,
+        }
+    )
+
+
+def test_watermarks_are_merged_after_each_upload(tmp_path):
+
+    store = WatermarkStore(str(tmp_path / "watermarks.sqlite"))
+    table_id = "project.binance.OHLCV_future_1h"
+
+    assert store.get(table_id).empty
+
+    store.replace(table_id, summarise(make_df("2023-01-01", 24, "BTCUSDT"), "startTime", "ticker"))
+    store.update(
+        table_id,
+        pd.concat(
+            [
+                summarise(make_df("2023-01-02", 3, "BTCUSDT"), "startTime", "ticker"),
+                summarise(make_df("2023-01-05", 2, "ETHUSDT"), "startTime", "ticker"),
+            ]
+        ),
+    )
+
+    df = store.get(table_id).set_index("ticker")
+
+    assert df.loc["BTCUSDT", "maxStartTime"] == pd.Timestamp("2023-01-02 02:00")
+    assert df.loc["BTCUSDT", "minStartTime"] == pd.Timestamp("2023-01-01 00:00")
+    # counts are only refreshed by a scan
+    assert df.loc["BTCUSDT", "countStartTime"] == 24
+    assert df.loc["ETHUSDT", "countStartTime"] == 2
+    assert df.loc["ETHUSDT", "maxStartTime"] == pd.Timestamp("2023-01-05 01:00")
+
+    # other tables are untouched
+    assert store.get("project.binance.OHLCV_spot_1h").empty
+
+
+def test_uploading_the_same_rows_twice_keeps_the_counts(tmp_path):
+    store = WatermarkStore(str(tmp_path / "watermarks.sqlite"))
+    table_id = "project.binance.OHLCV_future_1h"
+
+    store.replace(table_id, summarise(make_df("2023-01-01", 24, "BTCUSDT"), "startTime", "ticker"))
+    # overlapping pages fetched again, and upserted by the merge sink
+    for _ in range(2):
+        store.update(
+            table_id,
+            summarise(
+                pd.concat([make_df("2023-01-01 20:00", 4, "BTCUSDT"), make_df("2023-01-05", 2, "ETHUSDT")]),
+                "startTime",
+                "ticker",
+            ),
+        )
+
+    df = store.get(table_id).set_index("ticker")
+
+    assert df["countStartTime"].to_dict() == {"BTCUSDT": 24, "ETHUSDT": 2}
+    assert df.loc["BTCUSDT", "maxStartTime"] == pd.Timestamp("2023-01-01 23:00")
+
+
+def test_failed_loads_leave_the_watermarks_unchanged(tmp_path, monkeypatch):
+    monkeypatch.setenv("WATERMARK_DB_PATH", str(tmp_path / "watermarks.sqlite"))
+    monkeypatch.setenv("BIGQUERY_SINK", "load")
+    monkeypatch.setenv("project_id", "failing-project")
+    client = FakeBigQueryClient("failing-project")
+    set_bigquery_client("failing-project", client)
+
+    driver = DummyDriver(dataset_id="dataset", table_name="table", timeframe="1h")
+    df = make_df("2023-01-01", 24, "BTCUSDT")
+    df["close"] = 1.0
+
+    client.load_error = {"reason": "invalid", "message": "Error while reading data"}
+    driver.queue_upload(df, unique_col="close")
+    with pytest.raises(BadRequest):
+        driver.commit_uploads()
+
+    assert driver.watermarks.get(driver.TABLE_ID).empty
+    assert client.table_data(driver.TABLE_ID).empty
+
+    client.load_error = None
+    driver.queue_upload(df, unique_col="close")
+    driver.commit_uploads()
+
+    assert driver.watermarks.get(driver.TABLE_ID)["countStartTime"].tolist() == [24]
@@ -1,21 +1,118 @@
 from datetime import timedelta
+from typing import Callable, Hashable
+import os
+import threading
 from google.cloud import bigquery
 from google import auth
+import google.auth.credentials
+from google.auth.transport.requests import AuthorizedSession
+from google.oauth2 import service_account
+from requests.adapters import HTTPAdapter
+from utils.partition_util import partitioning_type
 import logging
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-def get_time_partitionning_type(time_delta: timedelta):
+# connections kept alive per host, drivers fetching markets concurrently share the same client
+BIGQUERY_POOL_SIZE = 32
+
+_credentials = None
+_clients = {}
+_ensured = set()
+_registry_lock = threading.RLock()
+
+
+def service_account_info_from_env() -> dict:
+    return {
+        "type": os.getenv("type"),
+        "project_id": os.getenv("project_id"),
+        "private_key_id": os.getenv("private_key_id"),
+        "private_key": os.getenv("private_key"),
+        "client_email": os.getenv("client_email"),
+        "client_id": os.getenv("client_id"),
+        "auth_uri": os.getenv("auth_uri"),
+        "token_uri": os.getenv("token_uri"),
+        "auth_provider_x509_cert_url": os.getenv("auth_provider_x509_cert_url"),
+        "client_x509_cert_url": os.getenv("client_x509_cert_url"),
+    }
+
+
+def get_bigquery_credentials() -> service_account.Credentials:
+    """service account credentials from the environment, built once per process"""
+    global _credentials
+
+    with _registry_lock:
+        if _credentials is None:
+            _credentials = service_account.Credentials.from_service_account_info(
+                service_account_info_from_env()
+            )
+        return _credentials
+
+
+def get_bigquery_client(project_id: str, credentials=None) -> bigquery.Client:
+    """process-wide BigQuery client of a project, created on first use
+
+    :param project_id: the GCP project
+    :param credentials: defaults to the service account from the environment
+    :return: the shared client
+    """
+    with _registry_lock:
+        if project_id not in _clients:
+            if credentials is None:
+                credentials = get_bigquery_credentials()
+            # the client only scopes its own copy of the credentials, not those of the session passed in
+            credentials = google.auth.credentials.with_scopes_if_required(
+                credentials, bigquery.Client.SCOPE
+            )
+
+            session = AuthorizedSession(credentials)
+            adapter = HTTPAdapter(
+                pool_connections=BIGQUERY_POOL_SIZE, pool_maxsize=BIGQUERY_POOL_SIZE
+            )
+            session.mount("https://", adapter)
+
+            _clients[project_id] = bigquery.Client(
+                project=project_id, credentials=credentials, _http=session
+            )
+            logger.info(f"Created BigQuery client for {project_id}")
+
+        return _clients[project_id]
+
+
+def set_bigquery_client(project_id: str, client: bigquery.Client):
+    """use `client` for `project_id` from now on, e.g. an in-memory fake for offline runs
+
+    The datasets and tables of the project will be ensured again on the new client.
+    """
+    with _registry_lock:
+        _clients[project_id] = client
+        for key in list(_ensured):
+            if not isinstance(key, tuple) or len(key) < 2:
+                continue
+            if key[1] == project_id or str(key[1]).startswith(f"{project_id}."):
+                _ensured.discard(key)
+
+
+def ensure_once(key: Hashable, create_function: Callable[[], None]):
+    """run `create_function` (e.g. creating a dataset) only once per process for `key`
+
+    Nothing is recorded if it raises, so it's tried again next time.
+    """
+    if key in _ensured:
+        return
+
+    with _registry_lock:
+        if key in _ensured:
+            return
+        create_function()
+        _ensured.add(key)
+
+
+def get_time_partitionning_type(time_delta: timedelta) -> str:
+    """the partitioning of a table of `time_delta` candles, see `utils.partition_util.partitioning_type`"""
+    return partitioning_type(time_delta)
 
-    if time_delta <= timedelta(hours=1):
-        return bigquery.table.TimePartitioningType.HOUR
-    elif time_delta <= timedelta(days=1):
-        return bigquery.table.TimePartitioningType.DAY
-    elif time_delta <= timedelta(days=30):
-        return bigquery.table.TimePartitioningType.MONTH
-    else:
-        return bigquery.table.TimePartitioningType.YEAR
 
 def complete():
     credentials, project = auth.default()
@@ -0,0 +1,248 @@
+import logging
+import os
+import re
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import List, Tuple
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+
+class CacheMetrics:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.evictions = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hit_ratio, 4),
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "evictions": self.evictions,
+        }
+
+    def __repr__(self):
+        return f"CacheMetrics({self.as_dict()})"
+
+
+def _naive_utc(timestamps: pd.Series) -> pd.Series:
+    timestamps = pd.to_datetime(timestamps)
+    if timestamps.dt.tz is not None:
+        timestamps = timestamps.dt.tz_convert(None)
+    return timestamps
+
+
+def _to_ms(dt) -> int:
+    dt = pd.Timestamp(dt)
+    if dt.tz is not None:
+        dt = dt.tz_convert(None)
+    return int(dt.value // 1_000_000)
+
+
+def _unlink(path: Path):
+    """remove `path` if it still exists, `Path.unlink(missing_ok=True)` needs Python 3.8"""
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class CandleCache:
+    """On-disk Parquet cache of fetched candles
+
+    Files are stored as `{cache_dir}/{exchange}/{instrument_type}/{timeframe}/{ticker}/{start_ms}_{end_ms}.parquet`,
+    each file covering the half-open range [start, end) that was fetched, even if the exchange had no candle for
+    part of it. Adjacent or overlapping ranges of a ticker are merged into one file on write, and the least
+    recently used files are evicted once the cache is bigger than `max_size_bytes`.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        timestamp_col: str,
+        max_size_bytes: int = 10 * 1024**3,
+        memory_map: bool = True,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.timestamp_col = timestamp_col
+        self.max_size_bytes = max_size_bytes
+        self.memory_map = memory_map
+
+        self.metrics = CacheMetrics()
+        self.lock = threading.RLock()
+
+    @classmethod
+    def from_env(cls, timestamp_col: str):
+        """Cache configured with `CANDLE_CACHE_DIR` and `CANDLE_CACHE_MAX_GB`, None if the directory isn't set"""
+        cache_dir = os.getenv("CANDLE_CACHE_DIR")
+
+        if not cache_dir:
+            return None
+
+        max_size_bytes = int(float(os.getenv("CANDLE_CACHE_MAX_GB", 10)) * 1024**3)
+        return cls(cache_dir, timestamp_col=timestamp_col, max_size_bytes=max_size_bytes)
+
+    def _key_dir(self, key: Tuple[str, str, str, str]) -> Path:
+        # tickers contain characters such as `/` and `:` (e.g. "BTC/USDT:USDT")
+        parts = [re.sub(r"[^A-Za-z0-9_.-]", "_", str(part)) for part in key]
+        return self.cache_dir.joinpath(*parts)
+
+    def _files(self, key) -> List[Tuple[int, int, Path]]:
+        key_dir = self._key_dir(key)
+
+        if not key_dir.exists():
+            return []
+
+        files = []
+        for path in key_dir.glob("*.parquet"):
+            start_ms, end_ms = path.stem.split("_")
+            files.append((int(start_ms), int(end_ms), path))
+
+        return sorted(files)
+
+    def covered_ranges(self, key) -> List[Tuple[datetime, datetime]]:
+        """The [start, end) ranges available for `key`"""
+        return [
+            (pd.Timestamp(start, unit="ms"), pd.Timestamp(end, unit="ms"))
+            for start, end, _ in self._files(key)
+        ]
+
+    def missing_ranges(
+        self, key, start: datetime, end: datetime
+    ) -> List[Tuple[datetime, datetime]]:
+        """The parts of [start, end) that aren't in the cache, these are the only ranges to fetch"""
+        start_ms, end_ms = _to_ms(start), _to_ms(end)
+
+        missing = []
+        cursor = start_ms
+
+        for file_start, file_end, _ in self._files(key):
+            if file_end <= cursor:
+                continue
+            if file_start >= end_ms:
+                break
+            if file_start > cursor:
+                missing.append((cursor, file_start))
+            cursor = max(cursor, file_end)
+
+        if cursor < end_ms:
+            missing.append((cursor, end_ms))
+
+        with self.lock:
+            if len(missing) == 0:
+                self.metrics.hits += 1
+            elif missing == [(start_ms, end_ms)]:
+                self.metrics.misses += 1
+            else:
+                # partial hit, we only fetch the missing parts
+                self.metrics.hits += 1
+
+        return [
+            (pd.Timestamp(s, unit="ms"), pd.Timestamp(e, unit="ms")) for s, e in missing
+        ]
+
+    def _read_file(self, path: Path) -> pd.DataFrame:
+        table = pq.read_table(path, memory_map=self.memory_map)
+        self.metrics.bytes_read += path.stat().st_size
+        # used as the "last access" time for the LRU eviction
+        os.utime(path)
+        return table.to_pandas()
+
+    def read(self, key, start: datetime, end: datetime) -> pd.DataFrame:
+        """Read the cached candles of `key` within [start, end)"""
+        start_ms, end_ms = _to_ms(start), _to_ms(end)
+
+        frames = []
+        with self.lock:
+            for file_start, file_end, path in self._files(key):
+                if file_end <= start_ms or file_start >= end_ms:
+                    continue
+                frames.append(self._read_file(path))
+
+        if len(frames) == 0:
+            return pd.DataFrame()
+
+        df = pd.concat(frames, ignore_index=True)
+        timestamps = _naive_utc(df[self.timestamp_col])
+        mask = (timestamps >= pd.Timestamp(start_ms, unit="ms")) & (
+            timestamps < pd.Timestamp(end_ms, unit="ms")
+        )
+
+        return df[mask].reset_index(drop=True)
+
+    def write(self, key, df: pd.DataFrame, start: datetime, end: datetime):
+        """Cache the candles fetched for [start, end), merging them with adjacent cached ranges"""
+        start_ms, end_ms = _to_ms(start), _to_ms(end)
+
+        if end_ms <= start_ms:
+            return
+
+        with self.lock:
+            frames = [df]
+            merged = []
+
+            for file_start, file_end, path in self._files(key):
+                if file_end < start_ms or file_start > end_ms:
+                    continue
+                frames.append(self._read_file(path))
+                merged.append(path)
+                start_ms = min(start_ms, file_start)
+                end_ms = max(end_ms, file_end)
+
+            frames = [frame for frame in frames if not frame.empty]
+            if len(frames) > 0:
+                df = pd.concat(frames, ignore_index=True)
+                df = df.drop_duplicates(self.timestamp_col, keep="first")
+                df = df.sort_values(self.timestamp_col).reset_index(drop=True)
+
+            key_dir = self._key_dir(key)
+            key_dir.mkdir(parents=True, exist_ok=True)
+            path = key_dir / f"{start_ms}_{end_ms}.parquet"
+
+            # write to a temporary file first so a crash never leaves a truncated file behind
+            tmp_path = path.with_suffix(".tmp")
+            pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_path)
+            os.replace(tmp_path, path)
+            self.metrics.bytes_written += path.stat().st_size
+
+            for old_path in merged:
+                if old_path != path:
+                    _unlink(old_path)
+
+            self.evict()
+
+    def size_bytes(self) -> int:
+        return sum(path.stat().st_size for path in self.cache_dir.rglob("*.parquet"))
+
+    def evict(self):
+        """Remove the least recently used files until the cache fits in `max_size_bytes`"""
+        with self.lock:
+            files = [(path.stat(), path) for path in self.cache_dir.rglob("*.parquet")]
+            total = sum(stat.st_size for stat, _ in files)
+
+            if total <= self.max_size_bytes:
+                return
+
+            for stat, path in sorted(files, key=lambda x: x[0].st_mtime):
+                if total <= self.max_size_bytes:
+                    break
+                _unlink(path)
+                total -= stat.st_size
+                self.metrics.evictions += 1
+                logger.info(f"Evicted {path} from the candle cache")
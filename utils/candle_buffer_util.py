@@ -0,0 +1,133 @@
+import logging
+from typing import Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+def to_epoch_ms(timestamps) -> np.ndarray:
+    """ms since epoch of datetimes or ISO strings, naive ones are considered UTC"""
+    index = pd.DatetimeIndex(pd.to_datetime(timestamps))
+    if index.tz is not None:
+        index = index.tz_convert(None)
+    return index.to_numpy().astype("datetime64[ms]").astype(np.int64)
+
+
+class CandleBuffer:
+    """Growable struct-of-arrays of candles: one int64 array of ms timestamps and one float64 array per field
+
+    Rows are kept in the middle of preallocated arrays with free space on both sides, so appending (forward
+    pagination) and prepending (backward pagination) a page only copies the page, the arrays are reallocated
+    with twice the size when a side is full. `to_frame` builds the DataFrame once at the end.
+    """
+
+    def __init__(self, fields: Sequence[str], capacity: int = 1024):
+        self.fields = list(fields)
+        self._allocate(max(capacity, 2))
+
+    def _allocate(self, capacity: int):
+        self._timestamps = np.empty(capacity, dtype=np.int64)
+        self._columns = {
+            field: np.empty(capacity, dtype=np.float64) for field in self.fields
+        }
+        self._start = self._end = capacity // 2
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    @property
+    def capacity(self) -> int:
+        return len(self._timestamps)
+
+    @property
+    def nbytes(self) -> int:
+        """size of the stored rows (not the allocated capacity)"""
+        return len(self) * 8 * (1 + len(self.fields))
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self._timestamps[self._start : self._end]
+
+    def column(self, field: str) -> np.ndarray:
+        return self._columns[field][self._start : self._end]
+
+    def _reserve(self, n: int, front: bool):
+        if front and self._start >= n:
+            return
+        if not front and self.capacity - self._end >= n:
+            return
+
+        length = len(self)
+        capacity = max(2 * self.capacity, 2 * (length + n))
+        timestamps, columns = self.timestamps, {f: self.column(f) for f in self.fields}
+
+        self._allocate(capacity)
+        # the free space is split evenly between both sides, once the new rows are added
+        self._start = (capacity - length - n) // 2 + (n if front else 0)
+        self._end = self._start + length
+        self._timestamps[self._start : self._end] = timestamps
+        for field, values in columns.items():
+            self._columns[field][self._start : self._end] = values
+
+    def _extend(self, timestamps: np.ndarray, columns: Dict[str, np.ndarray], front: bool):
+        n = len(timestamps)
+        if n == 0:
+            return
+
+        missing = set(self.fields) - set(columns)
+        if missing:
+            raise ValueError(f"missing fields {sorted(missing)}")
+
+        self._reserve(n, front)
+
+        if front:
+            start, end = self._start - n, self._start
+            self._start = start
+        else:
+            start, end = self._end, self._end + n
+            self._end = end
+
+        self._timestamps[start:end] = timestamps
+        for field in self.fields:
+            self._columns[field][start:end] = columns[field]
+
+    def append(self, timestamps, **columns):
+        """add rows after the existing ones
+
+        :param timestamps: ms since epoch
+        :param columns: one array-like per field
+        """
+        self._extend(np.asarray(timestamps, dtype=np.int64), columns, front=False)
+
+    def prepend(self, timestamps, **columns):
+        """add rows before the existing ones, e.g. an older page when going back in time"""
+        self._extend(np.asarray(timestamps, dtype=np.int64), columns, front=True)
+
+    def _split_rows(self, rows: List[list]):
+        # ccxt/OKX rows: [timestamp, field_1, field_2, ...], numbers can be strings
+        values = np.asarray(
+            [row[: 1 + len(self.fields)] for row in rows], dtype=np.float64
+        )
+        timestamps = values[:, 0].astype(np.int64)
+        return timestamps, {field: values[:, i + 1] for i, field in enumerate(self.fields)}
+
+    def append_rows(self, rows: List[list]):
+        if len(rows) > 0:
+            timestamps, columns = self._split_rows(rows)
+            self._extend(timestamps, columns, front=False)
+
+    def prepend_rows(self, rows: List[list]):
+        if len(rows) > 0:
+            timestamps, columns = self._split_rows(rows)
+            self._extend(timestamps, columns, front=True)
+
+    def to_frame(self, timestamp_col: str = "timestamp") -> pd.DataFrame:
+        """the rows as a DataFrame with naive UTC datetimes
+
+        The columns are views of the buffer when pandas allows it, so the buffer shouldn't be modified afterwards.
+        """
+        data = {timestamp_col: pd.to_datetime(self.timestamps, unit="ms")}
+        data.update({field: self.column(field) for field in self.fields})
+        return pd.DataFrame(data, copy=False)
@@ -0,0 +1,197 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, List
+
+import pandas as pd
+import pyarrow as pa
+
+logger = logging.getLogger(__name__)
+
+
+def arrow_nbytes(df: pd.DataFrame) -> int:
+    """size of `df` once converted to Arrow, which is what load jobs serialize (to Parquet) and send
+
+    `sys.getsizeof` of a list only measures its pointers, and pandas' memory usage counts Python object overhead.
+    """
+    return pa.Table.from_pandas(df, preserve_index=False).nbytes
+
+
+class CoalescerMetrics:
+    def __init__(self):
+        self.frames = 0
+        self.batches = 0
+        self.rows = 0
+        self.bytes = 0
+        self.waits = 0
+        self.waited_s = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "frames": self.frames,
+            "batches": self.batches,
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "waits": self.waits,
+            "waited_s": round(self.waited_s, 3),
+        }
+
+    def __repr__(self):
+        return f"CoalescerMetrics({self.as_dict()})"
+
+
+class UploadCoalescer:
+    """Batches the DataFrames added by the fetching threads and flushes them from a background thread
+
+    A batch is flushed once it holds `target_bytes` of Arrow data, or once its oldest frame is `max_age_s` old.
+    `add` only blocks when more than `max_inflight_bytes` are waiting to be (or being) flushed, which bounds the
+    memory used when uploads are slower than fetches.
+
+    :param flush: called with the frames of a batch, from the background thread
+    :param target_bytes: the size of a batch
+    :param max_age_s: how long a frame may wait for its batch to fill up
+    :param max_inflight_bytes: the most data buffered, pending and being flushed
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[List[pd.DataFrame]], None],
+        target_bytes: int = 8_000_000,
+        max_age_s: float = 60,
+        max_inflight_bytes: int = 128_000_000,
+    ):
+        self.flush = flush
+        self.target_bytes = target_bytes
+        self.max_age_s = max_age_s
+        self.max_inflight_bytes = max_inflight_bytes
+
+        self.pending: List[pd.DataFrame] = []
+        self.pending_bytes = 0
+        self.pending_since = None
+        # sealed batches, (frames, nbytes), waiting for the background thread
+        self.batches = deque()
+        # pending, sealed and being flushed
+        self.inflight_bytes = 0
+
+        self.error = None
+        self.closed = False
+        self.thread = None
+        self.condition = threading.Condition()
+
+        self.metrics = CoalescerMetrics()
+
+    def add(self, df: pd.DataFrame):
+        """queue `df` for upload, raises the error of a previous flush if any"""
+        if df is None or len(df) == 0:
+            return
+
+        nbytes = arrow_nbytes(df)
+
+        with self.condition:
+            self._raise_error()
+
+            # a frame larger than the bound is accepted on its own rather than waiting forever
+            if self.inflight_bytes > 0 and self.inflight_bytes + nbytes > self.max_inflight_bytes:
+                started = time.monotonic()
+                while (
+                    self.error is None
+                    and self.inflight_bytes > 0
+                    and self.inflight_bytes + nbytes > self.max_inflight_bytes
+                ):
+                    self.condition.wait()
+                self.metrics.waits += 1
+                self.metrics.waited_s += time.monotonic() - started
+                self._raise_error()
+
+            if len(self.pending) == 0:
+                self.pending_since = time.monotonic()
+            self.pending.append(df)
+            self.pending_bytes += nbytes
+            self.inflight_bytes += nbytes
+            self.metrics.frames += 1
+
+            if self.pending_bytes >= self.target_bytes:
+                self._seal()
+
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name="upload-coalescer", daemon=True
+                )
+                self.thread.start()
+
+            self.condition.notify_all()
+
+    def close(self):
+        """flush everything still buffered and stop the background thread, raises the first flush error"""
+        with self.condition:
+            if len(self.pending) > 0:
+                self._seal()
+            self.closed = True
+            self.condition.notify_all()
+            thread = self.thread
+
+        if thread is not None:
+            thread.join()
+
+        with self.condition:
+            self.thread = None
+            self.closed = False
+            error, self.error = self.error, None
+
+        logger.info(f"Upload coalescer: {self.metrics}")
+
+        if error is not None:
+            raise error
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError(f"a previous upload failed: {self.error}") from self.error
+
+    def _seal(self):
+        """move the pending frames to a batch, to be called with the condition held"""
+        self.batches.append((self.pending, self.pending_bytes))
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_since = None
+
+    def _next_batch(self):
+        """wait for a sealed batch, sealing the pending frames once they are too old, None once closed"""
+        with self.condition:
+            while len(self.batches) == 0:
+                if self.closed:
+                    return None
+
+                timeout = None
+                if len(self.pending) > 0:
+                    timeout = self.max_age_s - (time.monotonic() - self.pending_since)
+                    if timeout <= 0:
+                        self._seal()
+                        break
+
+                self.condition.wait(timeout)
+
+            return self.batches.popleft()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            frames, nbytes = batch
+            try:
+                # after a failure the remaining batches are dropped, the run is going to fail anyway
+                if self.error is None:
+                    self.flush(frames)
+                    self.metrics.batches += 1
+                    self.metrics.rows += sum(len(frame) for frame in frames)
+                    self.metrics.bytes += nbytes
+            except Exception as e:
+                logger.error(f"Couldn't upload a batch of {len(frames)} frames: {e}")
+                with self.condition:
+                    self.error = e
+            finally:
+                with self.condition:
+                    self.inflight_bytes -= nbytes
+                    self.condition.notify_all()
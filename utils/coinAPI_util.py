@@ -1,24 +1,65 @@
 import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import List, NamedTuple, Optional
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
 import logging
 
 logger = logging.getLogger(__name__)
 
+# only the fields we use are kept, the full symbol list of an exchange is tens of MB
+EXCHANGE_COLUMNS = ["exchange_id", "name", "website"]
+SYMBOL_COLUMNS = [
+    "symbol_id",
+    "exchange_id",
+    "symbol_type",
+    "symbol_id_exchange",
+    "asset_id_base",
+    "asset_id_quote",
+    "asset_id_base_exchange",
+    "asset_id_quote_exchange",
+    "data_trade_start",
+    "data_trade_end",
+]
+
+
+class CatalogEntry(NamedTuple):
+    df: pd.DataFrame
+    etag: Optional[str]
+    fetched_at: float
+
+
+# process-wide, every driver shares the same catalog
+_catalog = {}
+_catalog_lock = threading.Lock()
+
 
 class CoinAPI:
     """
     for list of exchanges see here: https://www.coinapi.io/integration
+
+    Catalog responses (exchanges and symbols) are cached in memory for the whole process and as a Parquet snapshot
+    in `COINAPI_CACHE_DIR`, they are only requested again once older than `COINAPI_CACHE_TTL_HOURS`, with the
+    ETag of the snapshot so an unchanged catalog isn't downloaded again.
     """
 
-    def __init__(self):
+    def __init__(self, cache_dir: Path = None, ttl_seconds: float = None):
 
         self.enpoint = "https://rest.coinapi.io"
 
         self.header = {"X-CoinAPI-Key": os.getenv("COINAPI_API_KEY")}
 
-        self.exchanges = self._get_all_exchange()
+        self.cache_dir = Path(cache_dir or os.getenv("COINAPI_CACHE_DIR", ".coinapi_cache"))
+
+        if ttl_seconds is None:
+            ttl_seconds = float(os.getenv("COINAPI_CACHE_TTL_HOURS", 24)) * 3600
+        self.ttl_seconds = ttl_seconds
 
         # we map symbol types from ccxt to CoinAPI
         self.symbol_types = [
@@ -31,18 +72,106 @@ class CoinAPI:
             "CONTRACT",
         ]
 
+    @property
+    def exchanges(self) -> List[dict]:
+        """only requested the first time it's needed"""
+        return self._get_all_exchange()
+
     def _get_all_exchange(self):
 
         all_exchanges = "/v1/exchanges"
-        url = self.enpoint + all_exchanges
+
+        return self._get_catalog(all_exchanges, EXCHANGE_COLUMNS).to_dict("records")
+
+    def _snapshot_path(self, path: str) -> Path:
+        return self.cache_dir / (re.sub(r"[^A-Za-z0-9_.-]", "_", path.strip("/")) + ".parquet")
+
+    def _read_snapshot(self, path: str) -> Optional[CatalogEntry]:
+        snapshot_path = self._snapshot_path(path)
+
+        if not snapshot_path.exists():
+            return None
 
         try:
-            response = requests.get(url, headers=self.header)
-            response.raise_for_status()
+            table = pq.read_table(snapshot_path)
         except Exception as e:
-            raise e
+            logger.warning(f"Couldn't read the CoinAPI snapshot {snapshot_path}: {e}")
+            return None
+
+        metadata = table.schema.metadata or {}
+        etag = metadata.get(b"etag", b"").decode() or None
+        fetched_at = float(metadata.get(b"fetched_at", b"0"))
+
+        return CatalogEntry(table.to_pandas(), etag, fetched_at)
+
+    def _write_snapshot(self, path: str, entry: CatalogEntry):
+        snapshot_path = self._snapshot_path(path)
+        snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+
+        table = pa.Table.from_pandas(entry.df, preserve_index=False)
+        table = table.replace_schema_metadata(
+            {
+                **(table.schema.metadata or {}),
+                b"etag": (entry.etag or "").encode(),
+                b"fetched_at": str(entry.fetched_at).encode(),
+            }
+        )
+
+        # write to a temporary file first, other processes might be reading the snapshot
+        tmp_path = snapshot_path.with_suffix(f".{os.getpid()}.tmp")
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, snapshot_path)
 
-        return response.json()
+    def _fetch(
+        self, path: str, columns: List[str], previous: Optional[CatalogEntry]
+    ) -> CatalogEntry:
+        headers = dict(self.header)
+        if previous is not None and previous.etag:
+            headers["If-None-Match"] = previous.etag
+
+        response = requests.get(self.enpoint + path, headers=headers, timeout=120)
+
+        if response.status_code == 304 and previous is not None:
+            logger.info(f"CoinAPI {path} unchanged")
+            return previous._replace(fetched_at=time.time())
+
+        if response.status_code != 200:
+            raise Exception(f"Couldn't correct to CoinAPI: {response.text}")
+
+        df = pd.DataFrame(response.json()).reindex(columns=columns)
+        for col in ["data_trade_start", "data_trade_end"]:
+            if col in df.columns:
+                df[col] = pd.to_datetime(df[col])
+
+        logger.info(f"Fetched CoinAPI {path} ({len(df)} rows)")
+
+        return CatalogEntry(df, response.headers.get("ETag"), time.time())
+
+    def _get_catalog(self, path: str, columns: List[str]) -> pd.DataFrame:
+        """the cached response of a catalog endpoint, refreshed once it's older than the TTL
+
+        If the refresh fails, the stale snapshot is used rather than failing the job.
+        """
+        with _catalog_lock:
+            key = (self.cache_dir.resolve(), path)
+            entry = _catalog.get(key) or self._read_snapshot(path)
+
+            if entry is not None and time.time() - entry.fetched_at < self.ttl_seconds:
+                _catalog[key] = entry
+                return entry.df
+
+            try:
+                entry = self._fetch(path, columns, entry)
+            except Exception as e:
+                if entry is None:
+                    raise e
+                logger.warning(f"Couldn't refresh CoinAPI {path}, using the cached catalog: {e}")
+            else:
+                self._write_snapshot(path, entry)
+
+            _catalog[key] = entry
+
+            return entry.df
 
     def get_exchange_data(self, exchange_name):
         """list of exchanges can be found here: https://www.coinapi.io/integration
@@ -80,23 +209,11 @@ class CoinAPI:
         symbol_id_exchange = exchange_data.get("exchange_id")
         all_symbols = f"/v1/symbols/{symbol_id_exchange}"
 
-        url = self.enpoint + all_symbols
-        symbols_resp = requests.get(url, headers=self.header)
-
-        if symbols_resp.status_code != 200:
-            raise Exception(f"Couldn't correct to CoinAPI: {symbols_resp.json()}")
-
-        symbols_df = pd.DataFrame(symbols_resp.json())
+        symbols_df = self._get_catalog(all_symbols, SYMBOL_COLUMNS)
 
+        # do we need to filter out symbols that are missing "data_trade_start" and "data_trade_end"?
         selected_type = symbols_df[
             symbols_df["symbol_type"] == coinapi_symbol_type
         ].copy()
 
-        # do we need to filter out symbols that are missing "data_trade_start" and "data_trade_end"?
-
-        selected_type["data_trade_start"] = pd.to_datetime(
-            symbols_df["data_trade_start"]
-        )
-        selected_type["data_trade_end"] = pd.to_datetime(symbols_df["data_trade_end"])
-
         return selected_type.reset_index(drop=True)
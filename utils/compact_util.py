@@ -0,0 +1,114 @@
+import logging
+from typing import Dict, Iterable, List, Sequence
+
+import numpy as np
+import pandas as pd
+from google.cloud import bigquery
+from pandas.api.types import union_categoricals
+
+from utils.candle_buffer_util import to_epoch_ms
+
+logger = logging.getLogger(__name__)
+
+# price columns that may be stored as float32 in research extracts, volumes and rates keep their precision
+PRICE_COLUMNS = ("open", "high", "low", "close", "price")
+
+# BigQuery type -> compact in-memory dtype, timestamps are int64 ms since epoch
+COMPACT_DTYPES = {
+    "DATETIME": "int64",
+    "TIMESTAMP": "int64",
+    "STRING": "category",
+    "FLOAT": "float64",
+    "FLOAT64": "float64",
+    "INTEGER": "int64",
+    "INT64": "int64",
+    "BOOLEAN": "bool",
+    "BOOL": "bool",
+}
+
+
+def constant_category(value: str, length: int) -> pd.Categorical:
+    """`length` times `value` as a categorical, i.e. one string and `length` int8 codes"""
+    return pd.Categorical.from_codes(np.zeros(length, dtype=np.int8), categories=[value])
+
+
+def compact_dtypes(
+    schema: Sequence[bigquery.SchemaField], float32_columns: Iterable[str] = ()
+) -> Dict[str, str]:
+    """the compact dtype of every column of a BigQuery schema
+
+    :param schema: a driver's `schema`
+    :param float32_columns: FLOAT columns to keep as float32
+    :return: column -> dtype
+    """
+    float32_columns = set(float32_columns)
+    dtypes = {}
+    for field in schema:
+        dtype = COMPACT_DTYPES.get(field.field_type.upper())
+        if dtype is None:
+            continue
+        if dtype == "float64" and field.name in float32_columns:
+            dtype = "float32"
+        if field.mode == "NULLABLE" and field.field_type.upper() in ("INTEGER", "INT64"):
+            # NULLs need the nullable extension type
+            dtype = "Int64"
+        if field.mode == "NULLABLE" and field.field_type.upper() in ("BOOLEAN", "BOOL"):
+            dtype = "boolean"
+        dtypes[field.name] = dtype
+    return dtypes
+
+
+def to_compact(df: pd.DataFrame, dtypes: Dict[str, str]) -> pd.DataFrame:
+    """int64 ms timestamps, categorical strings and (optionally) float32 prices, columns not in `dtypes` are kept as is
+
+    :param df: a DataFrame with datetime timestamps
+    :param dtypes: as returned by `compact_dtypes`
+    """
+    df = df.copy(deep=False)
+    for column, dtype in dtypes.items():
+        if column not in df.columns or df[column].dtype == dtype:
+            continue
+        if dtype == "int64" and not pd.api.types.is_numeric_dtype(df[column]):
+            df[column] = to_epoch_ms(df[column])
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def from_compact(df: pd.DataFrame, timestamp_cols: Sequence[str]) -> pd.DataFrame:
+    """datetime64[ms] timestamps and float64 floats again, e.g. before validation and upload
+
+    float32 values are widened as they are, 0.1f becomes 0.10000000149011612, which is why float32 is meant
+    for research extracts only.
+    """
+    df = df.copy(deep=False)
+    for column in timestamp_cols:
+        if column in df.columns and pd.api.types.is_integer_dtype(df[column]):
+            df[column] = df[column].to_numpy(dtype=np.int64).astype("datetime64[ms]")
+    for column in df.columns[df.dtypes == np.float32]:
+        df[column] = df[column].astype(np.float64)
+    return df
+
+
+def concat_compact(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    """`pd.concat` that keeps categorical columns categorical, plain concat turns differing categories into objects"""
+    frames = [frame for frame in frames if len(frame) > 0]
+    if len(frames) == 0:
+        return pd.DataFrame()
+
+    df = pd.concat(frames, ignore_index=True)
+    for column in frames[0].columns:
+        if isinstance(frames[0][column].dtype, pd.CategoricalDtype) and not isinstance(
+            df[column].dtype, pd.CategoricalDtype
+        ):
+            df[column] = union_categoricals(
+                [frame[column] for frame in frames], ignore_order=True
+            )
+    return df
+
+
+def bytes_per_million_rows(df: pd.DataFrame) -> float:
+    """memory used by `df`, strings included, scaled to a million rows"""
+    if len(df) == 0:
+        return 0.0
+    return df.memory_usage(deep=True, index=True).sum() / len(df) * 1_000_000
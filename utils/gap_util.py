@@ -0,0 +1,155 @@
+import logging
+from datetime import datetime, timedelta
+from typing import List, NamedTuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+GAP_COLUMNS = ["ticker", "start", "end"]
+
+
+class FetchRange(NamedTuple):
+    """candles of `ticker` to fetch in [start, end)"""
+
+    ticker: str
+    start: datetime
+    end: datetime
+
+
+def gap_query(
+    table_id: str,
+    timestamp_col: str,
+    market_col: str,
+    unique_col: str,
+    step: timedelta,
+    since: datetime = None,
+) -> str:
+    """SQL returning the [start, end) of every hole of each ticker: missing rows and rows where `unique_col` is NULL
+
+    The rows are grouped by ticker and timestamp first, so a NULL row (a gap filled by validation) stops being a hole
+    once a complete row is stored next to it, e.g. appended by the `load` sink after a repair.
+
+    :param table_id: the BigQuery table
+    :param timestamp_col: the DATETIME column
+    :param market_col: the ticker column
+    :param unique_col: a column that is only NULL for rows added to fill a gap
+    :param step: the timeframe of the table
+    :param since: only look for gaps after this date, to avoid scanning the whole table
+    :return: a query with ticker, start and end columns
+    """
+    step_s = int(step.total_seconds())
+    where = f"WHERE {timestamp_col} >= DATETIME('{since:%Y-%m-%d %H:%M:%S}')" if since else ""
+
+    return f"""WITH keyed AS (
+        SELECT
+            {market_col} AS ticker,
+            {timestamp_col} AS ts,
+            LOGICAL_AND({unique_col} IS NULL) AS is_null
+        FROM `{table_id}`
+        {where}
+        GROUP BY ticker, ts
+    ),
+    ordered AS (
+        SELECT *, LAG(ts) OVER (PARTITION BY ticker ORDER BY ts) AS prev_ts
+        FROM keyed
+    )
+    SELECT ticker, DATETIME_ADD(prev_ts, INTERVAL {step_s} SECOND) AS start, ts AS `end`
+    FROM ordered
+    WHERE DATETIME_DIFF(ts, prev_ts, SECOND) > {step_s}
+    UNION ALL
+    SELECT ticker, ts AS start, DATETIME_ADD(ts, INTERVAL {step_s} SECOND) AS `end`
+    FROM ordered
+    WHERE is_null"""
+
+
+def find_gaps(
+    df: pd.DataFrame,
+    timestamp_col: str,
+    market_col: str,
+    unique_col: str,
+    step: timedelta,
+) -> pd.DataFrame:
+    """same as `gap_query` on a DataFrame, e.g. the output of `DataDriver.validate_df`"""
+    # a key is only NULL if all of its rows are
+    complete = df[unique_col].notna().groupby(
+        [df[market_col].astype(str), pd.to_datetime(df[timestamp_col])]
+    ).any()
+    keys = complete.index.to_frame(index=False, name=["ticker", "ts"])
+
+    ts = keys["ts"].to_numpy()
+    tickers = keys["ticker"].to_numpy()
+    step = np.timedelta64(int(step.total_seconds()), "s")
+
+    same_ticker = np.r_[False, tickers[1:] == tickers[:-1]]
+    prev_ts = np.r_[ts[:1], ts[:-1]]
+    holes = same_ticker & (ts - prev_ts > step)
+    nulls = ~complete.to_numpy()
+
+    gaps = pd.concat(
+        [
+            pd.DataFrame(
+                {"ticker": tickers[holes], "start": prev_ts[holes] + step, "end": ts[holes]}
+            ),
+            pd.DataFrame({"ticker": tickers[nulls], "start": ts[nulls], "end": ts[nulls] + step}),
+        ],
+        ignore_index=True,
+    )
+
+    return gaps[GAP_COLUMNS]
+
+
+def plan_fetches(
+    gaps: pd.DataFrame,
+    watermarks: pd.DataFrame = None,
+    to_time_dt: datetime = None,
+    step: timedelta = None,
+) -> List[FetchRange]:
+    """the fewest [start, end) ranges covering the gaps (and the tail after each ticker's watermark)
+
+    Overlapping or adjacent ranges of a ticker are merged, e.g. consecutive NULL rows become a single range.
+
+    :param gaps: ticker, start and end columns, as returned by `gap_query` or `find_gaps`
+    :param watermarks: `DataDriver.get_latest_date` output, adds [maxStartTime + step, to_time_dt) for each ticker
+    :param to_time_dt: the end of the tail ranges
+    :param step: the timeframe, needed for the tail ranges
+    :return: the ranges sorted by ticker and start
+    """
+    ranges = [gaps[GAP_COLUMNS]] if gaps is not None and len(gaps) > 0 else []
+
+    if watermarks is not None and len(watermarks) > 0:
+        tail = pd.DataFrame(
+            {
+                "ticker": watermarks["ticker"].astype(str).to_numpy(),
+                "start": pd.to_datetime(watermarks["maxStartTime"]).to_numpy() + pd.Timedelta(step).to_timedelta64(),
+                "end": pd.Timestamp(to_time_dt),
+            }
+        )
+        ranges.append(tail[tail["start"] < tail["end"]])
+
+    if len(ranges) == 0:
+        return []
+
+    ranges = pd.concat(ranges, ignore_index=True)
+    ranges["start"] = pd.to_datetime(ranges["start"])
+    ranges["end"] = pd.to_datetime(ranges["end"])
+    ranges = ranges.sort_values(["ticker", "start"], kind="mergesort").reset_index(drop=True)
+
+    # a range starts a new group unless it overlaps (or touches) the ranges before it of the same ticker
+    end_so_far = ranges.groupby("ticker")["end"].cummax().groupby(ranges["ticker"]).shift()
+    new_group = end_so_far.isna() | (ranges["start"] > end_so_far)
+    group = new_group.cumsum()
+
+    merged = ranges.groupby(group).agg(
+        ticker=("ticker", "first"), start=("start", "min"), end=("end", "max")
+    )
+
+    plan = [
+        FetchRange(row.ticker, row.start.to_pydatetime(), row.end.to_pydatetime())
+        for row in merged.itertuples(index=False)
+    ]
+
+    logger.info(f"Fetch plan: {len(plan)} ranges from {len(ranges)} gaps")
+
+    return plan
@@ -0,0 +1,194 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+# prefix of the exported Prometheus metrics
+METRIC_PREFIX = "driver"
+
+# the scheduled job running in the current thread (or task), set by `scheduler_util.scheduled_job`
+current_job = contextvars.ContextVar("current_job", default=None)
+
+_metrics_log_lock = threading.Lock()
+
+
+@contextmanager
+def job_context(job_id: str):
+    """attribute everything instrumented within the block to `job_id`"""
+    token = current_job.set(job_id)
+    try:
+        yield
+    finally:
+        current_job.reset(token)
+
+
+class SpanStats:
+    def __init__(self):
+        self.count = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+
+    def add(self, duration_s: float):
+        self.count += 1
+        self.total_s += duration_s
+        self.max_s = max(self.max_s, duration_s)
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "total_s": round(self.total_s, 3),
+            "max_s": round(self.max_s, 3),
+        }
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels) -> str:
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+
+
+class Instrumentation:
+    """Timed spans and counters of a driver run, safe to use from the fetching threads
+
+    Spans of concurrent fetches overlap, their total can be larger than the wall time of the run.
+
+    :param table_id: the table the driver writes to, exported as a label
+    """
+
+    def __init__(self, table_id: str = None):
+        self.table_id = table_id
+        self.started_at = time.monotonic()
+        self.spans: Dict[str, SpanStats] = {}
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str):
+        """time the block, e.g. `with instrumentation.span("validate"):`"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration_s = time.perf_counter() - started
+            with self.lock:
+                self.spans.setdefault(name, SpanStats()).add(duration_s)
+
+    def count(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] += int(value)
+
+    def set_count(self, name: str, value: int):
+        """for counters kept elsewhere, e.g. the retry policy's"""
+        with self.lock:
+            self.counters[name] = int(value)
+
+    @property
+    def elapsed_s(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return {
+                "elapsed_s": round(self.elapsed_s, 3),
+                "spans": {name: stats.as_dict() for name, stats in self.spans.items()},
+                "counters": dict(self.counters),
+            }
+
+    def summary(self) -> str:
+        """one line for the Discord embed, e.g. `fetch_page 120x 34.2s | validate 1x 3.1s | rows_uploaded 12,345`"""
+        metrics = self.as_dict()
+        parts = [
+            f"{name} {stats['count']}x {stats['total_s']:.1f}s"
+            for name, stats in metrics["spans"].items()
+        ]
+        parts += [f"{name} {value:,}" for name, value in sorted(metrics["counters"].items())]
+        return " | ".join(parts) if parts else "nothing instrumented"
+
+    def to_json_line(self, job_id: str = None) -> str:
+        record = {
+            "job_id": job_id or current_job.get(),
+            "table_id": self.table_id,
+            "finished_at": datetime.utcnow().isoformat(),
+            "release": os.getenv("RAILWAY_GIT_COMMIT_SHA", "local"),
+            **self.as_dict(),
+        }
+        return json.dumps(record)
+
+    def to_prometheus(self, job_id: str = None) -> str:
+        """the spans and counters in the Prometheus text exposition format"""
+        job_id = job_id or current_job.get() or "manual"
+        metrics = self.as_dict()
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str, samples: list):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{METRIC_PREFIX}_{name}{{{labels}}} {value}")
+
+        span_labels = {
+            name: _labels(job=job_id, table=self.table_id, span=name)
+            for name in metrics["spans"]
+        }
+        metric(
+            "span_seconds_total",
+            "counter",
+            "Time spent in each stage of the run",
+            [(span_labels[name], stats["total_s"]) for name, stats in metrics["spans"].items()],
+        )
+        metric(
+            "span_count_total",
+            "counter",
+            "Number of times each stage ran",
+            [(span_labels[name], stats["count"]) for name, stats in metrics["spans"].items()],
+        )
+        metric(
+            "span_max_seconds",
+            "gauge",
+            "Longest single run of each stage",
+            [(span_labels[name], stats["max_s"]) for name, stats in metrics["spans"].items()],
+        )
+        for name, value in sorted(metrics["counters"].items()):
+            metric(
+                f"{name}_total",
+                "counter",
+                name.replace("_", " ").capitalize(),
+                [(_labels(job=job_id, table=self.table_id), value)],
+            )
+
+        return "\n".join(lines) + "\n"
+
+    def export(self, job_id: str = None):
+        """append the run to `JOB_METRICS_LOG` (JSON lines, default `job_metrics.jsonl`, empty to disable) and write
+        it to `<JOB_METRICS_PROM_DIR>/<job>.prom` for the node exporter's textfile collector (disabled by default)
+        """
+        job_id = job_id or current_job.get()
+
+        path = os.getenv("JOB_METRICS_LOG", "job_metrics.jsonl")
+        if path:
+            with _metrics_log_lock:
+                with open(path, "a") as f:
+                    f.write(self.to_json_line(job_id) + "\n")
+
+        prom_dir = os.getenv("JOB_METRICS_PROM_DIR")
+        if prom_dir:
+            name = (job_id or self.table_id or "manual").replace("/", "_")
+            prom_path = Path(prom_dir) / f"{name}.prom"
+            # written then renamed, so the collector never reads half a file
+            tmp_path = prom_path.with_suffix(".prom.tmp")
+            tmp_path.write_text(self.to_prometheus(job_id))
+            os.replace(tmp_path, prom_path)
+
+    def __repr__(self):
+        return f"Instrumentation({self.as_dict()})"
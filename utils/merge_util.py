@@ -0,0 +1,171 @@
+"""Upserts and in-place de-duplication of the driver tables
+
+Rows are keyed on (ticker, startTime). When a key appears more than once the row with the fewest NULLs wins, so a row
+added by validation to fill a gap never replaces a fetched one.
+"""
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Sequence
+
+from google.cloud import bigquery
+
+logger = logging.getLogger(__name__)
+
+# suffix of the tables batches are loaded into before being merged, they expire on their own if a run dies
+STAGING_SUFFIX = "__staging"
+STAGING_EXPIRATION_HOURS = 24
+
+# tables the compaction job leaves alone
+SKIPPED_SUFFIXES = (STAGING_SUFFIX, "_unpartitioned")
+
+
+def _nulls(columns: Iterable[str], alias: str = None) -> str:
+    """number of NULL values among `columns` of a row"""
+    prefix = f"{alias}." if alias else ""
+    terms = [f"IF({prefix}{column} IS NULL, 1, 0)" for column in columns]
+    return " + ".join(terms) if terms else "0"
+
+
+def dedup_select(source_id: str, key_columns: Sequence[str], value_columns: Sequence[str]) -> str:
+    """one row per key of `source_id`, the one with the fewest NULLs"""
+    return f"""SELECT * EXCEPT(_row) FROM (
+        SELECT *, ROW_NUMBER() OVER (
+            PARTITION BY {', '.join(key_columns)} ORDER BY {_nulls(value_columns)}
+        ) AS _row
+        FROM `{source_id}`
+    )
+    WHERE _row = 1"""
+
+
+def merge_query(
+    table_id: str,
+    staging_id: str,
+    schema: Sequence[bigquery.SchemaField],
+    key_columns: Sequence[str],
+    partition_field: str = None,
+    time_range: tuple = None,
+) -> str:
+    """MERGE the de-duplicated rows of `staging_id` into `table_id`
+
+    :param table_id: the destination table
+    :param staging_id: the table the batch was loaded into
+    :param schema: the schema of both tables
+    :param key_columns: the columns identifying a row, e.g. ticker and startTime
+    :param partition_field: the partitioning column of the destination, to only read the partitions of `time_range`
+    :param time_range: the (min, max) of `partition_field` in the batch
+    """
+    columns = [field.name for field in schema]
+    value_columns = [column for column in columns if column not in key_columns]
+
+    on = " AND ".join(f"T.{column} = S.{column}" for column in key_columns)
+    if partition_field is not None and time_range is not None:
+        start, end = time_range
+        on += (
+            f" AND T.{partition_field} BETWEEN DATETIME('{start:%Y-%m-%d %H:%M:%S}')"
+            f" AND DATETIME('{end:%Y-%m-%d %H:%M:%S}')"
+        )
+
+    when_matched = ""
+    if len(value_columns) > 0:
+        updates = ", ".join(f"{column} = S.{column}" for column in value_columns)
+        when_matched = f"""WHEN MATCHED AND {_nulls(value_columns, 'S')} <= {_nulls(value_columns, 'T')} THEN
+        UPDATE SET {updates}
+    """
+
+    return f"""MERGE `{table_id}` T
+    USING ({dedup_select(staging_id, key_columns, value_columns)}) S
+    ON {on}
+    {when_matched}WHEN NOT MATCHED THEN
+        INSERT ROW"""
+
+
+def duplicates_query(table_id: str, key_columns: Sequence[str]) -> str:
+    """SQL counting the rows that share their key with another row"""
+    keys = ", ".join(key_columns)
+    return f"""SELECT COALESCE(SUM(n - 1), 0) AS duplicates FROM (
+        SELECT COUNT(*) AS n FROM `{table_id}` GROUP BY {keys} HAVING n > 1
+    )"""
+
+
+def compact_query(table: bigquery.Table, key_columns: Sequence[str]) -> str:
+    """DML de-duplicating `table` in place: the rows of each duplicated key are deleted and the one with the fewest
+    NULLs inserted back, in a single MERGE
+
+    Unlike rewriting the table, rows appended while it runs (load jobs, the merge sink's MERGEs) are kept, the statement
+    only changes the rows it read. The table keeps its partitioning, clustering and metadata.
+    """
+    table_id = f"{table.project}.{table.dataset_id}.{table.table_id}"
+    columns = [field.name for field in table.schema]
+    value_columns = [column for column in columns if column not in key_columns]
+    keys = ", ".join(key_columns)
+
+    # one row per duplicated key matching (and deleting) all of its rows, then the rows to insert back, which never
+    # match since a row is matched at most once
+    deleted = ", ".join(column if column in key_columns else f"NULL AS {column}" for column in columns)
+    on = " AND ".join(f"T.{column} = S.{column}" for column in key_columns)
+
+    return f"""MERGE `{table_id}` T
+    USING (
+        SELECT {deleted}, TRUE AS _delete
+        FROM `{table_id}`
+        GROUP BY {keys}
+        HAVING COUNT(*) > 1
+        UNION ALL
+        SELECT * EXCEPT(_row, _count), FALSE AS _delete FROM (
+            SELECT *,
+                ROW_NUMBER() OVER (PARTITION BY {keys} ORDER BY {_nulls(value_columns)}) AS _row,
+                COUNT(*) OVER (PARTITION BY {keys}) AS _count
+            FROM `{table_id}`
+        )
+        WHERE _row = 1 AND _count > 1
+    ) S
+    ON S._delete AND {on}
+    WHEN MATCHED THEN
+        DELETE
+    WHEN NOT MATCHED AND NOT S._delete THEN
+        INSERT ({', '.join(columns)}) VALUES ({', '.join(columns)})"""
+
+
+def compact_table(client: bigquery.Client, table_id: str, key_columns: Sequence[str]) -> int:
+    """de-duplicate `table_id` in place if it has duplicates, see `compact_query`
+
+    :return: the number of rows removed
+    """
+    duplicates = int(client.query(duplicates_query(table_id, key_columns)).to_dataframe()["duplicates"].iloc[0])
+
+    if duplicates == 0:
+        logger.info(f"{table_id} has no duplicates")
+        return 0
+
+    logger.info(f"Removing {duplicates} duplicated rows from {table_id}")
+    client.query(compact_query(client.get_table(table_id), key_columns)).result()
+
+    return duplicates
+
+
+def compact_tables(
+    client: bigquery.Client, project_id: str, dataset_ids: List[str], key_columns: Sequence[str]
+) -> Dict[str, int]:
+    """`compact_table` every table of the datasets, except the staging and backup tables
+
+    :return: the number of rows removed per table
+    """
+    removed = {}
+
+    for dataset_id in dataset_ids:
+        for item in client.list_tables(f"{project_id}.{dataset_id}"):
+            if item.table_id.endswith(SKIPPED_SUFFIXES):
+                continue
+            table_id = f"{project_id}.{dataset_id}.{item.table_id}"
+            removed[table_id] = compact_table(client, table_id, key_columns)
+
+    return removed
+
+
+def staging_table(table: bigquery.Table, now: datetime) -> bigquery.Table:
+    """the staging table of `table`, same schema and no partitioning, it expires after a day"""
+    staging = bigquery.Table(
+        f"{table.project}.{table.dataset_id}.{table.table_id}{STAGING_SUFFIX}", schema=table.schema
+    )
+    staging.expires = now + timedelta(hours=STAGING_EXPIRATION_HOURS)
+    return staging
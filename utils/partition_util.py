@@ -0,0 +1,185 @@
+"""Time partitioning and clustering of the driver tables
+
+Tables are partitioned by their timestamp and clustered by ticker, so the watermark and research queries only read the
+recent partitions, and the blocks of the tickers they filter on.
+
+Tables created before partitioning was applied are rewritten with:
+    python -m utils.partition_util crypto-project.binance.OHLCV_future_1h --timeframe 1h
+"""
+import argparse
+import logging
+from datetime import datetime, timedelta
+from typing import Iterable
+
+import pandas as pd
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
+
+logger = logging.getLogger(__name__)
+
+# BigQuery won't let a single job (e.g. the load of a whole history) modify more partitions than this
+MAX_PARTITIONS = 4000
+
+# the history a table is expected to hold, crypto exchanges started around 2017
+PARTITION_HISTORY = timedelta(days=10 * 365)
+
+# partitions should hold at least this many candles of each ticker, smaller ones cost more metadata than they prune
+MIN_CANDLES_PER_PARTITION = 50
+
+# finest first, with the (longest) duration of one partition
+PARTITION_TYPES = [
+    (bigquery.TimePartitioningType.HOUR, timedelta(hours=1)),
+    (bigquery.TimePartitioningType.DAY, timedelta(days=1)),
+    (bigquery.TimePartitioningType.MONTH, timedelta(days=31)),
+    (bigquery.TimePartitioningType.YEAR, timedelta(days=366)),
+]
+
+
+def partitioning_type(step: timedelta, history: timedelta = PARTITION_HISTORY) -> str:
+    """the finest partitioning holding `MIN_CANDLES_PER_PARTITION` candles per ticker, with `history` fitting in
+    `MAX_PARTITIONS` partitions, e.g. DAY for 1m candles and MONTH for 1h candles
+
+    :param step: the timeframe of the table
+    :param history: the period the table covers
+    """
+    for partition_type, duration in PARTITION_TYPES:
+        if duration < step * MIN_CANDLES_PER_PARTITION:
+            continue
+        if history / duration <= MAX_PARTITIONS:
+            return partition_type
+    return bigquery.TimePartitioningType.YEAR
+
+
+def partition_table(
+    table: bigquery.Table, timestamp_col: str, market_col: str, step: timedelta
+) -> bigquery.Table:
+    """partition `table` on `timestamp_col` and cluster it by `market_col`, before it is created"""
+    table.time_partitioning = bigquery.TimePartitioning(
+        type_=partitioning_type(step), field=timestamp_col
+    )
+    table.clustering_fields = [market_col]
+    return table
+
+
+def _sql_list(values: Iterable[str]) -> str:
+    return ", ".join("'" + str(value).replace("\\", "\\\\").replace("'", "\\'") + "'" for value in values)
+
+
+def watermark_query(
+    table_id: str,
+    timestamp_col: str,
+    market_col: str,
+    since: datetime = None,
+    tickers: Iterable[str] = None,
+) -> str:
+    """SQL returning the max/min/count of the timestamps per ticker
+
+    :param table_id: the BigQuery table
+    :param timestamp_col: the DATETIME column, the partitioning column
+    :param market_col: the ticker column, the clustering column
+    :param since: only read the partitions after this date
+    :param tickers: only read the blocks of these tickers
+    :return: a query with maxStartTime, minStartTime, countStartTime and ticker columns
+    """
+    conditions = []
+    if since is not None:
+        conditions.append(f"{timestamp_col} >= DATETIME('{since:%Y-%m-%d %H:%M:%S}')")
+    if tickers is not None:
+        conditions.append(f"{market_col} IN ({_sql_list(tickers)})")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    return f"""SELECT
+                max({timestamp_col}) as maxStartTime,
+                min({timestamp_col}) as minStartTime,
+                count({timestamp_col}) as countStartTime,
+                {market_col}
+                FROM `{table_id}`
+                {where}
+                GROUP BY {market_col}
+                ORDER BY maxStartTime DESC"""
+
+
+def is_partitioned(table: bigquery.Table, market_col: str) -> bool:
+    return table.time_partitioning is not None and table.clustering_fields == [market_col]
+
+
+def migrate_table(
+    client: bigquery.Client,
+    table_id: str,
+    timestamp_col: str,
+    market_col: str,
+    step: timedelta,
+    drop_backup: bool = False,
+    dry_run: bool = False,
+) -> bool:
+    """rewrite an unpartitioned table into a partitioned and clustered copy, then swap the two
+
+    The original table is kept as `<table>_unpartitioned` unless `drop_backup` is set. Jobs writing to the table
+    shouldn't run during the migration, their rows could land in the backup.
+
+    :return: whether the table was migrated
+    """
+    table = client.get_table(table_id)
+    if is_partitioned(table, market_col):
+        logger.info(f"{table_id} is already partitioned and clustered")
+        return False
+
+    partition_type = partitioning_type(step)
+    project_dataset, table_name = table_id.rsplit(".", 1)
+    new_id = f"{table_id}_partitioned"
+    backup_name = f"{table_name}_unpartitioned"
+
+    try:
+        client.get_table(f"{project_dataset}.{backup_name}")
+        raise RuntimeError(f"{project_dataset}.{backup_name} already exists, drop it first")
+    except NotFound:
+        pass
+
+    statements = [
+        f"""CREATE TABLE `{new_id}`
+        PARTITION BY DATETIME_TRUNC({timestamp_col}, {partition_type})
+        CLUSTER BY {market_col}
+        AS SELECT * FROM `{table_id}`""",
+        f"ALTER TABLE `{table_id}` RENAME TO `{backup_name}`",
+        f"ALTER TABLE `{new_id}` RENAME TO `{table_name}`",
+    ]
+    if drop_backup:
+        statements.append(f"DROP TABLE `{project_dataset}.{backup_name}`")
+
+    for statement in statements:
+        logger.info(statement)
+        if not dry_run:
+            client.query(statement).result()
+
+    return not dry_run
+
+
+def main():
+    from utils.bigquery_util import get_bigquery_client
+
+    parser = argparse.ArgumentParser(description="Partition and cluster existing driver tables")
+    parser.add_argument("table_ids", nargs="+", help="project.dataset.table")
+    parser.add_argument("--timeframe", required=True, help="the candle size, e.g. 1h, 8h or 1m")
+    parser.add_argument("--timestamp-col", default="startTime")
+    parser.add_argument("--market-col", default="ticker")
+    parser.add_argument("--drop-backup", action="store_true", help="drop the unpartitioned table once swapped")
+    parser.add_argument("--dry-run", action="store_true", help="only log the statements")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    for table_id in args.table_ids:
+        client = get_bigquery_client(table_id.split(".")[0])
+        migrate_table(
+            client,
+            table_id,
+            timestamp_col=args.timestamp_col,
+            market_col=args.market_col,
+            step=pd.Timedelta(args.timeframe).to_pytimedelta(),
+            drop_backup=args.drop_backup,
+            dry_run=args.dry_run,
+        )
+
+
+if __name__ == "__main__":
+    main()
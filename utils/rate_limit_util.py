@@ -0,0 +1,130 @@
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+# (exchange_id, ccxt default type) -> (request weight allowed per window, window in seconds)
+# https://binance-docs.github.io/apidocs/spot/en/#limits
+# https://binance-docs.github.io/apidocs/futures/en/#limits
+# https://www.okx.com/docs-v5/en/#rest-api-market-data-get-candlesticks-history
+EXCHANGE_RATE_LIMITS = {
+    ("binance", "spot"): (6000, 60),
+    ("binance", "margin"): (6000, 60),
+    ("binance", "future"): (2400, 60),
+    ("binance", "delivery"): (2400, 60),
+    ("okx", "spot"): (20, 2),
+    ("okx", "future"): (20, 2),
+}
+
+# response header with the weight used in the current window
+USED_WEIGHT_HEADERS = {
+    "binance": "x-mbx-used-weight-1m",
+}
+
+# we keep a margin since other processes (or the exchange's own accounting) might use some of the budget
+SAFETY_FACTOR = 0.8
+
+
+class SlidingWindowLimiter:
+    """Thread-safe limit of `max_weight` every `window_s` seconds (sliding window), `acquire` blocks until the
+    request fits
+
+    Unlike a token bucket that starts full (or refills while idle), no window ever holds more than `max_weight`, not
+    even the first one of a run.
+    """
+
+    def __init__(self, max_weight: float, window_s: float):
+        self.max_weight = max_weight
+        self.window_s = window_s
+        # (time, weight) of the requests of the last window
+        self.sent = deque()
+        self.sent_weight = 0.0
+        self.lock = threading.Lock()
+
+    def _expire(self, now: float):
+        while self.sent and now - self.sent[0][0] >= self.window_s:
+            _, weight = self.sent.popleft()
+            self.sent_weight -= weight
+
+    def acquire(self, weight: float = 1) -> float:
+        """Take `weight` of the window's budget, sleeping if needed
+
+        :param weight: the weight of the request
+        :return: the time spent waiting in seconds
+        """
+        weight = min(weight, self.max_weight)
+        waited = 0.0
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._expire(now)
+                if self.sent_weight + weight <= self.max_weight:
+                    self.sent.append((now, weight))
+                    self.sent_weight += weight
+                    return waited
+
+                # until enough of the oldest requests leave the window
+                freed = self.sent_weight
+                for sent_at, sent_weight in self.sent:
+                    freed -= sent_weight
+                    if freed + weight <= self.max_weight:
+                        wait_time = self.window_s - (now - sent_at)
+                        break
+
+            time.sleep(wait_time)
+            waited += wait_time
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(
+    exchange_id: str, default_type: str, requests_per_second: float = 1.0
+) -> SlidingWindowLimiter:
+    """Return the process-wide rate limiter of an exchange, all drivers on the same exchange share it
+
+    :param exchange_id: the ccxt exchange id, e.g. `binance`
+    :param default_type: the ccxt default type, e.g. `future`
+    :param requests_per_second: the limit used if the exchange isn't in `EXCHANGE_RATE_LIMITS`
+    :return: the rate limiter
+    """
+    key = (exchange_id, default_type)
+
+    with _rate_limiters_lock:
+        if key not in _rate_limiters:
+            weight, window = EXCHANGE_RATE_LIMITS.get(key, (requests_per_second, 1))
+            _rate_limiters[key] = SlidingWindowLimiter(
+                max_weight=weight * SAFETY_FACTOR, window_s=window
+            )
+            logger.debug(f"Created rate limiter for {key}: {weight}/{window}s")
+
+        return _rate_limiters[key]
+
+
+def request_weight(exchange_id: str, default_type: str, limit: int = None) -> int:
+    """Weight of a history request (klines, funding rates...) against the exchange's limit
+
+    :param exchange_id: the ccxt exchange id, e.g. `binance`
+    :param default_type: the ccxt default type, e.g. `future`
+    :param limit: the number of rows requested
+    :return: the request weight
+    """
+    if exchange_id == "binance" and default_type in ["future", "delivery"]:
+        # futures klines weight depends on the limit
+        if limit is None or limit < 100:
+            return 1
+        elif limit < 500:
+            return 2
+        elif limit <= 1000:
+            return 5
+        else:
+            return 10
+    elif exchange_id == "binance":
+        return 2
+
+    return 1
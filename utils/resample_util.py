@@ -0,0 +1,125 @@
+"""Coarser OHLCV candles derived from finer ones, e.g. the 8h and 1d candles from the 1h ones
+
+Buckets are aligned like the exchanges' (Binance, OKX UTC bars): on the Unix epoch, and weeks start on Monday. A
+bucket is only derived once it is closed, i.e. once the finer candle ending it has been fetched.
+"""
+import logging
+from typing import Union
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# how each field of the finer candles is aggregated
+OHLCV_AGGREGATIONS = {
+    "open": "first",
+    "high": "max",
+    "low": "min",
+    "close": "last",
+    "volume": "sum",
+}
+
+# ccxt's timeframe units that pandas spells differently
+PANDAS_UNITS = {"d": "D", "w": "W"}
+
+# weekly candles open on Monday 00:00 UTC, the epoch was a Thursday
+WEEK_ORIGIN = pd.Timestamp("1970-01-05")
+EPOCH = pd.Timestamp("1970-01-01")
+
+
+def timeframe_step(timeframe: Union[str, pd.Timedelta]) -> pd.Timedelta:
+    """the duration of a ccxt timeframe, e.g. `8h` or `1d`, months aren't fixed and can't be derived"""
+    if not isinstance(timeframe, str):
+        return pd.Timedelta(timeframe)
+    if timeframe.endswith("M"):
+        raise NotImplementedError(f"{timeframe} candles can't be derived, months don't have a fixed length")
+    return pd.Timedelta(timeframe[:-1] + PANDAS_UNITS.get(timeframe[-1], timeframe[-1]))
+
+
+def bucket_starts(timestamps: pd.Series, step: pd.Timedelta) -> pd.Series:
+    """the open time of the `step` candle each timestamp falls in"""
+    origin = WEEK_ORIGIN if step % pd.Timedelta(days=7) == pd.Timedelta(0) else EPOCH
+    return origin + ((timestamps - origin) // step) * step
+
+
+def resample_ohlcv(
+    df: pd.DataFrame,
+    timeframe: Union[str, pd.Timedelta],
+    base_timeframe: Union[str, pd.Timedelta],
+    timestamp_col: str = "startTime",
+    market_col: str = "ticker",
+) -> pd.DataFrame:
+    """derive the `timeframe` candles of every market from its `base_timeframe` candles
+
+    Candles without a close (gaps filled by validation) are ignored, the buckets still open at the end of each
+    market's series are dropped.
+
+    :param df: the finer candles, with OHLCV_AGGREGATIONS columns
+    :param timeframe: the candles to derive, a multiple of `base_timeframe`
+    :param base_timeframe: the candles of `df`
+    :param timestamp_col: the open time of the candles
+    :param market_col: the ticker, the candles of each are derived separately
+    :return: the derived candles, with the columns of `df`
+    """
+    step, base_step = timeframe_step(timeframe), timeframe_step(base_timeframe)
+    if step % base_step != pd.Timedelta(0) or step <= base_step:
+        raise ValueError(f"{timeframe} candles can't be derived from {base_timeframe} candles")
+
+    columns = list(df.columns)
+    fields = {field: how for field, how in OHLCV_AGGREGATIONS.items() if field in df.columns}
+
+    df = df[df["close"].notna()] if "close" in df.columns else df
+    if len(df) == 0:
+        return df.iloc[:0][columns]
+
+    df = df.sort_values(timestamp_col)
+    buckets = bucket_starts(df[timestamp_col], step)
+
+    grouped = df.groupby([df[market_col], buckets.rename("_bucket")], observed=True, sort=True)
+    derived = grouped.agg(fields)
+    # a bucket of missing candles (e.g. exchange maintenance) has no volume rather than a volume of 0
+    if "volume" in fields:
+        derived["volume"] = grouped["volume"].sum(min_count=1)
+    derived = derived.reset_index()
+
+    # closed once the last finer candle of the bucket has been fetched
+    last_open = df.groupby(market_col, observed=True)[timestamp_col].max()
+    closed_until = derived[market_col].map(last_open).astype(df[timestamp_col].dtype) + base_step
+    derived = derived[derived["_bucket"] + step <= closed_until]
+
+    derived = derived.rename(columns={"_bucket": timestamp_col})
+    derived[market_col] = derived[market_col].astype(df[market_col].dtype)
+
+    return derived[columns].reset_index(drop=True)
+
+
+def compare_ohlcv(
+    derived: pd.DataFrame,
+    native: pd.DataFrame,
+    timestamp_col: str = "startTime",
+    rtol: float = 1e-6,
+) -> pd.DataFrame:
+    """the derived candles that differ from the exchange's own, on the candles both have
+
+    :param derived: the candles of `resample_ohlcv`, of a single market
+    :param native: the candles fetched from the exchange for the same market and timeframe
+    :param rtol: relative tolerance, volumes are sums of floats
+    :return: the mismatching candles, with `<field>_derived` and `<field>_native` columns
+    """
+    fields = [field for field in OHLCV_AGGREGATIONS if field in derived.columns and field in native.columns]
+
+    both = derived[[timestamp_col] + fields].merge(
+        native[[timestamp_col] + fields], on=timestamp_col, suffixes=("_derived", "_native")
+    )
+
+    mismatch = np.zeros(len(both), dtype=bool)
+    for field in fields:
+        mismatch |= ~np.isclose(
+            both[f"{field}_derived"].astype(float),
+            both[f"{field}_native"].astype(float),
+            rtol=rtol,
+            equal_nan=True,
+        )
+
+    return both[mismatch].reset_index(drop=True)
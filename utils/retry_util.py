@@ -0,0 +1,264 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Mapping, Optional, Tuple
+
+import ccxt
+import requests
+
+logger = logging.getLogger(__name__)
+
+# ratio of the exchange's weight limit above which we wait for the next window before sending more requests
+USED_WEIGHT_THRESHOLD = 0.9
+
+# errors that won't go away by retrying
+NON_RETRYABLE_ERRORS = (
+    ccxt.BadRequest,  # includes BadSymbol
+    ccxt.AuthenticationError,
+    ccxt.NotSupported,
+    ccxt.InsufficientFunds,
+)
+
+
+class RetryMetrics:
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.slept_s = 0.0
+        self.weight_pauses = 0
+        self.reasons = Counter()
+        self.lock = threading.Lock()
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "failures": self.failures,
+            "slept_s": round(self.slept_s, 3),
+            "weight_pauses": self.weight_pauses,
+            "reasons": dict(self.reasons),
+        }
+
+    def __repr__(self):
+        return f"RetryMetrics({self.as_dict()})"
+
+
+def _status_code(exception: Exception) -> Optional[int]:
+    # requests.HTTPError and DydxApiError expose the response, some clients only the status code
+    status_code = getattr(exception, "status_code", None)
+    if status_code is None:
+        # aiohttp.ClientResponseError
+        status_code = getattr(exception, "status", None)
+    response = getattr(exception, "response", None)
+    if status_code is None and response is not None:
+        status_code = getattr(response, "status_code", None)
+    return status_code if isinstance(status_code, int) else None
+
+
+def classify(exception: Exception) -> Tuple[bool, str]:
+    """whether an exception is worth retrying and why it happened
+
+    :param exception: raised by ccxt, requests or an exchange client
+    :return: (retryable, reason)
+    """
+    if isinstance(exception, ccxt.RateLimitExceeded):
+        return True, "rate_limit"
+    if isinstance(exception, ccxt.DDoSProtection):
+        return True, "ddos_protection"
+    if isinstance(exception, NON_RETRYABLE_ERRORS):
+        return False, exception.__class__.__name__
+    if isinstance(exception, ccxt.NetworkError):
+        return True, "network"
+    if isinstance(exception, (requests.ConnectionError, requests.Timeout)):
+        return True, "network"
+
+    status_code = _status_code(exception)
+    if status_code is not None:
+        if status_code in (418, 429):
+            return True, "rate_limit"
+        if status_code >= 500:
+            return True, "server"
+        if 400 <= status_code < 500:
+            return False, f"http_{status_code}"
+
+    # unknown errors were always retried, keep doing so within the attempt budget
+    return True, exception.__class__.__name__
+
+
+def get_header(headers: Optional[Mapping], name: str) -> Optional[str]:
+    """case insensitive lookup, ccxt's last_response_headers is a plain dict"""
+    if not headers:
+        return None
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """seconds to wait from a Retry-After header, either a number of seconds or an HTTP date"""
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """Retries with decorrelated jitter backoff, honouring Retry-After and the exchange's used weight headers
+
+    :param max_attempts: attempts before the last exception is raised
+    :param base_delay: the minimum sleep between attempts, in seconds
+    :param max_delay: the maximum sleep between attempts, in seconds
+    :param used_weight_header: response header with the request weight used in the current window
+    :param weight_limit: the exchange's weight limit for that window
+    :param weight_window_s: the length of that window
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        used_weight_header: str = None,
+        weight_limit: float = None,
+        weight_window_s: float = 60,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.used_weight_header = used_weight_header
+        self.weight_limit = weight_limit
+        self.weight_window_s = weight_window_s
+        self.sleep = sleep
+
+        self.metrics = RetryMetrics()
+
+    def backoff(self, previous_delay: float) -> float:
+        """decorrelated jitter: https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/"""
+        return min(
+            self.max_delay,
+            random.uniform(self.base_delay, max(previous_delay, self.base_delay) * 3),
+        )
+
+    def _sleep(self, seconds: float):
+        if seconds <= 0:
+            return
+        with self.metrics.lock:
+            self.metrics.slept_s += seconds
+        self.sleep(seconds)
+
+    def observe_headers(self, headers: Optional[Mapping]):
+        """wait for the next weight window once most of the exchange's weight limit is used"""
+        if self.used_weight_header is None or self.weight_limit is None:
+            return
+
+        used_weight = get_header(headers, self.used_weight_header)
+        if used_weight is None:
+            return
+
+        if float(used_weight) >= self.weight_limit * USED_WEIGHT_THRESHOLD:
+            wait = self.weight_window_s - time.time() % self.weight_window_s
+            logger.warning(
+                f"Used weight {used_weight}/{self.weight_limit}, waiting {wait:.1f}s for the next window"
+            )
+            with self.metrics.lock:
+                self.metrics.weight_pauses += 1
+            self._sleep(wait)
+
+    def _retry_delay(
+        self,
+        exception: Exception,
+        attempt: int,
+        delay: float,
+        headers: Callable[[], Optional[Mapping]] = None,
+    ) -> Tuple[float, float]:
+        """the next backoff and the time to wait before retrying, re-raises `exception` if we shouldn't retry"""
+        retryable, reason = classify(exception)
+
+        with self.metrics.lock:
+            self.metrics.reasons[reason] += 1
+
+        if not retryable or attempt >= self.max_attempts:
+            with self.metrics.lock:
+                self.metrics.failures += 1
+            raise exception
+
+        # requests attaches the response to its exceptions, aiohttp the headers
+        response = getattr(exception, "response", None)
+        response_headers = getattr(response, "headers", None)
+        if response_headers is None:
+            response_headers = getattr(exception, "headers", None)
+        if response_headers is None and headers is not None:
+            response_headers = headers()
+
+        retry_after = parse_retry_after(get_header(response_headers, "Retry-After"))
+        delay = self.backoff(delay)
+        wait = max(delay, retry_after or 0.0)
+
+        logger.warning(
+            f"FAILED {attempt}/{self.max_attempts} ({reason}), retrying in {wait:.1f}s: {exception}"
+        )
+
+        with self.metrics.lock:
+            self.metrics.retries += 1
+            self.metrics.slept_s += wait
+
+        return delay, wait
+
+    def call(
+        self,
+        function: Callable,
+        *args,
+        headers: Callable[[], Optional[Mapping]] = None,
+        **kwargs,
+    ):
+        """call `function` until it succeeds, the last exception is raised after `max_attempts`
+
+        :param function: the request to make
+        :param headers: returns the headers of the last response (e.g. `lambda: exchange.last_response_headers`),
+            for clients that don't attach the response to their exceptions
+        """
+        delay = self.base_delay
+
+        for attempt in range(1, self.max_attempts + 1):
+            with self.metrics.lock:
+                self.metrics.calls += 1
+
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                delay, wait = self._retry_delay(e, attempt, delay, headers)
+                self.sleep(wait)
+                continue
+
+            if headers is not None:
+                self.observe_headers(headers())
+
+            return result
+
+    async def call_async(self, function: Callable[..., Awaitable], *args, **kwargs):
+        """same as `call` for coroutine functions, waiting with `asyncio.sleep`"""
+        delay = self.base_delay
+
+        for attempt in range(1, self.max_attempts + 1):
+            with self.metrics.lock:
+                self.metrics.calls += 1
+
+            try:
+                return await function(*args, **kwargs)
+            except Exception as e:
+                delay, wait = self._retry_delay(e, attempt, delay)
+                await asyncio.sleep(wait)
@@ -0,0 +1,187 @@
+import argparse
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+from apscheduler.executors.pool import ProcessPoolExecutor, ThreadPoolExecutor
+
+from utils.instrumentation_util import job_context
+
+logger = logging.getLogger(__name__)
+
+JOB_DEFAULTS = {
+    # a job that missed several runs (e.g. a backfill running into the next day) only runs once
+    "coalesce": True,
+    # never start a job while its previous run is still going
+    "max_instances": 1,
+    # still run a job that was delayed by up to an hour
+    "misfire_grace_time": 3600,
+}
+
+# maximum number of jobs running at the same time on each exchange, they share the same rate limit
+EXCHANGE_CONCURRENCY = {
+    "binance": 1,
+    "dydx": 1,
+    "okx": 1,
+}
+
+# upper bounds of the runtime histogram buckets, in seconds
+RUNTIME_BUCKETS = [1, 5, 15, 60, 300, 900, 1800, 3600, 7200, np.inf]
+
+# created at import, so they are inherited by the (forked) workers of the process pool
+_exchange_semaphores = {
+    exchange: multiprocessing.BoundedSemaphore(limit)
+    for exchange, limit in EXCHANGE_CONCURRENCY.items()
+}
+
+_runtime_log_lock = threading.Lock()
+
+
+def get_job_defaults() -> dict:
+    """`JOB_DEFAULTS`, the misfire grace time can be set with `SCHEDULER_MISFIRE_GRACE_S`"""
+    job_defaults = dict(JOB_DEFAULTS)
+
+    if os.getenv("SCHEDULER_MISFIRE_GRACE_S"):
+        job_defaults["misfire_grace_time"] = int(os.getenv("SCHEDULER_MISFIRE_GRACE_S"))
+
+    return job_defaults
+
+
+def create_executors(thread_workers: int = None, process_workers: int = None) -> dict:
+    """a thread pool (`default`) for I/O bound fetches and a process pool (`processpool`) for CPU heavy jobs
+
+    :param thread_workers: defaults to `SCHEDULER_THREAD_WORKERS` (8)
+    :param process_workers: defaults to `SCHEDULER_PROCESS_WORKERS` (2)
+    :return: the executors to pass to the scheduler
+    """
+    if thread_workers is None:
+        thread_workers = int(os.getenv("SCHEDULER_THREAD_WORKERS", 8))
+    if process_workers is None:
+        process_workers = int(os.getenv("SCHEDULER_PROCESS_WORKERS", 2))
+
+    return {
+        "default": ThreadPoolExecutor(thread_workers),
+        "processpool": ProcessPoolExecutor(process_workers),
+    }
+
+
+@contextmanager
+def exchange_slot(exchange: str):
+    """wait for one of the `EXCHANGE_CONCURRENCY` slots of an exchange, no limit if it isn't listed"""
+    semaphore = _exchange_semaphores.get(exchange)
+
+    if semaphore is None:
+        yield
+        return
+
+    started = time.monotonic()
+    semaphore.acquire()
+    waited = time.monotonic() - started
+
+    if waited > 1:
+        logger.info(f"Waited {waited:.1f}s for a {exchange} job slot")
+
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+def record_runtime(job_id: str, started_at: datetime, duration_s: float, status: str):
+    """append one run to the JSON lines file at `JOB_RUNTIME_LOG` (default `job_runtimes.jsonl`, empty to disable)"""
+    path = os.getenv("JOB_RUNTIME_LOG", "job_runtimes.jsonl")
+
+    if not path:
+        return
+
+    record = {
+        "job_id": job_id,
+        "started_at": started_at.isoformat(),
+        "duration_s": round(duration_s, 3),
+        "status": status,
+        # runs are compared across deployments
+        "release": os.getenv("RAILWAY_GIT_COMMIT_SHA", "local"),
+    }
+
+    with _runtime_log_lock:
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def scheduled_job(exchange: str = None) -> Callable:
+    """decorator for the `update*` jobs: holds an exchange slot while running and records the job runtime
+
+    The drivers' metrics exported during the run are labelled with the job's name.
+
+    :param exchange: the exchange the job fetches from, see `EXCHANGE_CONCURRENCY`
+    """
+
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with exchange_slot(exchange), job_context(function.__name__):
+                started_at = datetime.utcnow()
+                started = time.perf_counter()
+                status = "error"
+                try:
+                    result = function(*args, **kwargs)
+                    status = "success"
+                    return result
+                finally:
+                    duration_s = time.perf_counter() - started
+                    logger.info(f"{function.__name__} {status} in {duration_s:.1f}s")
+                    record_runtime(function.__name__, started_at, duration_s, status)
+
+        return wrapper
+
+    return decorator
+
+
+def runtime_histogram(path: str, by_release: bool = True) -> pd.DataFrame:
+    """number of runs per runtime bucket and percentiles for each job (and release)
+
+    :param path: the JSON lines file written by `record_runtime`
+    :param by_release: group by release too, to compare deployments
+    :return: one row per job (and release)
+    """
+    runs = pd.read_json(path, lines=True)
+
+    keys = ["release", "job_id"] if by_release else ["job_id"]
+    labels = [f"<={bucket}s" for bucket in RUNTIME_BUCKETS[:-1]] + [
+        f">{RUNTIME_BUCKETS[-2]}s"
+    ]
+    runs["bucket"] = pd.cut(
+        runs["duration_s"], bins=[0] + RUNTIME_BUCKETS, labels=labels, include_lowest=True
+    )
+
+    histogram = (
+        runs.groupby(keys + ["bucket"], observed=False).size().unstack("bucket", fill_value=0)
+    )
+    grouped = runs.groupby(keys)["duration_s"]
+    histogram["runs"] = grouped.size()
+    histogram["errors"] = runs["status"].ne("success").groupby([runs[key] for key in keys]).sum()
+    histogram["p50_s"] = grouped.quantile(0.5)
+    histogram["p95_s"] = grouped.quantile(0.95)
+    histogram["max_s"] = grouped.max()
+
+    return histogram.dropna(subset=["runs"])
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Runtime histogram of the scheduled jobs")
+    parser.add_argument("path", nargs="?", default="job_runtimes.jsonl")
+    parser.add_argument("--all-releases", action="store_true")
+    args = parser.parse_args()
+
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(runtime_histogram(args.path, by_release=not args.all_releases))
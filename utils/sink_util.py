@@ -0,0 +1,482 @@
+import logging
+import math
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Dict, List
+
+import pandas as pd
+from google.cloud import bigquery
+from google.cloud.exceptions import Conflict
+
+from utils.coalesce_util import arrow_nbytes
+from utils.merge_util import merge_query, staging_table
+
+logger = logging.getLogger(__name__)
+
+
+class SinkMetrics:
+    """Throughput counters of a sink, since it was created"""
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.rows = 0
+        self.bytes = 0
+        self.appends = 0
+        self.commits = 0
+
+    @property
+    def elapsed_s(self) -> float:
+        return max(time.monotonic() - self.started_at, 1e-9)
+
+    @property
+    def rows_per_s(self) -> float:
+        return self.rows / self.elapsed_s
+
+    @property
+    def bytes_per_s(self) -> float:
+        return self.bytes / self.elapsed_s
+
+    def as_dict(self) -> dict:
+        return {
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "appends": self.appends,
+            "commits": self.commits,
+            "rows_per_s": round(self.rows_per_s, 2),
+            "bytes_per_s": round(self.bytes_per_s, 2),
+        }
+
+    def __repr__(self):
+        return f"SinkMetrics({self.as_dict()})"
+
+
+class BaseSink(ABC):
+    """Where validated DataFrames end up, `commit` is called once at the end of each driver run"""
+
+    def __init__(self):
+        self.metrics = SinkMetrics()
+
+    @abstractmethod
+    def write(self, table_id: str, df: pd.DataFrame):
+        pass
+
+    def flush(self):
+        """Send whatever is buffered without committing it"""
+        pass
+
+    def commit(self):
+        """Make everything written so far visible in the destination tables"""
+        pass
+
+
+class LoadJobSink(BaseSink):
+    """One `load_table_from_dataframe` job per write, data is visible as soon as the job completes"""
+
+    def __init__(self, client: bigquery.Client):
+        super().__init__()
+        self.client = client
+
+    def write(self, table_id: str, df: pd.DataFrame):
+
+        table = self.client.get_table(table_id)
+
+        try:
+            resp = self.client.load_table_from_dataframe(df, table)
+            # wait for the job, the rows (and the watermarks after them) only count once loaded
+            resp.result()
+        except Conflict as conf:
+            logger.error(f"{conf}")
+            raise
+        except Exception as e:
+            raise e
+
+        if resp.error_result is not None:
+            raise RuntimeError(f"Found errors uploading job: {resp.error_result}")
+
+        logger.info(
+            f"Updated table: {table.project}.{table.dataset_id}.{table.table_id}"
+        )
+
+        self.metrics.rows += len(df)
+        self.metrics.bytes += arrow_nbytes(df)
+        self.metrics.appends += 1
+        self.metrics.commits += 1
+
+
+class MergeSink(BaseSink):
+    """Upserts on `key_columns`: writes are buffered per table, loaded into a staging table and MERGEd in one statement
+
+    Rows fetched again (overlapping pages, retries, reruns) replace the stored ones instead of being appended twice,
+    and a row with NULLs (a gap filled by validation) never replaces a complete one. Writes are grouped until
+    `max_batch_rows` rows or `max_batch_bytes` (Arrow size) are buffered, so a run issues a handful of MERGEs rather
+    than one per write (each MERGE is a DML statement, and tables only accept a few of them at a time), while the
+    buffers stay bounded like the coalescers' in-flight bytes.
+    """
+
+    def __init__(
+        self,
+        client: bigquery.Client,
+        key_columns: List[str],
+        max_batch_rows: int = 1_000_000,
+        max_batch_bytes: int = 64_000_000,
+    ):
+        super().__init__()
+        self.client = client
+        self.key_columns = key_columns
+        self.max_batch_rows = max_batch_rows
+        self.max_batch_bytes = max_batch_bytes
+
+        self.buffers: Dict[str, List[pd.DataFrame]] = {}
+        self.buffer_rows: Dict[str, int] = {}
+        self.buffer_bytes: Dict[str, int] = {}
+        self.staging_ids: Dict[str, str] = {}
+
+    def write(self, table_id: str, df: pd.DataFrame):
+
+        if len(df) == 0:
+            return
+
+        self.buffers.setdefault(table_id, []).append(df)
+        self.buffer_rows[table_id] = self.buffer_rows.get(table_id, 0) + len(df)
+        self.buffer_bytes[table_id] = self.buffer_bytes.get(table_id, 0) + arrow_nbytes(df)
+
+        if (
+            self.buffer_rows[table_id] >= self.max_batch_rows
+            or self.buffer_bytes[table_id] >= self.max_batch_bytes
+        ):
+            self._flush_table(table_id)
+
+    def _flush_table(self, table_id: str):
+
+        frames = self.buffers.pop(table_id, [])
+        self.buffer_rows.pop(table_id, None)
+        nbytes = self.buffer_bytes.pop(table_id, 0)
+
+        if len(frames) == 0:
+            return
+
+        df = pd.concat(frames, ignore_index=True)
+        table = self.client.get_table(table_id)
+
+        staging = self.client.create_table(staging_table(table, datetime.utcnow()), exists_ok=True)
+        staging_id = f"{staging.project}.{staging.dataset_id}.{staging.table_id}"
+        self.staging_ids[table_id] = staging_id
+
+        job_config = bigquery.LoadJobConfig(
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE
+        )
+        self.client.load_table_from_dataframe(df, staging_id, job_config=job_config).result()
+
+        # only the partitions of the batch are read from the destination
+        partition_field, time_range = None, None
+        if table.time_partitioning is not None and table.time_partitioning.field in df.columns:
+            partition_field = table.time_partitioning.field
+            time_range = (df[partition_field].min(), df[partition_field].max())
+
+        self.client.query(
+            merge_query(
+                table_id,
+                staging_id,
+                table.schema,
+                self.key_columns,
+                partition_field=partition_field,
+                time_range=time_range,
+            )
+        ).result()
+
+        self.metrics.rows += len(df)
+        self.metrics.bytes += nbytes
+        self.metrics.appends += 1
+
+        logger.info(f"Merged {len(df)} rows into {table_id}")
+
+    def flush(self):
+        for table_id in list(self.buffers.keys()):
+            self._flush_table(table_id)
+
+    def commit(self):
+
+        self.flush()
+
+        for table_id, staging_id in self.staging_ids.items():
+            self.client.delete_table(staging_id, not_found_ok=True)
+            self.metrics.commits += 1
+
+        self.staging_ids = {}
+
+        logger.info(f"Sink throughput: {self.metrics}")
+
+
+class BaseWriter(ABC):
+    """Low level append-rows interface, `StorageWriteApiWriter` in production and a fake in tests"""
+
+    @abstractmethod
+    def serialize_rows(self, table_id: str, rows: List[dict]) -> List[bytes]:
+        pass
+
+    @abstractmethod
+    def open_stream(self, table_id: str) -> str:
+        """Open a pending stream on the table and return its name"""
+        pass
+
+    @abstractmethod
+    def append_rows(self, stream_name: str, serialized_rows: List[bytes]):
+        pass
+
+    @abstractmethod
+    def commit(self, table_id: str, stream_names: List[str]):
+        """Finalize and atomically commit the streams of a table"""
+        pass
+
+
+class StreamingSink(BaseSink):
+    """Keeps one open pending stream per table and appends rows batched by byte size and age
+
+    Nothing is visible in BigQuery until `commit` is called, which finalizes and commits every stream at once.
+    """
+
+    def __init__(
+        self,
+        writer: BaseWriter,
+        max_batch_bytes: int = 5 * 1024 * 1024,
+        max_batch_age_s: float = 30.0,
+    ):
+        super().__init__()
+        self.writer = writer
+        # AppendRows requests are limited to 10MB
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_age_s = max_batch_age_s
+
+        self.streams: Dict[str, str] = {}
+        self.buffers: Dict[str, List[bytes]] = {}
+        self.buffer_bytes: Dict[str, int] = {}
+        self.buffer_started_at: Dict[str, float] = {}
+
+    def write(self, table_id: str, df: pd.DataFrame):
+
+        rows = dataframe_to_rows(df)
+
+        for serialized in self.writer.serialize_rows(table_id, rows):
+
+            if (
+                self.buffer_bytes.get(table_id, 0) + len(serialized)
+                > self.max_batch_bytes
+            ):
+                self._flush_table(table_id)
+
+            if table_id not in self.buffers:
+                self.buffers[table_id] = []
+                self.buffer_bytes[table_id] = 0
+                self.buffer_started_at[table_id] = time.monotonic()
+
+            self.buffers[table_id].append(serialized)
+            self.buffer_bytes[table_id] += len(serialized)
+
+        if (
+            table_id in self.buffer_started_at
+            and time.monotonic() - self.buffer_started_at[table_id]
+            >= self.max_batch_age_s
+        ):
+            self._flush_table(table_id)
+
+    def _flush_table(self, table_id: str):
+
+        rows = self.buffers.pop(table_id, [])
+        size = self.buffer_bytes.pop(table_id, 0)
+        self.buffer_started_at.pop(table_id, None)
+
+        if len(rows) == 0:
+            return
+
+        if table_id not in self.streams:
+            self.streams[table_id] = self.writer.open_stream(table_id)
+
+        self.writer.append_rows(self.streams[table_id], rows)
+
+        self.metrics.rows += len(rows)
+        self.metrics.bytes += size
+        self.metrics.appends += 1
+
+        logger.debug(f"Appended {len(rows)} rows ({size:,} bytes) to {table_id}")
+
+    def flush(self):
+        for table_id in list(self.buffers.keys()):
+            self._flush_table(table_id)
+
+    def commit(self):
+
+        self.flush()
+
+        for table_id, stream_name in self.streams.items():
+            self.writer.commit(table_id, [stream_name])
+            self.metrics.commits += 1
+            logger.info(f"Committed stream {stream_name} to {table_id}")
+
+        self.streams = {}
+
+        logger.info(f"Sink throughput: {self.metrics}")
+
+
+def dataframe_to_rows(df: pd.DataFrame) -> List[dict]:
+    """Convert a DataFrame to a list of dicts, NaN/NaT become None"""
+    rows = df.astype(object).where(df.notna(), None).to_dict("records")
+    return rows
+
+
+class StorageWriteApiWriter(BaseWriter):
+    """BigQuery Storage Write API using pending streams, see https://cloud.google.com/bigquery/docs/write-api
+
+    Requires `google-cloud-bigquery-storage`.
+    """
+
+    # https://cloud.google.com/bigquery/docs/write-api#data_type_conversions
+    proto_types = {
+        "STRING": "TYPE_STRING",
+        "FLOAT": "TYPE_DOUBLE",
+        "FLOAT64": "TYPE_DOUBLE",
+        "INTEGER": "TYPE_INT64",
+        "INT64": "TYPE_INT64",
+        "BOOLEAN": "TYPE_BOOL",
+        "BOOL": "TYPE_BOOL",
+        "DATETIME": "TYPE_STRING",
+        "TIMESTAMP": "TYPE_INT64",
+    }
+
+    def __init__(self, bigquery_client: bigquery.Client, credentials=None):
+        try:
+            from google.cloud import bigquery_storage_v1
+        except ImportError as e:
+            raise ImportError(
+                "StorageWriteApiWriter requires `google-cloud-bigquery-storage`"
+            ) from e
+
+        self.bigquery_client = bigquery_client
+        self.client = bigquery_storage_v1.BigQueryWriteClient(credentials=credentials)
+
+        self.schemas: Dict[str, List[bigquery.SchemaField]] = {}
+        self.message_classes = {}
+        self.append_streams = {}
+        self.offsets: Dict[str, int] = {}
+
+    def _table_path(self, table_id: str) -> str:
+        project, dataset, table = table_id.split(".")
+        return self.client.table_path(project, dataset, table)
+
+    def _message_class(self, table_id: str):
+
+        if table_id in self.message_classes:
+            return self.message_classes[table_id]
+
+        from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+        schema = self.bigquery_client.get_table(table_id).schema
+        self.schemas[table_id] = schema
+
+        file_proto = descriptor_pb2.FileDescriptorProto()
+        file_proto.name = f"{table_id.replace('.', '_')}.proto"
+        file_proto.package = "mycelium"
+        file_proto.syntax = "proto2"
+
+        message_proto = file_proto.message_type.add()
+        message_proto.name = "Row"
+        for number, field in enumerate(schema, start=1):
+            field_proto = message_proto.field.add()
+            field_proto.name = field.name
+            field_proto.number = number
+            field_proto.label = descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL
+            field_proto.type = getattr(
+                descriptor_pb2.FieldDescriptorProto, self.proto_types[field.field_type]
+            )
+
+        pool = descriptor_pool.DescriptorPool()
+        pool.Add(file_proto)
+        descriptor = pool.FindMessageTypeByName("mycelium.Row")
+        message_class = message_factory.GetMessageClass(descriptor)
+
+        self.message_classes[table_id] = (message_class, message_proto)
+        return self.message_classes[table_id]
+
+    def serialize_rows(self, table_id: str, rows: List[dict]) -> List[bytes]:
+
+        message_class, _ = self._message_class(table_id)
+        schema = self.schemas[table_id]
+
+        serialized = []
+        for row in rows:
+            message = message_class()
+            for field in schema:
+                value = row.get(field.name)
+                if value is None or (isinstance(value, float) and math.isnan(value)):
+                    continue
+                if field.field_type == "DATETIME":
+                    value = pd.Timestamp(value).strftime("%Y-%m-%d %H:%M:%S.%f")
+                elif field.field_type == "TIMESTAMP":
+                    value = int(pd.Timestamp(value).value // 1000)
+                elif field.field_type in ["INTEGER", "INT64"]:
+                    value = int(value)
+                elif field.field_type in ["FLOAT", "FLOAT64"]:
+                    value = float(value)
+                elif field.field_type == "STRING":
+                    value = str(value)
+                setattr(message, field.name, value)
+            serialized.append(message.SerializeToString())
+
+        return serialized
+
+    def open_stream(self, table_id: str) -> str:
+        from google.cloud.bigquery_storage_v1 import types, writer
+
+        _, message_proto = self._message_class(table_id)
+
+        write_stream = self.client.create_write_stream(
+            parent=self._table_path(table_id),
+            write_stream=types.WriteStream(type_=types.WriteStream.Type.PENDING),
+        )
+
+        proto_schema = types.ProtoSchema()
+        proto_schema.proto_descriptor = message_proto
+
+        request_template = types.AppendRowsRequest()
+        request_template.write_stream = write_stream.name
+        request_template.proto_rows = types.AppendRowsRequest.ProtoData(
+            writer_schema=proto_schema
+        )
+
+        self.append_streams[write_stream.name] = writer.AppendRowsStream(
+            self.client, request_template
+        )
+        self.offsets[write_stream.name] = 0
+
+        return write_stream.name
+
+    def append_rows(self, stream_name: str, serialized_rows: List[bytes]):
+        from google.cloud.bigquery_storage_v1 import types
+
+        proto_rows = types.ProtoRows()
+        proto_rows.serialized_rows.extend(serialized_rows)
+
+        request = types.AppendRowsRequest()
+        request.offset = self.offsets[stream_name]
+        request.proto_rows = types.AppendRowsRequest.ProtoData(rows=proto_rows)
+
+        # wait for the append so that a failure is raised where it happened
+        self.append_streams[stream_name].send(request).result()
+        self.offsets[stream_name] += len(serialized_rows)
+
+    def commit(self, table_id: str, stream_names: List[str]):
+        from google.cloud.bigquery_storage_v1 import types
+
+        for stream_name in stream_names:
+            self.append_streams.pop(stream_name).close()
+            self.client.finalize_write_stream(name=stream_name)
+            self.offsets.pop(stream_name, None)
+
+        request = types.BatchCommitWriteStreamsRequest(
+            parent=self._table_path(table_id), write_streams=stream_names
+        )
+        response = self.client.batch_commit_write_streams(request)
+
+        if len(response.stream_errors) > 0:
+            raise Exception(f"Couldn't commit {stream_names}: {response.stream_errors}")
+
@@ -0,0 +1,205 @@
+"""The markets of an exchange and instrument type under each of their names
+
+    homogenised   the name shared by every exchange, e.g. BTC-USDT-SWAP
+    exchange_id   the exchange's own id, which the requests take, e.g. BTCUSDT on Binance, BTC-USDT-SWAP on OKX
+    ccxt_symbol   ccxt's unified symbol, which ccxt parses responses into, e.g. BTC/USDT:USDT
+
+with the listing and delisting dates from CoinAPI. The index is kept as a Parquet snapshot in `SYMBOL_INDEX_DIR` and
+only rebuilt when the CoinAPI catalog or the exchange's markets (ccxt `load_markets`) change.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+INDEX_COLUMNS = ["homogenised", "exchange_id", "ccxt_symbol", "listed", "delisted"]
+
+# the ccxt market type preferred when an exchange id is shared by several markets (e.g. BTCUSDT spot and swap)
+CCXT_MARKET_TYPES = {"future": "swap", "index": "spot", "spot": "spot"}
+
+# process-wide, every driver of an exchange and instrument type shares the same index
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def fingerprint(coinapi_assets: pd.DataFrame, markets: dict) -> str:
+    """hash of what the index is built from, the catalog rows and the id, symbol, type and status of each market"""
+    digest = hashlib.sha1()
+    digest.update(pd.util.hash_pandas_object(coinapi_assets, index=False).values.tobytes())
+    digest.update(
+        json.dumps(
+            sorted(
+                (str(market.get("id")), str(market.get("symbol")), str(market.get("type")), bool(market.get("active")))
+                for market in markets.values()
+            )
+        ).encode()
+    )
+    return digest.hexdigest()
+
+
+class SymbolIndex:
+    """O(1) lookups between the names of the markets, see the module docstring
+
+    :param df: the INDEX_COLUMNS, one row per homogenised name
+    :param fingerprint: of the catalog and markets it was built from
+    """
+
+    def __init__(self, df: pd.DataFrame, fingerprint: str):
+        self.df = df.reset_index(drop=True)
+        self.fingerprint = fingerprint
+
+        self._exchange_ids = dict(zip(self.df["homogenised"], self.df["exchange_id"]))
+        self._homogenised = dict(zip(self.df["exchange_id"], self.df["homogenised"]))
+        self._ccxt_symbols = dict(zip(self.df["exchange_id"], self.df["ccxt_symbol"]))
+        self._exchange_ids_by_ccxt_symbol = dict(zip(self.df["ccxt_symbol"], self.df["exchange_id"]))
+        self._listings = dict(
+            zip(self.df["exchange_id"], zip(self.df["listed"], self.df["delisted"]))
+        )
+
+    @classmethod
+    def build(
+        cls,
+        coinapi_assets: pd.DataFrame,
+        markets: dict,
+        exchange_id: str,
+        instrument_type: str,
+    ) -> "SymbolIndex":
+        """index the CoinAPI catalog of an exchange and instrument type
+
+        :param coinapi_assets: see `CoinAPI.get_all_assets_for_exchange`
+        :param markets: `exchange.markets` once loaded, by ccxt symbol
+        :param exchange_id: the ccxt exchange id, e.g. `okx`
+        :param instrument_type: `spot`, `future` (perpetuals) or `index`
+        """
+        base = coinapi_assets["asset_id_base_exchange"].astype(str)
+        quote = coinapi_assets["asset_id_quote_exchange"].astype(str)
+        pair = base + "-" + quote
+
+        # OKX ids are built from the assets, e.g. "BTC-USDT-SWAP" and "BTC-USDT" for its index
+        exchange_ids = coinapi_assets["symbol_id_exchange"].astype(str)
+        if exchange_id == "okx" and instrument_type == "future":
+            exchange_ids = pair + "-SWAP"
+        elif exchange_id == "okx" and instrument_type == "index":
+            exchange_ids = pair
+
+        homogenised = pair + "-SWAP" if instrument_type == "future" else pair
+
+        # ccxt's symbol of each id, the market of the instrument type first
+        market_type = CCXT_MARKET_TYPES.get(instrument_type)
+        ccxt_markets = pd.DataFrame(
+            [(market.get("id"), market.get("symbol"), market.get("type")) for market in markets.values()],
+            columns=["exchange_id", "ccxt_symbol", "type"],
+        )
+        ccxt_markets = ccxt_markets.sort_values(
+            "type", key=lambda types: types != market_type, kind="stable"
+        ).drop_duplicates("exchange_id")
+        ccxt_symbols = exchange_ids.map(ccxt_markets.set_index("exchange_id")["ccxt_symbol"])
+
+        df = pd.DataFrame(
+            {
+                "homogenised": homogenised,
+                "exchange_id": exchange_ids,
+                # like ccxt, an id it doesn't know (e.g. a delisted market) is its own symbol
+                "ccxt_symbol": ccxt_symbols.fillna(exchange_ids),
+                "listed": coinapi_assets.get("data_trade_start"),
+                "delisted": coinapi_assets.get("data_trade_end"),
+            }
+        )
+        # the last listing of a name wins, e.g. a relisted market
+        df = df.drop_duplicates("homogenised", keep="last")
+
+        return cls(df[INDEX_COLUMNS], fingerprint(coinapi_assets, markets))
+
+    def exchange_ids(self) -> Dict[str, str]:
+        """the exchange id of each market, by homogenised name"""
+        return dict(self._exchange_ids)
+
+    def exchange_id(self, homogenised: str) -> Optional[str]:
+        return self._exchange_ids.get(homogenised)
+
+    def homogenised(self, exchange_id: str) -> Optional[str]:
+        return self._homogenised.get(exchange_id)
+
+    def ccxt_symbol(self, exchange_id: str) -> str:
+        """ccxt's unified symbol of an exchange id, ids the index doesn't know are returned as is"""
+        return self._ccxt_symbols.get(exchange_id, exchange_id)
+
+    def exchange_id_of_ccxt_symbol(self, ccxt_symbol: str) -> Optional[str]:
+        return self._exchange_ids_by_ccxt_symbol.get(ccxt_symbol)
+
+    def listing(self, exchange_id: str) -> Tuple[Optional[pd.Timestamp], Optional[pd.Timestamp]]:
+        """the first and last trade CoinAPI has for the market"""
+        return self._listings.get(exchange_id, (None, None))
+
+    def __len__(self):
+        return len(self.df)
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        table = pa.Table.from_pandas(self.df, preserve_index=False)
+        table = table.replace_schema_metadata(
+            {**(table.schema.metadata or {}), b"fingerprint": self.fingerprint.encode()}
+        )
+
+        # write to a temporary file first, other processes might be reading the snapshot
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["SymbolIndex"]:
+        if not path.exists():
+            return None
+
+        try:
+            table = pq.read_table(path)
+        except Exception as e:
+            logger.warning(f"Couldn't read the symbol index {path}: {e}")
+            return None
+
+        metadata = table.schema.metadata or {}
+        return cls(table.to_pandas(), metadata.get(b"fingerprint", b"").decode())
+
+
+def get_symbol_index(
+    coinapi_assets: pd.DataFrame,
+    markets: dict,
+    exchange_id: str,
+    instrument_type: str,
+    cache_dir: Path = None,
+) -> SymbolIndex:
+    """the index of an exchange and instrument type, from memory or the snapshot while their fingerprint matches
+
+    :param cache_dir: defaults to `SYMBOL_INDEX_DIR` (`.symbol_index`), the snapshot is only kept in memory if empty
+    """
+    if cache_dir is None:
+        cache_dir = os.getenv("SYMBOL_INDEX_DIR", ".symbol_index")
+
+    current = fingerprint(coinapi_assets, markets)
+    path = Path(cache_dir) / f"{exchange_id}_{instrument_type}.parquet" if cache_dir else None
+
+    with _indexes_lock:
+        key = (exchange_id, instrument_type, path)
+        index = _indexes.get(key)
+
+        if (index is None or index.fingerprint != current) and path is not None:
+            index = SymbolIndex.load(path)
+
+        if index is None or index.fingerprint != current:
+            index = SymbolIndex.build(coinapi_assets, markets, exchange_id, instrument_type)
+            logger.info(f"Built the {exchange_id} {instrument_type} symbol index ({len(index)} markets)")
+            if path is not None:
+                index.save(path)
+
+        _indexes[key] = index
+
+        return index
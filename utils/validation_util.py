@@ -0,0 +1,185 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+NS_PER_SECOND = 1_000_000_000
+NS_PER_MINUTE = 60 * NS_PER_SECOND
+NS_PER_HOUR = 60 * NS_PER_MINUTE
+NS_PER_DAY = 24 * NS_PER_HOUR
+
+
+def timeframe_to_ns(timeframe: str) -> int:
+    """Convert a ccxt style timeframe (e.g. `1m`, `1h`, `8h`, `1d`) into nanoseconds
+
+    :param timeframe: the timeframe string
+    :return: the length of one period in nanoseconds
+    """
+    return int(pd.Timedelta(timeframe).value)
+
+
+def _to_utc_ns(timestamps: pd.Series):
+    """Return the timestamps as naive UTC int64 nanoseconds along with their original timezone and unit"""
+    index = pd.DatetimeIndex(timestamps)
+    tz, unit = index.tz, getattr(index, "unit", "ns")
+    if tz is not None:
+        index = index.tz_convert(None)
+    return _as_ns(index).asi8.copy(), tz, unit
+
+
+def _as_ns(index: pd.DatetimeIndex) -> pd.DatetimeIndex:
+    # pandas < 2 only has nanosecond resolution
+    return index.as_unit("ns") if hasattr(index, "as_unit") else index
+
+
+def _from_utc_ns(values: np.ndarray, tz, unit: str) -> pd.DatetimeIndex:
+    index = pd.DatetimeIndex(values.view("datetime64[ns]"))
+    if hasattr(index, "as_unit"):
+        index = index.as_unit(unit)
+    if tz is not None:
+        index = index.tz_localize("UTC").tz_convert(tz)
+    return index
+
+
+def validate_timeseries(
+    df: pd.DataFrame,
+    timestamp_col: str,
+    market_col: str,
+    timeframe: str,
+    floor_to_hour: bool = False,
+):
+    """Clean a multi-ticker timeseries in one vectorized pass
+
+    For every ticker the timestamps are floored (to the minute, and to the hour when `floor_to_hour` is set) if any
+    of them is misaligned, duplicated timestamps are dropped (keeping the first) and, when samples are missing, the
+    ticker is re-indexed onto a regular `timeframe` grid with NaN rows for the gaps.
+
+    :param df: the DataFrame to clean, must contain `timestamp_col` and `market_col`
+    :param timestamp_col: the name of the datetime column
+    :param market_col: the name of the ticker column
+    :param timeframe: the expected sampling period, e.g. `1h`
+    :param floor_to_hour: whether the minutes should be zero for all timestamps
+    :return: the cleaned DataFrame indexed by `timestamp_col` and a DataFrame of per-ticker stats
+    """
+    stats_columns = ["duplicated", "missing"]
+
+    if df.empty:
+        clean_df = df.set_index(timestamp_col)
+        return clean_df, pd.DataFrame(columns=stats_columns)
+
+    step = timeframe_to_ns(timeframe)
+
+    codes, tickers = pd.factorize(df[market_col], sort=False)
+    n_tickers = len(tickers)
+    ts, tz, unit = _to_utc_ns(df[timestamp_col])
+
+    # check seconds for all periods, then minutes for hourly and above (only for the tickers that need it)
+    for alignment, flag_name, is_needed in [
+        (NS_PER_MINUTE, "seconds", True),
+        (NS_PER_HOUR, "minutes", floor_to_hour),
+    ]:
+        if not is_needed:
+            continue
+        misaligned = np.bincount(codes, weights=(ts % alignment) != 0, minlength=n_tickers)
+        bad_tickers = misaligned > 0
+        if bad_tickers.any():
+            for ticker in tickers[bad_tickers]:
+                logger.warning(f"{ticker}: Not all {flag_name} are zero")
+            rows = bad_tickers[codes]
+            ts[rows] -= ts[rows] % alignment
+
+    # sort by ticker then time, the sort is stable so the first occurrence of a duplicate is kept
+    order = np.lexsort((ts, codes))
+    ts = ts[order]
+    codes = codes[order]
+
+    duplicated = np.zeros(len(ts), dtype=bool)
+    duplicated[1:] = (codes[1:] == codes[:-1]) & (ts[1:] == ts[:-1])
+    duplicated_count = np.bincount(codes, weights=duplicated, minlength=n_tickers)
+
+    keep = ~duplicated
+    order = order[keep]
+    ts = ts[keep]
+    codes = codes[keep]
+
+    # ticker boundaries in the sorted arrays
+    counts = np.bincount(codes, minlength=n_tickers)
+    first = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    last = first + counts - 1
+    t_start = ts[first]
+    t_end = ts[last]
+
+    # check for gaps in timeseries
+    expected = (t_end - t_start) // step + 1
+    on_grid = (ts - t_start[codes]) % step == 0
+    on_grid_count = np.bincount(codes, weights=on_grid, minlength=n_tickers)
+    missing = (expected - on_grid_count).astype(np.int64)
+
+    for code in np.flatnonzero(duplicated_count):
+        logger.warning(
+            f"{tickers[code]}: Duplicated {int(duplicated_count[code])} samples "
+            f"({duplicated_count[code] / (counts[code] + duplicated_count[code]) * 100:.2f}%)"
+        )
+    for code in np.flatnonzero(missing):
+        logger.warning(
+            f"{tickers[code]}: Missing {missing[code]} samples ({missing[code] / expected[code] * 100:.2f}%)"
+        )
+
+    source = df.drop(columns=[timestamp_col]).take(order).reset_index(drop=True)
+
+    # tickers without gaps are kept as is
+    complete = missing[codes] == 0
+    complete_rows = np.flatnonzero(complete)
+
+    # tickers with gaps are re-indexed on a regular grid, new rows reference the source row -1 (i.e. NaN)
+    gap_tickers = np.flatnonzero(missing > 0)
+    grid_sizes = expected[gap_tickers]
+    grid_total = int(grid_sizes.sum())
+    grid_offsets = np.zeros(n_tickers, dtype=np.int64)
+    grid_offsets[gap_tickers] = np.concatenate([[0], np.cumsum(grid_sizes)[:-1]])
+    grid_codes = np.repeat(gap_tickers, grid_sizes)
+    grid_position = np.arange(grid_total) - np.repeat(grid_offsets[gap_tickers], grid_sizes)
+    grid_ts = t_start[grid_codes] + grid_position * step
+
+    grid_source = np.full(grid_total, -1, dtype=np.int64)
+    grid_rows = np.flatnonzero(~complete & on_grid)
+    grid_source[
+        grid_offsets[codes[grid_rows]] + (ts[grid_rows] - t_start[codes[grid_rows]]) // step
+    ] = grid_rows
+
+    rows = np.concatenate([complete_rows, grid_source])
+    out_ts = np.concatenate([ts[complete_rows], grid_ts])
+    out_codes = np.concatenate([codes[complete_rows], grid_codes])
+
+    clean_df = source.reindex(rows)
+    clean_df[market_col] = tickers.take(out_codes)
+
+    # sort by time, ties keep the ticker order
+    final_order = np.lexsort((out_codes, out_ts))
+    clean_df = clean_df.take(final_order)
+    clean_df.index = _from_utc_ns(out_ts[final_order], tz, unit)
+    clean_df.index.name = timestamp_col
+
+    stats = pd.DataFrame(
+        {"duplicated": duplicated_count.astype(np.int64), "missing": missing},
+        index=pd.Index(tickers, name=market_col),
+        columns=stats_columns,
+    )
+
+    return clean_df, stats
+
+
+def unexpected_time_mask(index: pd.DatetimeIndex, timeframe: str) -> np.ndarray:
+    """Flag the timestamps whose time of day isn't a multiple of `timeframe` (e.g. 08:30 for `8h`)
+
+    :param index: the timestamps to check
+    :param timeframe: the expected sampling period, e.g. `1h`
+    :return: a boolean mask, True for unexpected timestamps
+    """
+    step = timeframe_to_ns(timeframe)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    time_of_day = _as_ns(index).asi8 % NS_PER_DAY
+    return (time_of_day % min(step, NS_PER_DAY)) != 0
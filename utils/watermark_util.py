@@ -0,0 +1,128 @@
+import logging
+import os
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def summarise(df: pd.DataFrame, timestamp_col: str, market_col: str) -> pd.DataFrame:
+    """Per ticker max/min/count of the timestamps, with the same columns as `DataDriver.get_latest_date`"""
+    timestamps = pd.to_datetime(df[timestamp_col])
+    if timestamps.dt.tz is not None:
+        timestamps = timestamps.dt.tz_convert(None)
+
+    summary = (
+        pd.DataFrame({"ts": timestamps, "ticker": df[market_col].astype(str)})
+        .groupby("ticker", observed=True)["ts"]
+        .agg(["max", "min", "count"])
+        .rename(
+            columns={
+                "max": "maxStartTime",
+                "min": "minStartTime",
+                "count": "countStartTime",
+            }
+        )
+        .reset_index()
+    )
+
+    return summary[["maxStartTime", "minStartTime", "countStartTime", "ticker"]]
+
+
+class WatermarkStore:
+    """Latest timestamp per ticker and table, kept in a local SQLite file
+
+    It's updated after each committed upload, so `DataDriver.get_latest_date` doesn't need to scan the whole table.
+    The counts are those of the last scan (`replace`), uploads only set the count of tickers the store doesn't know
+    yet: candles are re-uploaded when pages overlap and the merge sink upserts them, so adding every upload up would
+    drift away from the table.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS watermarks (
+                    table_id TEXT NOT NULL,
+                    ticker TEXT NOT NULL,
+                    max_ts TEXT NOT NULL,
+                    min_ts TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (table_id, ticker)
+                )"""
+            )
+
+    @classmethod
+    def from_env(cls):
+        """Store located at `WATERMARK_DB_PATH` (default `watermarks.sqlite`), None if it's set to an empty string"""
+        db_path = os.getenv("WATERMARK_DB_PATH", "watermarks.sqlite")
+
+        if not db_path:
+            return None
+
+        return cls(db_path)
+
+    def _connect(self):
+        # one connection per call, so the store can be used from several threads
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def get(self, table_id: str) -> pd.DataFrame:
+        with closing(self._connect()) as conn:
+            df = pd.read_sql_query(
+                """SELECT max_ts AS maxStartTime, min_ts AS minStartTime, count AS countStartTime, ticker
+                FROM watermarks WHERE table_id = ? ORDER BY max_ts DESC""",
+                conn,
+                params=(table_id,),
+            )
+
+        df["maxStartTime"] = pd.to_datetime(df["maxStartTime"], format=TIMESTAMP_FORMAT)
+        df["minStartTime"] = pd.to_datetime(df["minStartTime"], format=TIMESTAMP_FORMAT)
+
+        return df
+
+    def _rows(self, table_id: str, summary: pd.DataFrame):
+        updated_at = datetime.utcnow().strftime(TIMESTAMP_FORMAT)
+        return [
+            (
+                table_id,
+                row.ticker,
+                pd.Timestamp(row.maxStartTime).strftime(TIMESTAMP_FORMAT),
+                pd.Timestamp(row.minStartTime).strftime(TIMESTAMP_FORMAT),
+                int(row.countStartTime),
+                updated_at,
+            )
+            for row in summary.itertuples(index=False)
+            if not pd.isna(row.maxStartTime)
+        ]
+
+    def update(self, table_id: str, summary: pd.DataFrame):
+        """Merge the output of `summarise` for newly uploaded rows into the stored watermarks, see the class for counts"""
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                """INSERT INTO watermarks (table_id, ticker, max_ts, min_ts, count, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (table_id, ticker) DO UPDATE SET
+                    max_ts = max(max_ts, excluded.max_ts),
+                    min_ts = min(min_ts, excluded.min_ts),
+                    updated_at = excluded.updated_at""",
+                self._rows(table_id, summary),
+            )
+
+    def replace(self, table_id: str, summary: pd.DataFrame):
+        """Overwrite the watermarks of a table, e.g. with the result of a full table scan"""
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM watermarks WHERE table_id = ?", (table_id,))
+            conn.executemany(
+                """INSERT INTO watermarks (table_id, ticker, max_ts, min_ts, count, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                self._rows(table_id, summary),
+            )
+
+        logger.info(f"Rebuilt watermarks of {table_id} ({len(summary)} tickers)")